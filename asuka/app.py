@@ -9,16 +9,16 @@ import os.path
 import re
 
 from boto.ec2.connection import EC2Connection
-from boto.exception import EC2ResponseError
 from boto.route53.connection import Route53Connection
 from github3.api import login
 from github3.github import GitHub
 from github3.repos import Repository
 from paramiko.pkey import PKey
 from paramiko.rsakey import RSAKey
-from werkzeug.utils import cached_property
+from werkzeug.utils import cached_property, import_string
 
 from .instance import REGION_AMI_MAP, AMI_LOGIN_MAP, Instance
+from .inventory import Inventory
 
 __all__ = 'App', 'DeployedBranchDict', 'InstanceSet'
 
@@ -79,17 +79,52 @@ class App(object):
     github_client_secret = None
 
     #: (:class:`collections.Sequence`) The list of hook urls requested
-    #: when the build has started.  These urls are requested in the order.
+    #: when the build has started.  These urls are requested concurrently
+    #: by :class:`~asuka.notify.Notifier`.
     start_hook_urls = []
 
     #: (:class:`collections.Sequence`) The list of hook urls requested
-    #: when the build has finished.  These urls are requested in the order.
+    #: when the build has finished.  These urls are requested concurrently
+    #: by :class:`~asuka.notify.Notifier`.
     finish_hook_urls = []
 
     #: (:class:`collections.Mapping`) The config dict for
     #: :class:`~asuka.web.WebApp`.
     web_config = {}
 
+    #: (:class:`numbers.Integral`) The number of warm instances to keep
+    #: for each provisioning fingerprint.  See :mod:`asuka.warmpool`.
+    #: The default is 0 which disables the warm pool.
+    warm_pool_size = 0
+
+    #: (:class:`numbers.Real`) Seconds to keep idle warm instances.
+    #: The default is an hour.
+    warm_pool_idle_timeout = 3600
+
+    #: (:class:`numbers.Integral`) The maximum number of builds to run
+    #: at a time.  Jobs beyond it wait in the :mod:`job queue
+    #: <asuka.jobqueue>`.  The default is ``None`` which means no limit.
+    max_concurrent_builds = None
+
+    #: (:class:`numbers.Integral`) The maximum number of instances of
+    #: the app.  Builds aren't started while the app has this many
+    #: instances.  The default is ``None`` which means no limit.
+    max_instances = None
+
+    #: (:class:`numbers.Real`) Seconds a job can run.  Timed out jobs
+    #: stop at the next stage boundary, or their worker processes are
+    #: killed.  The default is two hours.  ``None`` means no limit.
+    job_timeout = 7200
+
+    #: (:class:`basestring`) The import name of the job queue backend
+    #: class e.g. ``'asuka.jobqueue:JobQueue'``.  See :mod:`asuka.jobqueue`.
+    job_queue_backend = 'asuka.jobqueue:JobQueue'
+
+    #: (:class:`bool`) Whether jobs are run by separate
+    #: :program:`asuka-worker` processes instead of the web frontend.
+    #: See :mod:`asuka.worker`.  The default is ``False``.
+    external_workers = False
+
     def __init__(self, **values):
         # Pop and set "name" and "ec2_connection" first because other
         # properties require it.
@@ -131,6 +166,15 @@ class App(object):
         self.start_hook_urls = list(self.start_hook_urls)
         self.finish_hook_urls = list(self.finish_hook_urls)
         self.web_config = dict(self.web_config)
+        self.warm_pool_size = int(self.warm_pool_size)
+        self.warm_pool_idle_timeout = float(self.warm_pool_idle_timeout)
+        if self.max_concurrent_builds is not None:
+            self.max_concurrent_builds = int(self.max_concurrent_builds)
+        if self.max_instances is not None:
+            self.max_instances = int(self.max_instances)
+        if self.job_timeout is not None:
+            self.job_timeout = float(self.job_timeout)
+        self.external_workers = bool(self.external_workers)
 
     @property
     def private_key(self):
@@ -290,27 +334,54 @@ class App(object):
             validate_certs=ec2.https_validate_certificates
         )
 
-    def create_instance(self, instance_type='t1.micro'):
-        """Creates a new instance to deploy the application.
+    @property
+    def base_image(self):
+        """(:class:`basestring`) The id of the vanilla AMI of the region."""
+        return REGION_AMI_MAP[self.ec2_connection.region.name]
+
+    def create_instance(self, instance_type='t1.micro', fingerprint=None):
+        """Creates a new instance to deploy the application.  If
+        the provisioning ``fingerprint`` is given, it claims a warm
+        instance from the :class:`~asuka.warmpool.WarmPool` first,
+        and replenishes the pool in background.  If there's no warm
+        instance but an image baked for the ``fingerprint``,
+        the instance is launched from the image, and tagged with
+        ``Provisioning`` and ``Base-Image``.
 
         :param instance_type: the ec2 instance type.
                               default is ``'t1.micro'``
         :type instance_type: :class:`basestring`
+        :param fingerprint: the optional :func:`provisioning fingerprint
+                            <asuka.image.provisioning_fingerprint>`
+        :type fingerprint: :class:`basestring`
         :returns: the created new instance
         :rtype: :class:`asuka.instance.Instance`
 
         """
-        region = self.ec2_connection.region.name
-        ami = REGION_AMI_MAP[region]
+        from .image import ImageStore
+        from .warmpool import WarmPool
+        if fingerprint:
+            pool = WarmPool(self, fingerprint)
+            instance = pool.claim()
+            pool.replenish_in_background()
+            if instance is not None:
+                return instance
+        ami = self.base_image
         login = AMI_LOGIN_MAP[ami]
+        image = fingerprint and ImageStore(self).find(fingerprint)
         reserve = self.ec2_connection.run_instances(
-            image_id=ami,
+            image_id=image.id if image else ami,
             instance_type=instance_type,
             key_name=self.key_name,
             security_groups=list(self.ec2_security_groups)
         )
-        instance = reserve.instances[0]
-        return Instance(self, instance, login)
+        instance = Instance(self, reserve.instances[0], login)
+        if image:
+            instance.tags.update({
+                'Provisioning': fingerprint,
+                'Base-Image': ami
+            })
+        return instance
 
     @property
     def instances(self):
@@ -320,6 +391,23 @@ class App(object):
         """
         return InstanceSet(self)
 
+    @property
+    def inventory(self):
+        """(:class:`~asuka.inventory.Inventory`) The inventory of
+        instances shared in the process.
+
+        """
+        return Inventory.from_app(self)
+
+    @property
+    def job_queue(self):
+        """(:class:`~asuka.jobqueue.JobQueue`) The job queue of the app.
+        Its backend is :attr:`job_queue_backend`.
+
+        """
+        backend = import_string(self.job_queue_backend)
+        return backend.from_app(self)
+
     @cached_property
     def consistent_secret(self):
         """(:class:`str`) The secret key consistent for every deployment
@@ -378,7 +466,8 @@ class App(object):
 
 
 class InstanceSet(collections.Set):
-    """The set of instances.
+    """The set of running instances.  Queries are answered from
+    the :attr:`App.inventory <App.inventory>`.
 
     :param app: the app object
     :type app: :class:`App`
@@ -410,27 +499,16 @@ class InstanceSet(collections.Set):
         return type(self)(self.app, tags)
 
     def __iter__(self):
-        app = self.app
-        ec2_conn = app.ec2_connection
-        filters = dict(('tag:' + tag, value)
-                       for tag, value in self.tags.iteritems())
-        filters['instance-state-name'] = 'running'
-        try:
-            reservations = ec2_conn.get_all_instances(filters=filters)
-            for reserve in reservations:
-                for instance in reserve.instances:
-                    yield Instance(self.app, instance)
-        except EC2ResponseError:
-            pass
+        for instance in self.app.inventory.find(self.tags):
+            yield Instance(self.app, instance)
 
     def __len__(self):
-        return sum(1 for _ in self)
+        return len(self.app.inventory.find(self.tags))
 
     def __contains__(self, instance):
         if isinstance(instance, Instance):
-            for i in self:
-                if i.instance.id == instance.instance.id:
-                    return True
+            return any(i.id == instance.instance.id
+                       for i in self.app.inventory.find(self.tags))
         return False
 
 
@@ -469,13 +547,14 @@ class DeployedBranchDict(collections.Mapping):
         return len(self.branches)
 
     def __iter__(self):
-        from .branch import find_by_label
+        from .branch import OpenPullRequests, find_by_label
         if self.branches is None:
             labels = (label for label, commit in self.itertags())
         else:
             labels = self.branches
+        pull_requests = OpenPullRequests(self.app)
         for label in labels:
-            yield find_by_label(self.app, label)
+            yield find_by_label(self.app, label, pull_requests=pull_requests)
 
     def __getitem__(self, branch):
         from .branch import Branch
@@ -0,0 +1,149 @@
+""":mod:`asuka.aptcache` --- Shared APT package cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Instances of the same platform that install the same set of APT
+packages download the same :file:`.deb` files.  :class:`AptCache` keeps
+them in an archive on the controller, and seeds
+:file:`/var/cache/apt/archives` of new instances in one transfer, so
+that :program:`aptitude` doesn't have to download them again from
+the mirrors.
+
+"""
+import hashlib
+import os
+import os.path
+import tempfile
+
+from .instance import Instance
+from .logger import LoggerProviderMixin
+
+__all__ = 'AptCache',
+
+
+class AptCache(LoggerProviderMixin):
+    """The cache of :file:`.deb` files for the set of APT packages
+    on a platform. ::
+
+        cache = AptCache(instance.platform, repositories, packages)
+        seeded = cache.seed(instance)
+        install_packages(instance)
+        if not seeded:
+            cache.save(instance)
+
+    :param platform: the :attr:`~asuka.instance.Instance.platform`
+                     identifier
+    :type platform: :class:`basestring`
+    :param repositories: the APT repositories to add
+    :type repositories: :class:`collections.Iterable`
+    :param packages: the APT packages to install
+    :type packages: :class:`collections.Iterable`
+    :param path: the path of the directory to store archives.
+                 default is :file:`asuka-apt-cache` in the temporary
+                 directory
+    :type path: :class:`basestring`
+
+    """
+
+    #: (:class:`basestring`) The directory of downloaded packages
+    #: in instances.
+    ARCHIVES_PATH = '/var/cache/apt/archives'
+
+    #: (:class:`basestring`) The temporary path of the archive
+    #: in instances.
+    REMOTE_PATH = '/tmp/asuka-apt-cache.tar'
+
+    def __init__(self, platform, repositories, packages, path=None):
+        if not isinstance(platform, basestring):
+            raise TypeError('platform must be a string, not ' +
+                            repr(platform))
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'asuka-apt-cache')
+        self.platform = platform
+        self.repositories = frozenset(repositories)
+        self.packages = frozenset(packages)
+        self.path = path
+
+    @property
+    def key(self):
+        """(:class:`basestring`) The fingerprint of the platform,
+        repositories and packages.
+
+        """
+        fingerprint = hashlib.sha1(self.platform)
+        for repository in sorted(self.repositories):
+            fingerprint.update('\0repo:' + repository)
+        for package in sorted(self.packages):
+            fingerprint.update('\0package:' + package)
+        return fingerprint.hexdigest()
+
+    @property
+    def archive_path(self):
+        """(:class:`basestring`) The local path of the archive."""
+        return os.path.join(self.path, self.key + '.tar')
+
+    def seed(self, instance):
+        """Extracts the cached :file:`.deb` files into
+        :attr:`ARCHIVES_PATH` of the ``instance`` if there's the cache.
+
+        :param instance: the instance to seed
+        :type instance: :class:`~asuka.instance.Instance`
+        :returns: whether the cache existed or not
+        :rtype: :class:`bool`
+
+        """
+        if not isinstance(instance, Instance):
+            raise TypeError('instance must be an instance of asuka.instance.'
+                            'Instance, not ' + repr(instance))
+        logger = self.get_logger('seed')
+        if not os.path.isfile(self.archive_path):
+            logger.info('no cache for %s', self.key)
+            return False
+        with instance:
+            instance.put_file(self.archive_path, self.REMOTE_PATH)
+            status = instance.sudo(['tar', '-xf', self.REMOTE_PATH,
+                                    '-C', self.ARCHIVES_PATH])
+            instance.do(['rm', '-f', self.REMOTE_PATH])
+        if status:
+            logger.warn('failed to extract the cache %s (%d)',
+                        self.key, status)
+            return False
+        logger.info('seeded %s from %s', instance, self.key)
+        return True
+
+    def save(self, instance):
+        """Archives :file:`.deb` files downloaded into the ``instance``,
+        and stores it to the cache.
+
+        :param instance: the instance which installed packages
+        :type instance: :class:`~asuka.instance.Instance`
+        :returns: whether it's saved or not
+        :rtype: :class:`bool`
+
+        """
+        if not isinstance(instance, Instance):
+            raise TypeError('instance must be an instance of asuka.instance.'
+                            'Instance, not ' + repr(instance))
+        logger = self.get_logger('save')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with instance:
+            status = instance.sudo([
+                'sh', '-c',
+                'cd {0} && tar -cf {1} *.deb && chmod 0644 {1}'.format(
+                    self.ARCHIVES_PATH, self.REMOTE_PATH
+                )
+            ])
+            if status:
+                logger.warn('failed to archive packages (%d)', status)
+                return False
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            os.close(fd)
+            try:
+                instance.get_file(self.REMOTE_PATH, tmp_path)
+                os.rename(tmp_path, self.archive_path)
+            finally:
+                if os.path.isfile(tmp_path):
+                    os.unlink(tmp_path)
+                instance.sudo(['rm', '-f', self.REMOTE_PATH])
+        logger.info('saved %s', self.key)
+        return True
@@ -2,29 +2,43 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 """
+import collections
 import contextlib
+import logging
 import numbers
 import os
 import os.path
 import re
 import sys
 import tempfile
+import threading
+import time
 
 from werkzeug.utils import cached_property
 
 from .app import App
 from .logger import LoggerProviderMixin
 
-__all__ = 'Branch', 'GitMergeError', 'PullRequest', 'find_by_label'
+__all__ = ('Branch', 'GitMergeError', 'MergeabilityCheck',
+           'OpenPullRequests', 'PullRequest', 'find_by_label')
 
 
-def find_by_label(app, label):
+def find_by_label(app, label, merge_test=False, pull_requests=None):
     """Finds the branch by its ``label`` string.
 
     :param app: the application object
     :type app: :class:`~asuka.app.App`
     :param label: the label got from :attr:`Branch.label` property
     :type label: :class:`str`
+    :param merge_test: whether to test mergeability if the label is
+                       of a pull request.  ``False`` by default.
+                       see also :class:`PullRequest`
+    :type merge_test: :class:`bool`
+    :param pull_requests: the optional mapping of pull request numbers to
+                          already fetched :class:`github3.pulls.PullRequest`
+                          objects e.g. :class:`OpenPullRequests`.  pull
+                          requests not in it are fetched one by one
+    :type pull_requests: :class:`collections.Mapping`
 
     """
     m = re.match(r'^branch-(.*)$', str(label))
@@ -32,7 +46,13 @@ def find_by_label(app, label):
         return Branch(app, m.group(1))
     m = re.match(r'^pull-([1-9]\d*)$', label)
     if m:
-        return PullRequest(app, int(m.group(1)), merge_test=False)
+        number = int(m.group(1))
+        if pull_requests is None:
+            pull_request = None
+        else:
+            pull_request = pull_requests.get(number)
+        return PullRequest(app, number, merge_test=merge_test,
+                           pull_request=pull_request)
     raise ValueError('invalid label: ' + repr(label))
 
 
@@ -188,39 +208,68 @@ class PullRequest(Branch):
     :type app: :class:`~asuka.app.App`
     :param number: the pull request number
     :type number: :class:`numbers.Integral`
-    :param merge_test: raise :exc:`GitMergeError` if the pull request
-                       cannot be merged.  if it's ``False`` don't
+    :param merge_test: test mergeability of the pull request in background,
+                       and raise :exc:`GitMergeError` from :meth:`fetch()`
+                       if it cannot be merged.  if it's ``False`` don't
                        test mergeability of the pull request.
                        ``True`` by default
     :type merge_test: :class:`bool`
-    :raises GitMergeError: if ``merge_test`` is ``True`` (default) and
-                           the pull request cannot be merged into the
-                           master branch
+    :param pull_request: the already fetched pull request, if any.
+                         it's fetched from GitHub if omitted
+    :type pull_request: :class:`github3.pulls.PullRequest`
 
     """
 
     #: (:class:`github3.pulls.PullRequest`) The GitHub pull request object.
     pull_request = None
 
-    def __init__(self, app, number, merge_test=True):
+    #: (:class:`bool`) Whether to test mergeability of the pull request
+    #: or not.
+    merge_test = None
+
+    def __init__(self, app, number, merge_test=True, pull_request=None):
         if not isinstance(number, numbers.Integral):
             raise TypeError('number must be an integer, not ' + repr(number))
-        pr = app.repository.pull_request(number)
+        pr = pull_request or app.repository.pull_request(number)
         if not pr:
             raise ValueError("pull request #{0} can't be found".format(number))
-        if merge_test:
-            for x in xrange(10):
-                mergeable = pr.mergeable
-                if mergeable is None or x < 2:
-                    pr = app.repository.pull_request(number)
-                    continue
-                break
-            if not mergeable:
-                msg = '{0!r} cannot be merged [{1!r}]'.format(pr, mergeable)
-                raise GitMergeError(msg)
         super(PullRequest, self).__init__(app, pr.base.ref)
         self.pull_request = pr
         self.number = number
+        self.merge_test = bool(merge_test)
+        if self.merge_test:
+            self.mergeability
+
+    @cached_property
+    def mergeability(self):
+        """(:class:`MergeabilityCheck`) The mergeability check of
+        the pull request's current head.  It's started in background
+        when it's accessed first.
+
+        """
+        return MergeabilityCheck.for_pull_request(self.app,
+                                                  self.pull_request)
+
+    @property
+    def mergeable(self):
+        """(:class:`bool`) Whether the pull request can be merged into
+        the base branch.  It blocks until GitHub determines it.
+
+        """
+        return bool(self.mergeability.wait())
+
+    def test_merge(self):
+        """Waits the :attr:`mergeability` check.
+
+        :raises GitMergeError: if the pull request cannot be merged into
+                               the base branch
+
+        """
+        mergeable = self.mergeability.wait()
+        if not mergeable:
+            msg = '{0!r} cannot be merged [{1!r}]'.format(self.pull_request,
+                                                         mergeable)
+            raise GitMergeError(msg)
 
     @property
     def label(self):
@@ -244,22 +293,54 @@ class PullRequest(Branch):
                               work_tree=path)
                 cmd = command.format(*args, **kwargs)
                 logger.info('%s', cmd)
-                with os.popen(cmd) as f:
-                    for line in f:
-                        logger.debug('[%s] %s', cmd, line)
-            git('checkout {0}', self.pull_request.base.sha)
-            git('checkout -b asuka-pullreq-{0}', self.number)
-            git('pull "{0}" "{1}":asuka-pullreq-{2}',
-                self.app.get_clone_url(self.repository),
-                self.pull_request.head.ref,
-                self.number)
-            git('checkout "{0}"', self.name)
-            git('checkout -b asuka-mergedpullreq-{0}', self.number)
-            git('merge "{0}"', ref)
-            git('branch -D asuka-pullreq-{0}', self.number)
-            yield path
+                output = []
+                f = os.popen(cmd)
+                for line in f:
+                    logger.debug('[%s] %s', cmd, line)
+                    output.append(line)
+                if f.close():
+                    return
+                return ''.join(output)
+            remote = self.app.get_clone_url()
+            head_branch = 'asuka-pullreq-{0}'.format(self.number)
+            merged_branch = 'asuka-mergedpullreq-{0}'.format(self.number)
+            # GitHub precomputes the merge commit of every mergeable pull
+            # request as refs/pull/<number>/merge of the base repository.
+            # It can be used as it is if its second parent is the ref.
+            fetched = git('fetch "{0}" "+refs/pull/{1}/merge:{2}"',
+                          remote, self.number, merged_branch)
+            merge_parent = fetched is not None and git(
+                'rev-parse --verify --quiet "{0}^2"', merged_branch
+            )
+            if merge_parent and merge_parent.strip() == ref:
+                logger.info('use the merge ref precomputed by GitHub')
+                git('checkout "{0}"', merged_branch)
+            else:
+                logger.info('merge ref is not available yet; merge locally')
+                if fetched is not None:
+                    git('branch -D "{0}"', merged_branch)
+                if self.merge_test:
+                    self.test_merge()
+                fetched = git('fetch "{0}" "+refs/pull/{1}/head:{2}"',
+                              remote, self.number, head_branch)
+                if fetched is None:
+                    git('checkout {0}', self.pull_request.base.sha)
+                    git('checkout -b {0}', head_branch)
+                    git('pull "{0}" "{1}":{2}',
+                        self.app.get_clone_url(self.repository),
+                        self.pull_request.head.ref,
+                        head_branch)
+                git('checkout "{0}"', self.name)
+                git('checkout -b {0}', merged_branch)
+                git('merge "{0}"', ref)
+                git('branch -D {0}', head_branch)
+            self.fetched_paths[ref] = path
+            try:
+                yield path
+            finally:
+                del self.fetched_paths[ref]
             git('checkout "{0}"', self.name)
-            git('branch -D asuka-mergedpullreq-{0}', self.number)
+            git('branch -D {0}', merged_branch)
 
     @property
     def url(self):
@@ -277,5 +358,174 @@ class PullRequest(Branch):
         return fmt.format(c.__module__, c.__name__, self)
 
 
+class OpenPullRequests(collections.Mapping):
+    """The mapping of pull request numbers to open
+    :class:`github3.pulls.PullRequest` objects of the ``app``.
+    They are fetched at once when it's looked up first, so that
+    listing several pull requests costs a single GitHub request
+    instead of one request per pull request. ::
+
+        pull_requests = OpenPullRequests(app)
+        branches = [find_by_label(app, label, pull_requests=pull_requests)
+                    for label in labels]
+
+    :param app: the application object
+    :type app: :class:`~asuka.app.App`
+
+    """
+
+    def __init__(self, app):
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        self.app = app
+
+    @cached_property
+    def pull_requests(self):
+        """(:class:`collections.Mapping`) The fetched pull requests."""
+        return dict((pr.number, pr)
+                    for pr in self.app.repository.iter_pulls(state='open'))
+
+    def __len__(self):
+        return len(self.pull_requests)
+
+    def __iter__(self):
+        return iter(self.pull_requests)
+
+    def __getitem__(self, number):
+        return self.pull_requests[number]
+
+
+class MergeabilityCheck(threading.Thread):
+    """The background thread which polls the mergeability of the pull
+    request until GitHub determines it.  Because GitHub computes
+    mergeability lazily, it backs off exponentially while it's unknown.
+    Use :meth:`for_pull_request()` class method instead of
+    the constructor; it caches the result per head and base commits
+    for :attr:`ttl` seconds.
+
+    :param app: the application object
+    :type app: :class:`~asuka.app.App`
+    :param pull_request: the pull request to test
+    :type pull_request: :class:`github3.pulls.PullRequest`
+
+    """
+
+    #: (:class:`numbers.Integral`) The maximum number of polling.
+    max_attempts = 8
+
+    #: (:class:`numbers.Real`) The seconds to wait before the first
+    #: retrial.  It doubles for each retrial.
+    initial_delay = 1
+
+    #: (:class:`numbers.Real`) The maximum seconds between retrials.
+    max_delay = 60
+
+    #: (:class:`numbers.Real`) Seconds to cache the determined result.
+    ttl = 600
+
+    #: (:class:`collections.MutableMapping`) The started checks.
+    #: Keys are tuples of (app name, pull request number, head SHA,
+    #: base SHA).
+    checks = {}
+
+    #: (:class:`threading.Lock`) The lock for :attr:`checks`.
+    checks_lock = threading.Lock()
+
+    #: (:class:`bool`) Whether the pull request can be merged or not.
+    #: ``None`` if it's unknown yet.
+    result = None
+
+    #: (:class:`numbers.Real`) The time the result was determined.
+    #: ``None`` if it's unknown yet.
+    determined_at = None
+
+    @classmethod
+    def for_pull_request(cls, app, pull_request):
+        """Starts a check of the ``pull_request`` if there's no check
+        for its head and base commits yet.  Results older than
+        :attr:`ttl` seconds are evicted.
+
+        :param app: the application object
+        :type app: :class:`~asuka.app.App`
+        :param pull_request: the pull request to test
+        :type pull_request: :class:`github3.pulls.PullRequest`
+        :returns: the started (or cached) check
+        :rtype: :class:`MergeabilityCheck`
+
+        """
+        key = cls.make_key(app, pull_request)
+        expired = time.time() - cls.ttl
+        with cls.checks_lock:
+            for k, c in cls.checks.items():
+                if c.determined_at is not None and c.determined_at < expired:
+                    del cls.checks[k]
+            check = cls.checks.get(key)
+            if check is None:
+                check = cls(app, pull_request)
+                cls.checks[key] = check
+                check.start()
+        return check
+
+    @staticmethod
+    def make_key(app, pull_request):
+        """Makes the key of :attr:`checks` for the ``pull_request``."""
+        return (app.name, pull_request.number,
+                pull_request.head.sha, pull_request.base.sha)
+
+    def __init__(self, app, pull_request):
+        super(MergeabilityCheck, self).__init__(
+            name='mergeability-{0}-{1}'.format(app.name, pull_request.number)
+        )
+        self.daemon = True
+        self.app = app
+        self.pull_request = pull_request
+        self.key = self.make_key(app, pull_request)
+
+    def run(self):
+        logger = logging.getLogger(__name__ + '.MergeabilityCheck')
+        pr = self.pull_request
+        delay = self.initial_delay
+        try:
+            for attempt in xrange(1, self.max_attempts + 1):
+                if self.make_key(self.app, pr) != self.key:
+                    logger.info('%r: head or base has changed', pr)
+                    break
+                if pr.mergeable is not None:
+                    self.result = bool(pr.mergeable)
+                    self.determined_at = time.time()
+                    logger.info('%r: mergeable = %r [attempt #%d]',
+                                pr, self.result, attempt)
+                    return
+                if attempt >= self.max_attempts:
+                    break
+                logger.debug('%r: mergeable is unknown yet; retry after '
+                             '%d second(s)... [attempt #%d]',
+                             pr, delay, attempt)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+                pr = self.app.repository.pull_request(pr.number)
+            logger.warn('%r: failed to determine mergeability', pr)
+        except Exception as e:
+            logger.exception(e)
+        # Don't cache the unknown result so that it can be retried later.
+        with self.checks_lock:
+            if self.checks.get(self.key) is self:
+                del self.checks[self.key]
+
+    def wait(self, timeout=None):
+        """Waits until the check finishes.
+
+        :param timeout: optional timeout in seconds
+        :type timeout: :class:`numbers.Real`
+        :returns: whether the pull request can be merged or not.
+                  ``None`` if it cannot be determined
+        :rtype: :class:`bool`
+
+        """
+        self.join(timeout)
+        return self.result
+
+
 class GitMergeError(EnvironmentError):
     """The error which rise when two Git branches cannot be merged."""
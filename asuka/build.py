@@ -9,25 +9,36 @@ import logging
 import os
 import os.path
 import pprint
+import Queue
 import re
 import shutil
+import sys
 import tempfile
 import threading
+import time
 import traceback
 
 from boto.exception import EC2ResponseError
 from boto.route53.record import ResourceRecordSets
 from pkg_resources import resource_string
-from werkzeug.utils import import_string
-from yaml import load
+from werkzeug.utils import cached_property, import_string
 
+from .aptcache import AptCache
 from .branch import Branch
 from .commit import Commit
+from .coordinator import BuildCancelledError
 from .dist import PYPI_INDEX_URLS, Dist
+from .image import ImageStore, provisioning_fingerprint
 from .instance import Instance
+from .inventory import InventoryError
 from .logger import LoggerProviderMixin
+from .manifest import ManifestLoader, manifest_graph
+from .stage import StageGraph
+from .timing import TimingRecord
+from .wheelhouse import Wheelhouse
 
-__all__ = 'BaseBuild', 'Build', 'BuildLogHandler', 'Clean', 'Promote'
+__all__ = ('BaseBuild', 'Build', 'BuildLogHandler', 'Clean', 'Promote',
+           'ServiceValues', 'call_concurrently')
 
 
 class BaseBuild(LoggerProviderMixin):
@@ -42,7 +53,15 @@ class BaseBuild(LoggerProviderMixin):
 
     #: (:class:`re.RegexObject`) The pattern of service configuration
     #: files.
-    SERVICE_FILENAME_PATTERN = re.compile(r'^(?P<name>[a-z0-9_]{2,50})\.yml$')
+    SERVICE_FILENAME_PATTERN = ManifestLoader.FILENAME_PATTERN
+
+    #: (:class:`basestring`) The filename of the record of resolved
+    #: service manifests in :attr:`data_dir`.
+    MANIFESTS_FILENAME = 'manifests.json'
+
+    #: (:class:`numbers.Integral`) The number of attempts to list
+    #: up-to-date instances for :attr:`replaced_instances`.
+    refresh_retries = 3
 
     #: class:`basestring`) The unique identifier for the build.
     identifier = None
@@ -60,6 +79,16 @@ class BaseBuild(LoggerProviderMixin):
     #: (:class:`~asuka.dist.Dist`) The package distribution object.
     dist = None
 
+    #: (:class:`~asuka.timing.TimingRecord`) The timing record of stages.
+    timing = None
+
+    #: (:class:`collections.MutableSequence`) The extra listeners
+    #: appended to :attr:`StageGraph.listeners
+    #: <asuka.stage.StageGraph.listeners>` of the build e.g.
+    #: :meth:`BuildCoordinator.listener()
+    #: <asuka.coordinator.BuildCoordinator.listener>`.
+    stage_listeners = None
+
     def __init__(self, branch, commit):
         if not isinstance(branch, Branch):
             raise TypeError('branch must be an instance of asuka.branch.'
@@ -74,12 +103,16 @@ class BaseBuild(LoggerProviderMixin):
         self.app = branch.app
         self.branch = branch
         self.commit = commit
-        self.dist = Dist(branch, commit)
         self.identifier = '{branch.label}-{commit!s}.{t:%Y%m%d%H%M%S}'.format(
             branch=branch,
             commit=commit,
             t=datetime.datetime.utcnow()
         )
+        self.timing = TimingRecord(
+            os.path.join(self.data_dir, TimingRecord.FILENAME)
+        )
+        self.dist = Dist(branch, commit, timing=self.timing)
+        self.stage_listeners = []
         self.configure_logging_handler()
 
     @contextlib.contextmanager
@@ -93,50 +126,84 @@ class BaseBuild(LoggerProviderMixin):
         with self.branch.fetch(self.commit.ref) as path:
             yield path
 
-    @property
+    @cached_property
     def services(self):
         """(:class:`collections.Sequence`) The list of declared
         :class:`~asuka.service.Service` objects, in topological order.
 
         """
-        filename_re = self.SERVICE_FILENAME_PATTERN
-        with self.fetch() as path:
-            config_dir = os.path.join(path, self.app.config_dir)
-            if not os.path.isdir(config_dir):
-                return
-            service_dicts = {}
-            for fname in os.listdir(config_dir):
-                match = filename_re.search(fname)
-                if not match:
-                    continue
-                try:
-                    with open(os.path.join(config_dir, fname)) as yaml:
-                        service_dict = load(yaml)
-                    if not service_dict.pop('enabled', False):
-                        continue
-                    service_dicts[match.group('name')] = service_dict
-                except Exception as e:
-                    raise type(e)(fname + ': ' + str(e))
-            result = []
-            visited = set()
-            def visit(name, service_dict):
-                if name in visited:
-                    return
-                visited.add(name)
-                for d_name, d_service_dict in service_dicts.iteritems():
-                    if name in d_service_dict.get('depends', ()):
-                        visit(d_name, d_service_dict)
-                try:
-                    service = self.create_service(name, service_dict)
-                except Exception as e:
-                    raise type(e)(name + ': ' + str(e))
-                result.append(service)
-            for name, service_dict in service_dicts.iteritems():
-                if not service_dict.get('depends'):
-                    visit(name, service_dict)
-            result = result[::-1]
-            self.get_logger('services').info('%r', [s.name for s in result])
-            return result
+        result = []
+        for name, service_dict in self.manifests:
+            try:
+                service = self.create_service(name, service_dict)
+            except Exception as e:
+                raise type(e)(name + ': ' + str(e))
+            result.append(service)
+        self.get_logger('services').info('%r', [s.name for s in result])
+        return result
+
+    @property
+    def manifests(self):
+        """(:class:`collections.Sequence`) The list of (service name,
+        manifest dict) pairs of enabled services, in topological order.
+        It doesn't check out the source tree.
+
+        """
+        return ManifestLoader(self.branch, self.commit).load()
+
+    @cached_property
+    def service_graph(self):
+        """(:class:`~asuka.graph.DependencyGraph`) The dependency graph
+        of service names.
+
+        """
+        return manifest_graph(self.manifests)
+
+    @property
+    def service_levels(self):
+        """(:class:`collections.Sequence`) The list of dependency levels
+        of :attr:`services`.  Each level is a list of services that depend
+        only on services of prior levels, so services of the same level
+        can be installed concurrently.
+
+        """
+        services = dict((service.name, service) for service in self.services)
+        return [[services[name] for name in level]
+                for level in self.service_graph.levels]
+
+    def resolve_services(self):
+        """Resolves :attr:`services`.  It's the first stage of
+        builds.
+
+        :returns: the list of :attr:`services`
+        :rtype: :class:`collections.Sequence`
+
+        """
+        return self.services
+
+    def make_stages(self):
+        """Makes the :class:`~asuka.stage.StageGraph` of the build.
+        Subclasses have to implement this.
+
+        :returns: the stage graph of the build
+        :rtype: :class:`~asuka.stage.StageGraph`
+
+        """
+        raise NotImplementedError('make_stages() method has to be '
+                                  'implemented')
+
+    def run_stages(self):
+        """Runs the stages made by :meth:`make_stages()`, recording their
+        durations into :attr:`timing`.
+
+        :returns: the mapping of all values the stages provided
+        :rtype: :class:`collections.Mapping`
+
+        """
+        stages = self.make_stages()
+        stages.listeners.extend(self.stage_listeners)
+        stages.listeners.append(self.timing.listen)
+        return stages.run()
 
     def create_service(self, name, service_dict):
         """Creates an instance of :class:`~asuka.service.Service`
@@ -186,25 +253,25 @@ class BaseBuild(LoggerProviderMixin):
     def replaced_instances(self):
         """(:class:`collections.Set`) The set of :class:`Instance
         <boto.ec2.instance.Instance>`\ s to be replaced with an instance
-        built by this.
+        built by this.  Instances to terminate have to be up to date,
+        so it raises :exc:`~asuka.inventory.InventoryError` instead of
+        falling back to the stale snapshot if EC2 keeps failing.
 
         """
         logger = self.get_logger('replaced_instances')
-        try:
-            reservations = self.app.ec2_connection.get_all_instances(filters={
-                'tag:App': self.app.name,
-                'tag:Branch': self.branch.label
-            })
-            instances = frozenset(
-                instance
-                for reservation in reservations
-                for instance in reservation.instances
-            )
-            logger.debug('instances = %r', instances)
-            return instances
-        except EC2ResponseError as e:
-            logger.exception(e)
-            raise
+        inventory = self.app.inventory
+        tags = {'Branch': self.branch.label}
+        for retry in xrange(self.refresh_retries):
+            if retry:
+                time.sleep(2 ** retry)
+            if inventory.refresh(tags):
+                break
+        else:
+            raise InventoryError('failed to list instances of ' +
+                                 repr(self.branch.label))
+        instances = frozenset(inventory.find(tags, states=inventory.STATES))
+        logger.debug('instances = %r', instances)
+        return instances
 
     def terminate_instances(self):
         """Terminates the instances of the :attr:`branch`."""
@@ -214,7 +281,8 @@ class BaseBuild(LoggerProviderMixin):
             instance_ids = [instance.id for instance in instances]
             logger.debug('instance_ids = %r', instance_ids)
             self.app.ec2_connection.terminate_instances(instance_ids)
-        except EC2ResponseError as e:
+            self.app.inventory.forget(instance_ids)
+        except (EC2ResponseError, InventoryError) as e:
             logger.exception(e)
 
     @property
@@ -228,6 +296,69 @@ class BaseBuild(LoggerProviderMixin):
             os.makedirs(path)
         return path
 
+    def save_manifests(self, manifests):
+        """Records the resolved service ``manifests`` of the build into
+        :attr:`data_dir`, so that :class:`Clean` can reconstruct services
+        later without git or GitHub access.
+
+        :param manifests: the list of (service name, manifest dict) pairs
+        :type manifests: :class:`collections.Sequence`
+
+        """
+        filename = os.path.join(self.data_dir, self.MANIFESTS_FILENAME)
+        with open(filename, 'w') as f:
+            json.dump({
+                'branch': self.branch.label,
+                'commit': self.commit.ref,
+                'services': [[name, d] for name, d in manifests]
+            }, f)
+
+    def load_recorded_manifests(self, commit_ref=None, strict=False):
+        """Finds the service manifests recorded by the latest build
+        of the :attr:`commit`, or by the latest build of the :attr:`branch`
+        if there's no build of the commit.  The record of this build
+        itself is excluded.
+
+        :param commit_ref: the commit ref to prefer instead of
+                           the :attr:`commit`
+        :type commit_ref: :class:`basestring`
+        :param strict: if ``True`` it finds only builds of the commit.
+                       default is ``False``
+        :type strict: :class:`bool`
+        :returns: the list of (service name, manifest dict) pairs, or
+                  ``None`` if there's no record
+        :rtype: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('load_recorded_manifests')
+        if commit_ref is None:
+            commit_ref = self.commit.ref
+        data_dir = self.app.data_dir
+        prefix = self.branch.label + '-'
+        builds = []
+        for dirname in os.listdir(data_dir):
+            if dirname == self.identifier:
+                continue
+            identifier, _, timestamp = dirname.rpartition('.')
+            if not identifier.startswith(prefix):
+                continue
+            ref = identifier[len(prefix):]
+            if not Commit.REF_PATTERN.match(ref) or len(ref) != 40:
+                continue
+            elif strict and ref != commit_ref:
+                continue
+            filename = os.path.join(data_dir, dirname,
+                                    self.MANIFESTS_FILENAME)
+            if os.path.isfile(filename):
+                builds.append((ref == commit_ref, timestamp, filename))
+        if not builds:
+            return
+        _, _, filename = max(builds)
+        logger.info('use the recorded manifests: %s', filename)
+        with open(filename) as f:
+            record = json.load(f)
+        return [(str(name), d) for name, d in record['services']]
+
     def configure_logging_handler(self):
         filename = os.path.join(self.data_dir, 'log.txt')
         handler = BuildLogHandler(filename, encoding='utf-8')
@@ -251,17 +382,56 @@ class Build(BaseBuild):
     :param commit: the commit of the build
     :type commit: :class:`~asuka.commit.Commit`
     :param instance: the instance the build is/will be done.
+                     if it's omitted the build launches a new instance
+                     from the image baked for its provisioning
+                     fingerprint if there is
     :type instance: :class:`~asuka.instance.Instance`
 
     """
 
+    #: (:class:`collections.Set`) The APT packages every instance needs.
+    BASE_APT_PACKAGES = frozenset([
+        'build-essential', 'python-dev', 'python-setuptools', 'python-pip'
+    ])
+
     #: (:class:`~asuka.instance.Instance`) The instance the build
     #: is/will be done.
     instance = None
 
-    def __init__(self, branch, commit, instance):
+    #: (:class:`bool`) Whether to bake the provisioned instance into
+    #: an image if there's no image for its provisioning fingerprint.
+    bake_image = True
+
+    #: (:class:`bool`) Whether to redeploy into the existing healthy
+    #: instance of the branch in place if its provisioning fingerprint
+    #: is the same.
+    redeploy_in_place = True
+
+    #: (:class:`collections.Mapping`) The mapping of service names to
+    #: manifest dicts the reused :attr:`instance` was deployed with.
+    #: ``None`` unless the build redeploys in place.
+    previous_manifests = None
+
+    #: (:class:`collections.Mapping`) The tags the reused :attr:`instance`
+    #: had before the build.  They are restored if the build fails or
+    #: is cancelled.  ``None`` unless the build redeploys in place.
+    previous_tags = None
+
+    #: (:class:`bool`) Whether the :attr:`instance` was launched by
+    #: the build itself.
+    launched = False
+
+    #: The context of the source tree fetched by :meth:`make_package()`.
+    #: It's kept until the build finishes, so that services (e.g.
+    #: :class:`~asuka.services.statics3.StaticS3Service`) reuse the tree
+    #: instead of fetching it again.
+    fetched_tree = None
+
+    def __init__(self, branch, commit, instance=None):
         super(Build, self).__init__(branch, commit)
-        if not isinstance(instance, Instance):
+        if instance is None:
+            pass
+        elif not isinstance(instance, Instance):
             raise TypeError('expected an instance of asuka.instance.'
                             'Instance, not ' + repr(instance))
         elif not (branch.app is commit.app is instance.app):
@@ -282,6 +452,8 @@ class Build(BaseBuild):
         """
         try:
             return self._install()
+        except BuildCancelledError:
+            raise
         except Exception as e:
             logger = self.get_logger('install')
             logger.exception(e)
@@ -289,52 +461,283 @@ class Build(BaseBuild):
 
     def _install(self):
         logger = self.get_logger('install')
-        sudo = self.instance.sudo
         logger.info(
             'START TO INSTALL: branch = %r, commit = %r, instance = %r',
             self.branch, self.commit, self.instance
         )
-        def setup_instance(service_manifests, service_manifests_available):
-            logger = self.get_logger('install.setup_instance')
-            with self.instance:
-                def aptitude(*commands):
-                    sudo(['aptitude', '-y'] + list(commands),
-                         environ={'DEBIAN_FRONTEND': 'noninteractive'})
-                # create user for app
-                sudo(['useradd', '-U', '-G', 'users,www-data', '-Mr',
-                      self.app.name])
-                # assume instance uses Ubuntu >= 12.04
-                apt_sources = re.sub(
-                    r'\n#\s*(deb(?:-src)?\s+'
-                    r'http://[^.]\.ec2\.archive\.ubuntu\.com/'
-                    r'ubuntu/\s+[^-]+multiverse\n)',
-                    lambda m: '\n' + m.group(1),
-                    self.instance.read_file('/etc/apt/sources.list', sudo=True)
+        try:
+            try:
+                values = self.run_stages()
+            finally:
+                self.release_tree()
+        except BuildCancelledError:
+            logger.info('CANCELLED: branch = %r, commit = %r',
+                        self.branch, self.commit)
+            if self.launched:
+                self.app.ec2_connection.terminate_instances(
+                    [self.instance.id]
                 )
-                self.instance.write_file('/etc/apt/sources.list', apt_sources,
-                                         sudo=True)
-                apt_repos = set()
-                apt_packages = set([
-                    'build-essential', 'python-dev', 'python-setuptools',
-                    'python-pip'
-                ])
-                with service_manifests_available:
-                    while not service_manifests[0]:
-                        service_manifests_available.wait()
-                for service in service_manifests[1:]:
-                    apt_repos.update(service.required_apt_repositories)
-                    apt_packages.update(service.required_apt_packages)
-                if apt_repos:
-                    for repo in apt_repos:
-                        sudo(['apt-add-repository', '-y', repo])
-                    aptitude('update')
-                with self.instance.sftp():
-                    self.instance.write_file(
-                        '/usr/bin/apt-fast',
-                        resource_string(__name__, 'apt-fast'),
-                        sudo=True
-                    )
-                    self.instance.write_file('/etc/apt-fast.conf', '''
+                self.app.inventory.forget([self.instance.id])
+            else:
+                self.restore_instance()
+            raise
+        except Exception:
+            self.restore_instance()
+            raise
+        self.instance.status = 'done'
+        self.terminate_instances()
+        return values['deployed_domains']
+
+    def restore_instance(self):
+        """Restores the :attr:`previous_tags` of the reused
+        :attr:`instance`, so that the next build redeploys into it
+        again from the previous commit.  It does nothing if the build
+        doesn't redeploy in place.
+
+        """
+        previous_tags = self.previous_tags
+        if previous_tags is None:
+            return
+        logger = self.get_logger('restore_instance')
+        tags = dict((tag, previous_tags[tag])
+                    for tag in ('Name', 'Commit', 'Live')
+                    if tag in previous_tags)
+        try:
+            self.instance.tags.update(**tags)
+            self.instance.status = previous_tags.get('Status', 'done')
+        except Exception as e:
+            logger.exception(e)
+            return
+        logger.info('restored %r to %s', self.instance,
+                    previous_tags.get('Commit'))
+
+    def make_stages(self):
+        stages = StageGraph()
+        stages.add('resolve_services', self.resolve_services,
+                   provides=['services'])
+        stages.add('launch_instance', self.launch_instance,
+                   requires=['services'])
+        stages.add('tag_instance', self.tag_instance,
+                   after=['launch_instance'])
+        stages.add('provision_instance', self.provision_instance,
+                   requires=['services'], after=['tag_instance'])
+        stages.add('make_package', self.make_package,
+                   provides=['config_path', 'package_path', 'remote_path'])
+        # neither the configuration nor the package must be baked into
+        # the image.
+        stages.add('upload_config', self.upload_config,
+                   requires=['config_path'], after=['provision_instance'])
+        stages.add('upload_package', self.upload_package,
+                   requires=['package_path', 'remote_path'],
+                   after=['provision_instance'])
+        stages.add('install_package', self.install_package,
+                   requires=['remote_path'], after=['upload_package'])
+        # pip processes must not run concurrently on the same instance,
+        # and service packages have to be installed over the package's.
+        stages.add('install_python_packages', self.install_python_packages,
+                   requires=['services'], after=['install_package'])
+        stages.add('run_pre_install', self.run_pre_install,
+                   requires=['services'],
+                   after=['install_python_packages', 'upload_config'])
+        stages.add('install_services', self.install_services,
+                   requires=['services'], after=['run_pre_install'])
+        stages.add('run_post_install', self.run_post_install,
+                   requires=['services'], after=['install_services'])
+        stages.add('route_domains', self.route_domains,
+                   requires=['services'], provides=['deployed_domains'],
+                   after=['run_post_install'])
+        return stages
+
+    def launch_instance(self, services):
+        """Launches a new :attr:`instance` if it's not given.  It's
+        launched from the image baked for the provisioning fingerprint
+        of the ``services`` if there is.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+
+        """
+        if self.instance is not None:
+            return
+        fingerprint = self.get_provisioning_fingerprint(services)
+        if self.redeploy_in_place:
+            self.instance = self.find_reusable_instance(fingerprint)
+            if self.instance is not None:
+                return
+        self.instance = self.app.create_instance(fingerprint=fingerprint)
+        self.launched = True
+        self.get_logger('launch_instance').info(
+            'launched %r from %s', self.instance,
+            self.instance.instance.image_id
+        )
+
+    def find_reusable_instance(self, fingerprint):
+        """Finds the healthy instance of the branch that was deployed
+        with the same provisioning ``fingerprint``, and sets
+        :attr:`previous_manifests`.
+
+        :param fingerprint: the provisioning fingerprint
+        :type fingerprint: :class:`basestring`
+        :returns: the reusable instance, or ``None`` if there isn't
+        :rtype: :class:`~asuka.instance.Instance`
+
+        """
+        logger = self.get_logger('find_reusable_instance')
+        instances = self.app.instances.tagged('Branch', self.branch.label)
+        for instance in instances.tagged('Status', 'done'):
+            tags = instance.tags
+            if (tags.get('Live', '') != self.live or
+                tags.get('Provisioning') != fingerprint):
+                continue
+            manifests = self.load_recorded_manifests(tags.get('Commit'),
+                                                     strict=True)
+            if manifests is None:
+                continue
+            try:
+                with instance:
+                    if instance.do(['true']):
+                        continue
+            except Exception as e:
+                logger.exception(e)
+                continue
+            logger.info('redeploy into %r in place (previous commit: %s)',
+                        instance, tags.get('Commit'))
+            self.previous_manifests = dict(manifests)
+            self.previous_tags = dict(tags)
+            return instance
+
+    def get_changed_services(self, services):
+        """Filters services that have to be (re)installed.  If the build
+        doesn't redeploy in place, all ``services`` are changed.
+        Otherwise, services of which manifests changed, services that
+        are :attr:`~asuka.service.Service.commit_specific`, and services
+        that depend on them are changed.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+        :returns: the list of changed services
+        :rtype: :class:`collections.Sequence`
+
+        """
+        previous = self.previous_manifests
+        if previous is None:
+            return list(services)
+        manifests = dict(self.manifests)
+        graph = self.service_graph
+        changed = set()
+        for service in services:
+            if (service.commit_specific or
+                previous.get(service.name) != manifests[service.name] or
+                graph[service.name] & changed):
+                changed.add(service.name)
+        return [service for service in services if service.name in changed]
+
+    def get_provisioning_requirements(self, services):
+        """Gets the requirements to provision the instance for
+        the ``services``.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+        :returns: the triple of the set of APT repositories, the set of
+                  APT packages, and the set of Python packages
+        :rtype: :class:`tuple`
+
+        """
+        apt_repos = set()
+        apt_packages = set(self.BASE_APT_PACKAGES)
+        python_packages = set()
+        for service in services:
+            apt_repos.update(service.required_apt_repositories)
+            apt_packages.update(service.required_apt_packages)
+            python_packages.update(service.required_python_packages)
+        return apt_repos, apt_packages, python_packages
+
+    def get_provisioning_fingerprint(self, services):
+        """Gets the :func:`~asuka.image.provisioning_fingerprint` of
+        the instance for the ``services``.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+        :returns: the fingerprint
+        :rtype: :class:`basestring`
+
+        """
+        base_image = (self.instance.base_image if self.instance
+                      else self.app.base_image)
+        return provisioning_fingerprint(
+            self.app, base_image,
+            *self.get_provisioning_requirements(services)
+        )
+
+    def tag_instance(self):
+        """Sets the metadata of the :attr:`instance`, and marks it
+        as started.
+
+        """
+        self.update_instance_metadata()
+        self.instance.status = 'started'
+
+    def resolve_services(self):
+        self.save_manifests(self.manifests)
+        return super(Build, self).resolve_services()
+
+    def provision_instance(self, services):
+        """Creates the user for the app, and installs APT packages
+        the ``services`` require into the :attr:`instance`.
+        Downloaded packages are shared with later builds through
+        :class:`~asuka.aptcache.AptCache`.
+
+        If the :attr:`instance` was launched from the image baked for
+        the same provisioning fingerprint, it does nothing.  Otherwise
+        it also installs Python packages the ``services`` require, and
+        then bakes the instance into a new image if :attr:`bake_image`
+        is ``True``.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('provision_instance')
+        fingerprint = self.get_provisioning_fingerprint(services)
+        if self.instance.tags.get('Provisioning') == fingerprint:
+            logger.info('%r is already provisioned: %s',
+                        self.instance, fingerprint)
+            self.instance.status = 'apt-installed'
+            return
+        apt_repos, apt_packages, python_packages = \
+            self.get_provisioning_requirements(services)
+        sudo = self.instance.sudo
+        with self.instance:
+            def aptitude(*commands):
+                sudo(['aptitude', '-y'] + list(commands),
+                     environ={'DEBIAN_FRONTEND': 'noninteractive'})
+            # create user for app
+            sudo(['useradd', '-U', '-G', 'users,www-data', '-Mr',
+                  self.app.name])
+            # assume instance uses Ubuntu >= 12.04
+            apt_sources = re.sub(
+                r'\n#\s*(deb(?:-src)?\s+'
+                r'http://[^.]\.ec2\.archive\.ubuntu\.com/'
+                r'ubuntu/\s+[^-]+multiverse\n)',
+                lambda m: '\n' + m.group(1),
+                self.instance.read_file('/etc/apt/sources.list', sudo=True)
+            )
+            self.instance.write_file('/etc/apt/sources.list', apt_sources,
+                                     sudo=True)
+            if apt_repos:
+                for repo in apt_repos:
+                    sudo(['apt-add-repository', '-y', repo])
+                aptitude('update')
+            apt_cache = AptCache(self.instance.platform, apt_repos,
+                                 apt_packages | set(['aria2']))
+            seeded = apt_cache.seed(self.instance)
+            with self.instance.sftp():
+                self.instance.write_file(
+                    '/usr/bin/apt-fast',
+                    resource_string(__name__, 'apt-fast'),
+                    sudo=True
+                )
+                self.instance.write_file('/etc/apt-fast.conf', '''
 _APTMGR=aptitude
 DOWNLOADBEFORE=true
 _MAXNUM=20
@@ -343,88 +746,272 @@ _DOWNLOADER='aria2c -c -j ${_MAXNUM} -i ${DLLIST} --connect-timeout=10 \
              --timeout=600 -m0'
 DLDIR='/var/cache/apt/archives/apt-fast'
 APTCACHE='/var/cache/apt/archives/'
-                    ''', sudo=True)
-                sudo(['chmod', '+x', '/usr/bin/apt-fast'])
-                aptitude('install', 'aria2')
-                sudo(['apt-fast', '-q', '-y', 'install'] + list(apt_packages),
-                     environ={'DEBIAN_FRONTEND': 'noninteractive'})
-        service_manifests_available = threading.Condition()
-        service_manifests = [False]
-        instance_setup_worker = threading.Thread(
-            target=setup_instance,
-            kwargs={
-                'service_manifests_available': service_manifests_available,
-                'service_manifests': service_manifests
-            }
-        )
-        instance_setup_worker.start()
-        # setup metadata of the instance
-        self.update_instance_metadata()
-        self.instance.status = 'started'
-        # making package (pybundle)
+                ''', sudo=True)
+            sudo(['chmod', '+x', '/usr/bin/apt-fast'])
+            aptitude('install', 'aria2')
+            sudo(['apt-fast', '-q', '-y', 'install'] + list(apt_packages),
+                 environ={'DEBIAN_FRONTEND': 'noninteractive'})
+            if not seeded:
+                apt_cache.save(self.instance)
+            if self.bake_image:
+                self.install_python_requirements(python_packages)
+                images = ImageStore(self.app)
+                images.bake(self.instance, fingerprint)
+                self.instance.tags['Provisioning'] = fingerprint
+                images.collect_garbage()
+        self.instance.status = 'apt-installed'
+
+    def make_package(self):
+        """Fetches the source tree, and then copies the configuration
+        directory and makes the package (pybundle) from it.  The tree
+        is kept until :meth:`release_tree()`.
+
+        :returns: the triple of the local path of the copied config
+                  directory, the local path of the package, and
+                  the remote path to upload the package
+        :rtype: :class:`tuple`
+
+        """
         fd, package_path = tempfile.mkstemp()
         os.close(fd)
-        with self.fetch() as download_path:
-            service_manifests.extend(self.services)
-            service_manifests[0] = True
-            with service_manifests_available:
-                service_manifests_available.notify()
-            config_temp_path = tempfile.mkdtemp()
-            shutil.copytree(
-                os.path.join(download_path, self.app.config_dir),
-                os.path.join(config_temp_path, self.app.name)
+        self.fetched_tree = self.fetch()
+        download_path = self.fetched_tree.__enter__()
+        config_path = tempfile.mkdtemp()
+        shutil.copytree(
+            os.path.join(download_path, self.app.config_dir),
+            os.path.join(config_path, self.app.name)
+        )
+        with self.dist.bundle_package() as (package, filename, temp_path):
+            shutil.copyfile(temp_path, package_path)
+            remote_path = os.path.join('/tmp', filename)
+        return config_path, package_path, remote_path
+
+    def release_tree(self):
+        """Cleans up the source tree fetched by :meth:`make_package()`
+        if there is.
+
+        """
+        fetched_tree, self.fetched_tree = self.fetched_tree, None
+        if fetched_tree is not None:
+            fetched_tree.__exit__(None, None, None)
+
+    def upload_config(self, config_path):
+        """Uploads the copied configuration directory to
+        :file:`/etc/{app}/` of the :attr:`instance`.
+
+        :param config_path: the local path of the copied configuration
+                            directory
+        :type config_path: :class:`basestring`
+
+        """
+        try:
+            self.instance.put_directory(
+                os.path.join(config_path, self.app.name),
+                '/etc/' + self.app.name,
+                sudo=True
             )
-            with self.dist.bundle_package() as (package, filename, temp_path):
-                shutil.copyfile(temp_path, package_path)
-                remote_path = os.path.join('/tmp', filename)
-            with self.instance.sftp():
-                # upload config files
-                self.instance.put_directory(
-                    os.path.join(config_temp_path, self.app.name),
-                    '/etc/' + self.app.name,
-                    sudo=True
-                )
-                shutil.rmtree(config_temp_path)
-                python_packages = set()
-                for service in service_manifests[1:]:
-                    python_packages.update(service.required_python_packages)
-                # uploads package
-                self.instance.put_file(package_path, remote_path)
-                # join instance_setup_worker
-                instance_setup_worker.join()
-                self.instance.status = 'apt-installed'
-                pip_cmd = ['pip', 'install', '-i', PYPI_INDEX_URLS[0]]
-                for idx in PYPI_INDEX_URLS[1:]:
-                    pip_cmd.append('--extra-index-url=' + idx)
-                sudo(pip_cmd + [remote_path], environ={'CI': '1'})
-                sudo(pip_cmd + ['-I'] + list(python_packages),
-                     environ={'CI': '1'})
-                self.instance.status = 'installed'
-                for service in service_manifests[1:]:
-                    for cmd in service.pre_install:
-                        sudo(cmd, environ={'DEBIAN_FRONTEND': 'noninteractive'})
-                values_path = '/etc/{0}/values.json'.format(self.app.name)
-                service_values = {
-                    '.build': dict(
-                        commit=self.commit.ref,
-                        branch=self.branch.label
+        finally:
+            shutil.rmtree(config_path)
+
+    def upload_package(self, package_path, remote_path):
+        """Uploads the package to the :attr:`instance`.
+
+        :param package_path: the local path of the package
+        :type package_path: :class:`basestring`
+        :param remote_path: the remote path to upload the package
+        :type remote_path: :class:`basestring`
+
+        """
+        try:
+            self.instance.put_file(package_path, remote_path)
+        finally:
+            os.unlink(package_path)
+
+    @property
+    def pip_command(self):
+        """(:class:`collections.Sequence`) The :program:`pip install`
+        command with index options.
+
+        """
+        pip_cmd = ['pip', 'install', '-i', PYPI_INDEX_URLS[0]]
+        for idx in PYPI_INDEX_URLS[1:]:
+            pip_cmd.append('--extra-index-url=' + idx)
+        return pip_cmd
+
+    def install_package(self, remote_path):
+        """Installs the uploaded package.
+
+        :param remote_path: the remote path of the uploaded package
+        :type remote_path: :class:`basestring`
+
+        """
+        self.instance.sudo(self.pip_command + [remote_path],
+                           environ={'CI': '1'})
+
+    def install_python_packages(self, services):
+        """Installs Python packages the ``services`` require.
+        They are installed from prebuilt wheels of the
+        :class:`~asuka.wheelhouse.Wheelhouse`, and packages that
+        can't be built into wheels are installed from indices.
+
+        They are already installed if the :attr:`instance` was launched
+        from the image baked for the same provisioning fingerprint, or
+        if :meth:`provision_instance()` has baked it in this build.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('install_python_packages')
+        fingerprint = self.get_provisioning_fingerprint(services)
+        if self.instance.tags.get('Provisioning') == fingerprint:
+            logger.info('%r already has Python packages: %s',
+                        self.instance, fingerprint)
+        elif self.previous_manifests is None:
+            _, _, python_packages = \
+                self.get_provisioning_requirements(services)
+            self.install_python_requirements(python_packages)
+        self.instance.status = 'installed'
+
+    def install_python_requirements(self, python_packages):
+        """Installs ``python_packages`` into the :attr:`instance`.
+
+        :param python_packages: the Python packages to install
+        :type python_packages: :class:`collections.Iterable`
+
+        """
+        if python_packages:
+            wheelhouse = Wheelhouse.for_instance(self.instance)
+            python_packages = wheelhouse.install(self.instance,
+                                                 python_packages)
+        if python_packages:
+            self.instance.sudo(self.pip_command + ['-I'] +
+                               list(python_packages),
+                               environ={'CI': '1'})
+
+    def run_pre_install(self, services):
+        """Runs :attr:`~asuka.service.Service.pre_install` commands
+        of the ``services``.  When the build redeploys in place, only
+        commands of changed services are run.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+
+        """
+        with self.instance:
+            for service in self.get_changed_services(services):
+                for cmd in service.pre_install:
+                    self.instance.sudo(
+                        cmd,
+                        environ={'DEBIAN_FRONTEND': 'noninteractive'}
                     )
-                }
-                refresh_values = lambda: self.instance.write_file(
-                    values_path,
-                    json.dumps(service_values),
-                    sudo=True
-                )
-                refresh_values()
-                for service in service_manifests[1:]:
-                    service_value = service.install(self.instance)
-                    service_values[service.name] = service_value
-                    refresh_values()
-                for service in service_manifests[1:]:
-                    for cmd in service.post_install:
-                        sudo(cmd, environ={'DEBIAN_FRONTEND': 'noninteractive'})
-        service_map = dict((service.name, service)
-                           for service in service_manifests[1:])
+
+    def install_services(self, services):
+        """Installs the ``services`` level by level of
+        :attr:`service_levels`, and shares values they provide
+        through :file:`/etc/{app}/values.json`.  The file is rewritten
+        only before a level that depends on values not written yet,
+        and once at the end.
+
+        When the build redeploys in place, services removed from
+        the manifests are uninstalled, only changed services are
+        installed, and the others are gracefully reloaded at the end
+        with their previous values.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('install_services')
+        service_values = ServiceValues(
+            self.instance,
+            '/etc/{0}/values.json'.format(self.app.name)
+        )
+        changed = set(s.name for s in self.get_changed_services(services))
+        if self.previous_manifests is not None:
+            service_values.load()
+            self.uninstall_removed_services(services, service_values)
+        service_values.update({
+            '.build': dict(
+                commit=self.commit.ref,
+                branch=self.branch.label
+            )
+        })
+        service_values.flush()
+        graph = self.service_graph
+        for level in self.service_levels:
+            level = [service for service in level if service.name in changed]
+            if not level:
+                continue
+            logger.info('install services: %r',
+                        [service.name for service in level])
+            service_values.flush_for(
+                dep for service in level for dep in graph[service.name]
+            )
+            def install(service):
+                with self.timing.measure('service:' + service.name):
+                    return service.name, service.install(self.instance)
+            service_values.update(call_concurrently(install, level))
+        service_values.flush()
+        unchanged = [service for service in services
+                     if service.name not in changed]
+        if unchanged:
+            logger.info('reload services: %r',
+                        [service.name for service in unchanged])
+            def reload_(service):
+                with self.timing.measure('service:' + service.name):
+                    service.reload(self.instance)
+            call_concurrently(reload_, unchanged)
+
+    def uninstall_removed_services(self, services, service_values):
+        """Uninstalls services that were deployed into the reused
+        :attr:`instance` but removed from the manifests.
+
+        :param services: the services to be installed
+        :type services: :class:`collections.Sequence`
+        :param service_values: the values store to remove their values
+        :type service_values: :class:`ServiceValues`
+
+        """
+        names = set(service.name for service in services)
+        for name, manifest in sorted(self.previous_manifests.items()):
+            if name in names:
+                continue
+            self.get_logger('uninstall_removed_services').info(
+                'uninstall %s', name
+            )
+            service = self.create_service(name, dict(manifest))
+            self.instance.sudo(['stop', service.job_name])
+            service.uninstall()
+            service_values.remove(name)
+
+    def run_post_install(self, services):
+        """Runs :attr:`~asuka.service.Service.post_install` commands
+        of the ``services``.
+
+        :param services: the installed services
+        :type services: :class:`collections.Sequence`
+
+        """
+        with self.instance:
+            for service in services:
+                for cmd in service.post_install:
+                    self.instance.sudo(
+                        cmd,
+                        environ={'DEBIAN_FRONTEND': 'noninteractive'}
+                    )
+
+    def route_domains(self, services):
+        """Routes domains of :attr:`route53_records` to the ``services``.
+
+        :param services: the installed services
+        :type services: :class:`collections.Sequence`
+        :returns: the map of routed services to these domain names
+        :rtype: :class:`collections.Mapping`
+
+        """
+        logger = self.get_logger('route_domains')
+        service_map = dict((service.name, service) for service in services)
         deployed_domains = {}
         if self.route53_hosted_zone_id and self.route53_records:
             self.instance.status = 'run'
@@ -448,8 +1035,6 @@ APTCACHE='/var/cache/apt/archives/'
             if changeset.changes:
                 logger.info('Route 53 changeset:\n%s', changeset.to_xml())
                 changeset.commit()
-        self.instance.status = 'done'
-        self.terminate_instances()
         return deployed_domains
 
     @property
@@ -503,6 +1088,22 @@ APTCACHE='/var/cache/apt/archives/'
 
 class Clean(BaseBuild):
 
+    @cached_property
+    def manifests(self):
+        """(:class:`collections.Sequence`) The list of (service name,
+        manifest dict) pairs the branch was built with.  It prefers
+        the record saved by the :class:`Build`, and loads manifests
+        from the repository only if there's no record.
+
+        """
+        manifests = self.load_recorded_manifests()
+        if manifests is None:
+            logger = self.get_logger('manifests')
+            logger.info('there are no recorded manifests; load them from '
+                        'the repository')
+            manifests = super(Clean, self).manifests
+        return manifests
+
     def uninstall(self):
         """Uninstalls the :attr:`services`, cleans up the domains, and
         terminate instances.
@@ -510,15 +1111,37 @@ class Clean(BaseBuild):
         """
         try:
             return self._uninstall()
+        except BuildCancelledError:
+            raise
         except Exception as e:
             logger = self.get_logger('uninstall')
             logger.exception(e)
             raise
 
     def _uninstall(self):
-        logger = self.get_logger('uninstall')
-        self.terminate_instances()
-        service_map = dict((s.name, s) for s in self.services)
+        self.run_stages()
+
+    def make_stages(self):
+        stages = StageGraph()
+        stages.add('terminate_instances', self.terminate_instances)
+        stages.add('resolve_services', self.resolve_services,
+                   provides=['services'])
+        stages.add('remove_domains', self.remove_domains,
+                   requires=['services'])
+        stages.add('uninstall_services', self.uninstall_services,
+                   requires=['services'], after=['remove_domains'])
+        return stages
+
+    def remove_domains(self, services):
+        """Removes domains of :attr:`route53_records` routed to
+        the ``services``.
+
+        :param services: the services to be uninstalled
+        :type services: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('remove_domains')
+        service_map = dict((s.name, s) for s in services)
         if self.route53_hosted_zone_id and self.route53_records:
             changeset = ResourceRecordSets(
                 self.app.route53_connection,
@@ -537,10 +1160,22 @@ class Clean(BaseBuild):
             if changeset.changes:
                 logger.info('Route 53 changeset:\n%s', changeset.to_xml())
                 changeset.commit()
-        for name, service in service_map.iteritems():
-            logger.info('Uninstall %s...', name)
+
+    def uninstall_services(self, services):
+        """Uninstalls the ``services`` in reverse order of
+        :attr:`service_levels`.
+
+        :param services: the services to be uninstalled
+        :type services: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('uninstall_services')
+        def uninstall(service):
+            logger.info('Uninstall %s...', service.name)
             service.uninstall()
-            logger.info('Uninstalled %s', name)
+            logger.info('Uninstalled %s', service.name)
+        for level in reversed(self.service_levels):
+            call_concurrently(uninstall, level)
 
 
 class Promote(Build):
@@ -569,36 +1204,327 @@ class Promote(Build):
         return 'live'
 
 
+class ServiceValues(LoggerProviderMixin):
+    """The store of values services provide, written to the ``path``
+    of the ``instance`` (:file:`/etc/{app}/values.json`).  Updates
+    are buffered, and the file is rewritten only when :meth:`flush()`
+    is called, or :meth:`flush_for()` is called with names of services
+    whose values haven't been written yet. ::
+
+        values = ServiceValues(instance, '/etc/app/values.json')
+        values.update({'db': db.install(instance)})
+        values.flush_for(['db'])  # writes, since web depends on db
+        values.update({'web': web.install(instance)})
+        values.flush()
+
+    :param instance: the instance to write the values file
+    :type instance: :class:`~asuka.instance.Instance`
+    :param path: the path of the values file
+    :type path: :class:`basestring`
+
+    """
+
+    def __init__(self, instance, path):
+        if not isinstance(instance, Instance):
+            raise TypeError('instance must be an instance of asuka.instance.'
+                            'Instance, not ' + repr(instance))
+        self.instance = instance
+        self.path = path
+        self.values = {}
+        self.dirty = set()
+
+    def update(self, values):
+        """Updates values without writing the file.
+
+        :param values: the mapping of service names to their values,
+                       or the iterable of (name, values) pairs
+        :type values: :class:`collections.Mapping`,
+                      :class:`collections.Iterable`
+
+        """
+        values = dict(values)
+        self.values.update(values)
+        self.dirty.update(values)
+
+    def load(self):
+        """Loads values already written in the file.  Loaded values
+        aren't regarded as to be written.
+
+        """
+        try:
+            content = self.instance.read_file(self.path, sudo=True)
+            self.values.update(json.loads(content))
+        except Exception as e:
+            self.get_logger('load').exception(e)
+
+    def remove(self, name):
+        """Removes values of the service ``name``.
+
+        :param name: the service name
+        :type name: :class:`basestring`
+
+        """
+        if self.values.pop(name, None) is not None:
+            self.dirty.add(name)
+
+    def flush_for(self, names):
+        """Writes the file only if any values of the services ``names``
+        haven't been written yet.
+
+        :param names: the names of services to be read
+        :type names: :class:`collections.Iterable`
+        :returns: whether the file was written or not
+        :rtype: :class:`bool`
+
+        """
+        if self.dirty.intersection(names):
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """Writes the file if there are values not written yet."""
+        if not self.dirty:
+            return
+        self.get_logger('flush').info('write %s: %r',
+                                      self.path, sorted(self.dirty))
+        self.instance.write_file(self.path, json.dumps(self.values),
+                                 sudo=True)
+        self.dirty.clear()
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+
+def call_concurrently(function, arguments):
+    """Calls the ``function`` for each of ``arguments`` in separate
+    threads, and waits all of them.
+
+    :param function: the function to call.  it takes an argument
+    :type function: :class:`collections.Callable`
+    :param arguments: the arguments to pass
+    :type arguments: :class:`collections.Sequence`
+    :returns: the list of return values in the order of ``arguments``
+    :rtype: :class:`collections.Sequence`
+    :raises Exception: the first error raised by the ``function``, if any
+
+    """
+    if len(arguments) < 2:
+        return map(function, arguments)
+    results = [None] * len(arguments)
+    errors = []
+    def call(index, argument):
+        try:
+            results[index] = function(argument)
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=call, args=pair)
+               for pair in enumerate(arguments)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        exc_type, exc_value, tb = errors[0]
+        raise exc_type, exc_value, tb
+    return results
+
+
 class BuildLogHandler(logging.FileHandler):
     """Specialized logging handler for build process.  It serializes
     each :class:`~logging.LogRecord` to JSON objects.
 
+    Serialization and writing don't block the logging thread: records
+    are put into a bounded queue shared in the process, and a writer
+    thread serializes and writes them in batches, flushing once per
+    batch.  If the queue is full (e.g. because of verbose output of
+    remote commands), records below :attr:`backpressure_level` are
+    dropped immediately, and the others block the logging thread up to
+    :attr:`backpressure_timeout` seconds before they are dropped.
+    The number of dropped records is written to the log as well.
+
     """
 
+    #: (:class:`numbers.Integral`) The maximum number of records waiting
+    #: to be written in a process.
+    capacity = 10000
+
+    #: (:class:`numbers.Integral`) The maximum number of records written
+    #: at a time.
+    batch_size = 500
+
+    #: (:class:`numbers.Integral`) Records of this level or higher wait
+    #: for the queue instead of being dropped immediately.
+    backpressure_level = logging.WARNING
+
+    #: (:class:`numbers.Real`) Seconds to wait for the full queue.
+    backpressure_timeout = 1
+
+    #: (:class:`Queue.Queue`) Pairs of handlers and records waiting to be
+    #: written in the process.
+    records = None
+
+    #: (:class:`numbers.Integral`) The id of the process which started
+    #: the writer thread for :attr:`records`.
+    records_pid = None
+
+    #: (:class:`threading.Lock`) The lock for :attr:`records`.
+    records_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super(BuildLogHandler, self).__init__(*args, **kwargs)
+        #: (:class:`numbers.Integral`) The number of queued records.
+        self.queued = 0
+        #: (:class:`numbers.Integral`) The number of dropped records.
+        self.dropped = 0
+        #: (:class:`numbers.Integral`) The number of written records.
+        self.written = 0
+        self.reported_drops = 0
+        # emit() holds the handler lock while it waits for the queue,
+        # so the writer thread uses its own lock for the stream.
+        self.write_lock = threading.Lock()
+
+    @classmethod
+    def get_queue(cls):
+        """Gets the queue of the process, and starts the writer thread
+        if it's not running.
+
+        :returns: the queue of records
+        :rtype: :class:`Queue.Queue`
+
+        """
+        with cls.records_lock:
+            if cls.records_pid != os.getpid():
+                # Threads aren't inherited by forked processes.
+                cls.records = Queue.Queue(cls.capacity)
+                cls.records_pid = os.getpid()
+                thread = threading.Thread(target=cls.write,
+                                          args=(cls.records,),
+                                          name='build-log-writer')
+                thread.daemon = True
+                thread.start()
+            return cls.records
+
+    @property
+    def pending(self):
+        """(:class:`numbers.Integral`) The number of records of
+        the process waiting to be written.  The queue inherited from
+        the parent process isn't counted, since no thread of this
+        process drains it.
+
+        """
+        records = self.records
+        if records is None or self.records_pid != os.getpid():
+            return 0
+        return records.unfinished_tasks
+
     def emit(self, record):
         try:
-            stream = self.stream
-            json.dump({
-                'name': record.name,
-                'created': record.created,
-                'levelname': record.levelname,
-                'levelno': record.levelno,
-                'pathname': record.pathname,
-                'lineno': record.lineno,
-                'module': record.module,
-                'func_name': record.funcName,
-                'thread_name': record.threadName,
-                'process_name': record.processName,
-                'msg': record.msg,
-                'args': pprint.pformat(record.args),
-                'message': self.format(record),
-                'traceback': record.exc_info and traceback.format_exception(
-                    *record.exc_info
-                )
-            }, stream)
-            stream.write('\n')
-            self.flush()
+            # Only interpolate the message here; everything else is done
+            # by the writer thread.
+            record.message = self.format(record)
+            record.traceback = record.exc_info and traceback.format_exception(
+                *record.exc_info
+            )
+            records = self.get_queue()
+            if record.levelno >= self.backpressure_level:
+                records.put((self, record), timeout=self.backpressure_timeout)
+            else:
+                records.put_nowait((self, record))
+            self.queued += 1
+        except Queue.Full:
+            self.dropped += 1
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
+
+    def serialize(self, record):
+        """Serializes the ``record`` to a JSON line."""
+        return json.dumps({
+            'name': record.name,
+            'created': record.created,
+            'levelname': record.levelname,
+            'levelno': record.levelno,
+            'pathname': record.pathname,
+            'lineno': record.lineno,
+            'module': record.module,
+            'func_name': record.funcName,
+            'thread_name': record.threadName,
+            'process_name': record.processName,
+            'msg': record.msg,
+            'args': pprint.pformat(record.args),
+            'message': record.message,
+            'traceback': getattr(record, 'traceback', None)
+        }) + '\n'
+
+    def report_drops(self):
+        """Makes the JSON line which reports dropped records."""
+        dropped = self.dropped
+        count = dropped - self.reported_drops
+        self.reported_drops = dropped
+        record = logging.LogRecord(
+            __name__ + '.BuildLogHandler', logging.WARNING, __file__, 0,
+            '%d log records were dropped because the log queue was full',
+            (count,), None, 'report_drops'
+        )
+        record.message = record.getMessage()
+        return self.serialize(record)
+
+    def write_batch(self, records):
+        """Writes the ``records`` and flushes the stream once."""
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.serialize(record))
+            except Exception:
+                self.handleError(record)
+        if self.dropped != self.reported_drops:
+            lines.append(self.report_drops())
+        with self.write_lock:
+            if self.stream is None:
+                return
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+        self.written += len(records)
+
+    @staticmethod
+    def write(records):
+        while True:
+            batch = [records.get()]
+            try:
+                while len(batch) < BuildLogHandler.batch_size:
+                    batch.append(records.get_nowait())
+            except Queue.Empty:
+                pass
+            handlers = []
+            grouped = {}
+            for handler, record in batch:
+                if handler not in grouped:
+                    handlers.append(handler)
+                    grouped[handler] = []
+                grouped[handler].append(record)
+            for handler in handlers:
+                try:
+                    handler.write_batch(grouped[handler])
+                except Exception:
+                    traceback.print_exc()
+            for _ in batch:
+                records.task_done()
+
+    def flush(self, timeout=10):
+        """Waits until records of the process are written, at most
+        ``timeout`` seconds.
+
+        """
+        deadline = time.time() + timeout
+        while self.pending and time.time() < deadline:
+            time.sleep(0.05)
+        super(BuildLogHandler, self).flush()
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            if self.stream is not None and self.dropped != self.reported_drops:
+                self.stream.write(self.report_drops())
+            super(BuildLogHandler, self).close()
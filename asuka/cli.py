@@ -13,8 +13,9 @@ from werkzeug.wsgi import DispatcherMiddleware
 
 from .config import app_from_config_file
 from .web import WebApp
+from .worker import Worker
 
-__all__ = 'ForcingHTTPSMiddleware', 'run_server'
+__all__ = 'ForcingHTTPSMiddleware', 'run_server', 'run_worker'
 
 
 class ForcingHTTPSMiddleware(object):
@@ -39,22 +40,18 @@ class ForcingHTTPSMiddleware(object):
         return self.app(environ, start_response)
 
 
-def run_server():
-    """The main function of :program:`asuka-server`."""
-    parser = optparse.OptionParser(usage='%prog [options] config.yml')
-    parser.add_option('-H', '--host', default='0.0.0.0',
-                      help='Host to listen [default: %default]')
-    parser.add_option('-p', '--port', type='int', default=8080,
-                      help='Port to listen [default: %default]')
-    parser.add_option('--pong', help='Path which simply responds 200 OK e.g. '
-                                     '--pong=/ping/')
+def parse_args(parser):
+    """Adds common options to the ``parser``, parses arguments, and
+    configures logging.
+
+    :param parser: the option parser
+    :type parser: :class:`optparse.OptionParser`
+    :returns: the pair of parsed options and the config file path
+    :rtype: :class:`tuple`
+
+    """
     parser.add_option('--log-file', default='/dev/stderr',
                       help='File to write logs [default: %default]')
-    parser.add_option('--proxy-fix', action='store_true', default=False,
-                      help='Forward X-Forwared-* headers to support HTTP '
-                           'reverse proxies e.g. nginx, lighttpd')
-    parser.add_option('--force-https', action='store_true', default=False,
-                      help='Redirect all HTTP requests to HTTPS locations')
     parser.add_option('-v', '--verbose', action='store_true', default=False)
     parser.add_option('-q', '--quiet', action='store_true', default=False)
     options, args = parser.parse_args()
@@ -82,6 +79,24 @@ def run_server():
     logger =  logging.getLogger()
     logger.setLevel(logging_level)
     logger.addHandler(logging.StreamHandler(log_file))
+    return options, config
+
+
+def run_server():
+    """The main function of :program:`asuka-server`."""
+    parser = optparse.OptionParser(usage='%prog [options] config.yml')
+    parser.add_option('-H', '--host', default='0.0.0.0',
+                      help='Host to listen [default: %default]')
+    parser.add_option('-p', '--port', type='int', default=8080,
+                      help='Port to listen [default: %default]')
+    parser.add_option('--pong', help='Path which simply responds 200 OK e.g. '
+                                     '--pong=/ping/')
+    parser.add_option('--proxy-fix', action='store_true', default=False,
+                      help='Forward X-Forwared-* headers to support HTTP '
+                           'reverse proxies e.g. nginx, lighttpd')
+    parser.add_option('--force-https', action='store_true', default=False,
+                      help='Redirect all HTTP requests to HTTPS locations')
+    options, config = parse_args(parser)
     app = app_from_config_file(config)
     webapp = WebApp(app)
     if options.force_https:
@@ -94,3 +109,24 @@ def run_server():
     if options.pong:
         webapp = DispatcherMiddleware(webapp, {options.pong: pong})
     serve(webapp, host=options.host, port=options.port)
+
+
+def run_worker():
+    """The main function of :program:`asuka-worker`.  Set
+    :attr:`App.external_workers <asuka.app.App.external_workers>` to make
+    :program:`asuka-server` leave jobs to it.
+
+    """
+    parser = optparse.OptionParser(usage='%prog [options] config.yml')
+    parser.add_option('-n', '--name',
+                      help='Unique name of the worker [default: hostname]')
+    parser.add_option('-j', '--processes', type='int',
+                      help='Number of jobs to run at a time '
+                           '[default: twice the number of CPUs plus one]')
+    options, config = parse_args(parser)
+    app = app_from_config_file(config)
+    worker = Worker(app, name=options.name, processes=options.processes)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
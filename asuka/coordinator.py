@@ -0,0 +1,193 @@
+""":mod:`asuka.coordinator` --- Per-branch build coordination
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Rapid pushes to a branch schedule several builds of the same branch,
+and only the build of the latest commit matters.  :class:`BuildCoordinator`
+keeps the generation number of each branch in
+:attr:`App.data_dir <asuka.app.App.data_dir>`, so that it's shared among
+worker processes.  Scheduling a new build bumps the generation, and
+builds of older generations are superseded:
+
+- queued builds are dropped when they start, and
+- running builds are cancelled at the next stage boundary through
+  :attr:`StageGraph.listeners <asuka.stage.StageGraph.listeners>`.
+
+::
+
+    coordinator = BuildCoordinator(app, branch.label)
+    generation = coordinator.supersede(commit.ref)
+    # in the worker process:
+    if coordinator.is_current(generation):
+        build.stage_listeners.append(coordinator.listener(generation))
+        build.install()
+
+"""
+import contextlib
+import fcntl
+import json
+import os
+import os.path
+import urllib
+
+from .logger import LoggerProviderMixin
+
+__all__ = 'BuildCancelledError', 'BuildCoordinator'
+
+
+class BuildCoordinator(LoggerProviderMixin):
+    """The coordinator of builds of a branch.
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+    :param label: the :attr:`~asuka.branch.Branch.label` of the branch
+    :type label: :class:`basestring`
+
+    """
+
+    #: (:class:`basestring`) The name of the directory to store states
+    #: in :attr:`App.data_dir <asuka.app.App.data_dir>`.
+    DIRNAME = '.coordinator'
+
+    def __init__(self, app, label):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        elif not isinstance(label, basestring):
+            raise TypeError('label must be a string, not ' + repr(label))
+        self.app = app
+        self.label = label
+
+    @property
+    def path(self):
+        """(:class:`basestring`) The path of the state file.  The label
+        is quoted, since branch names can contain slashes.
+
+        """
+        dirname = os.path.join(self.app.data_dir, self.DIRNAME)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        label = self.label
+        if isinstance(label, unicode):
+            label = label.encode('utf-8')
+        return os.path.join(dirname, urllib.quote(label, safe='') + '.json')
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Locks the state among processes."""
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @property
+    def state(self):
+        """(:class:`collections.Mapping`) The current state which
+        contains ``'generation'`` and ``'commit'``.
+
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'generation': 0, 'commit': None}
+
+    def _bump(self, commit_ref):
+        with self.lock():
+            state = self.state
+            state['generation'] += 1
+            state['commit'] = commit_ref
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_path, self.path)
+        return state['generation']
+
+    def supersede(self, commit_ref):
+        """Schedules a new build of the ``commit_ref``.  Builds scheduled
+        before are superseded.
+
+        :param commit_ref: the commit ref of the new build
+        :type commit_ref: :class:`basestring`
+        :returns: the generation of the new build
+        :rtype: :class:`numbers.Integral`
+
+        """
+        generation = self._bump(commit_ref)
+        self.get_logger('supersede').info('%s: generation %d [%s]',
+                                          self.label, generation, commit_ref)
+        return generation
+
+    def cancel(self):
+        """Cancels all scheduled and running builds of the branch.
+
+        :returns: the new generation
+        :rtype: :class:`numbers.Integral`
+
+        """
+        generation = self._bump(None)
+        self.get_logger('cancel').info('%s: generation %d',
+                                       self.label, generation)
+        return generation
+
+    def is_current(self, generation):
+        """Checks whether the build of the ``generation`` isn't
+        superseded.
+
+        :param generation: the generation of the build
+        :type generation: :class:`numbers.Integral`
+        :returns: ``True`` if the build is current
+        :rtype: :class:`bool`
+
+        """
+        return self.state['generation'] == generation
+
+    def check(self, generation):
+        """Raises :exc:`BuildCancelledError` if the build of
+        the ``generation`` is superseded.
+
+        :param generation: the generation of the build
+        :type generation: :class:`numbers.Integral`
+        :raises BuildCancelledError: if the build is superseded
+
+        """
+        if not self.is_current(generation):
+            raise BuildCancelledError(self.label, generation)
+
+    def listener(self, generation):
+        """Makes the listener for :attr:`StageGraph.listeners
+        <asuka.stage.StageGraph.listeners>` which cancels the build
+        of the ``generation`` before the next stage starts.
+
+        :param generation: the generation of the build
+        :type generation: :class:`numbers.Integral`
+        :returns: the listener function
+        :rtype: :class:`collections.Callable`
+
+        """
+        def listen(event, stage):
+            if event == 'start':
+                self.check(generation)
+        return listen
+
+
+class BuildCancelledError(Exception):
+    """An error raised when the build is superseded by a newer one.
+
+    :param label: the label of the branch
+    :type label: :class:`basestring`
+    :param generation: the generation of the cancelled build
+    :type generation: :class:`numbers.Integral`
+
+    """
+
+    def __init__(self, label, generation, message=None):
+        if not message:
+            message = 'the build #{0} of {1} was superseded'.format(
+                generation, label
+            )
+        super(BuildCancelledError, self).__init__(message)
+        self.label = label
+        self.generation = generation
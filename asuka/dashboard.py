@@ -0,0 +1,325 @@
+""":mod:`asuka.dashboard` --- Precomputed dashboard
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+The list of deployed branches shows domains and instances of every
+deployment, and the branch of every pull request.  Computing them for
+each page view makes its latency grow linearly with the fleet, so
+:class:`Dashboard` precomputes the whole model in a background thread,
+and the page is rendered from memory.
+
+Besides the full refresh every :attr:`Dashboard.ttl` seconds, the
+dashboard follows the :class:`~asuka.events.EventLog`: status changes
+of instances are applied in place, and only the deployments of
+the branch whose job finished are recomputed.
+
+"""
+import threading
+import time
+
+from .deploy import Deployment
+from .events import EventLog
+from .logger import LoggerProviderMixin
+from .urls import commit as commit_url, service_config_file
+
+__all__ = 'Dashboard',
+
+
+class Dashboard(LoggerProviderMixin):
+    """The precomputed dashboard of the ``app``.  Each deployment of
+    :attr:`deployments` is a plain mapping like::
+
+        {
+            'label': 'pull-123',
+            'branch': {'name': 'master', 'title': u'Pull Request #123',
+                       'url': 'https://github.com/crosspop/asuka/pull/123'},
+            'commit': '5fa1779c62b5...',
+            'commit_url': 'https://github.com/crosspop/asuka/commit/...',
+            'live': False,
+            'domains': [{'service': 'web',
+                         'domain': 'pull-123.test.example.com',
+                         'config_url': 'https://github.com/...'}],
+            'instances': [{'id': 'i-1234abcd', 'state': 'running',
+                           'status': 'done'}]
+        }
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+
+    """
+
+    #: (:class:`numbers.Real`) Seconds between full refreshes.
+    ttl = 60
+
+    #: (:class:`numbers.Real`) Seconds between reads of events.
+    interval = 2
+
+    #: (:class:`numbers.Real`) The time of the last full refresh.
+    #: ``None`` if it has never been refreshed.
+    refreshed_at = None
+
+    #: (:class:`numbers.Real`) The time of the last attempt of a full
+    #: refresh, whether it succeeded or not.  ``None`` if it has never
+    #: been attempted.
+    attempted_at = None
+
+    #: (:class:`basestring`) The error message of the last full refresh
+    #: if it failed.
+    error = None
+
+    #: (:class:`numbers.Integral`) The number which increases whenever
+    #: deployments are added, removed or changed, except for status
+    #: changes of instances.
+    revision = 0
+
+    def __init__(self, app):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        self.app = app
+        self.lock = threading.RLock()
+        self.rows = {}
+        self.branches = {}
+        self.events = EventLog(app)
+        self.cursor = None
+
+    @property
+    def deployments(self):
+        """(:class:`collections.Sequence`) The precomputed deployments,
+        ordered by their branch names.
+
+        """
+        with self.lock:
+            rows = self.rows.values()
+        rows.sort(key=lambda row: (row['branch']['name'], row['label']))
+        return rows
+
+    @property
+    def age(self):
+        """(:class:`numbers.Real`) Seconds since the last full refresh,
+        or ``None`` if it has never been refreshed.
+
+        """
+        if self.refreshed_at is not None:
+            return time.time() - self.refreshed_at
+
+    @property
+    def stale(self):
+        """(:class:`bool`) Whether the last full refresh is too old,
+        e.g. because EC2 or GitHub failed.
+
+        """
+        age = self.age
+        return age is None or age > self.ttl * 2
+
+    def summarize_branch(self, deployment):
+        """Makes the plain mapping of the branch of the ``deployment``.
+        It's the only part which may need GitHub requests.
+
+        """
+        branch = deployment.branch
+        return {
+            'name': branch.name,
+            'title': unicode(branch),
+            'url': branch.url
+        }
+
+    def summarize(self, deployment, branch):
+        """Makes the plain mapping of the ``deployment``.
+
+        :param deployment: the deployment to summarize
+        :type deployment: :class:`~asuka.deploy.Deployment`
+        :param branch: the summary of its branch
+        :type branch: :class:`collections.Mapping`
+        :returns: the summary
+        :rtype: :class:`collections.Mapping`
+
+        """
+        instances = list(deployment.instances)
+        domains = {}
+        for instance in instances:
+            for tag, value in instance.tags.iteritems():
+                if tag.startswith('Domain-'):
+                    domains[tag[7:]] = value
+        return {
+            'label': deployment.label,
+            'branch': branch,
+            'commit': deployment.ref,
+            'commit_url': commit_url(deployment.commit),
+            'live': deployment.live,
+            'domains': [
+                {
+                    'service': service,
+                    'domain': domain[:-1] if domain.endswith('.') else domain,
+                    'config_url': service_config_file(deployment, service)
+                }
+                for service, domain in sorted(domains.iteritems())
+            ],
+            'instances': [
+                {
+                    'id': instance.id,
+                    'state': instance.instance.state,
+                    'status': instance.status
+                }
+                for instance in instances
+            ]
+        }
+
+    def compute(self, deployments, branches):
+        """Summarizes the ``deployments``.  Summaries of branches are
+        taken from and stored into ``branches``.
+
+        """
+        logger = self.get_logger('compute')
+        rows = {}
+        for deployment in deployments:
+            label = deployment.label
+            if label not in branches:
+                try:
+                    branches[label] = self.summarize_branch(deployment)
+                except Exception as e:
+                    # e.g. the pull request has been deleted
+                    logger.exception(e)
+                    branches[label] = {'name': label, 'title': label,
+                                       'url': None}
+            key = label, deployment.ref, deployment.live
+            rows[key] = self.summarize(deployment, branches[label])
+        return rows
+
+    def refresh(self):
+        """Recomputes the whole dashboard.  Branches are resolved
+        again as well.
+
+        :returns: whether it's refreshed or not
+        :rtype: :class:`bool`
+
+        """
+        logger = self.get_logger('refresh')
+        started_at = time.time()
+        self.attempted_at = started_at
+        inventory = self.app.inventory
+        if not inventory.fresh and not inventory.refresh():
+            self.error = 'failed to list instances'
+            return False
+        try:
+            branches = {}
+            rows = self.compute(Deployment.from_app(self.app), branches)
+        except Exception as e:
+            logger.exception(e)
+            self.error = str(e)
+            return False
+        with self.lock:
+            if rows != self.rows:
+                self.revision += 1
+            self.rows = rows
+            self.branches = branches
+            self.refreshed_at = started_at
+            self.error = None
+        logger.debug('%d deployments in %.2f seconds',
+                     len(rows), time.time() - started_at)
+        return True
+
+    def update(self, label):
+        """Recomputes only the deployments of the branch.
+
+        :param label: the :attr:`~asuka.branch.Branch.label` of the branch
+        :type label: :class:`basestring`
+
+        """
+        inventory = self.app.inventory
+        inventory.refresh({'Branch': label})
+        deployments = [deployment
+                       for deployment in Deployment.from_app(self.app)
+                       if deployment.label == label]
+        with self.lock:
+            branches = dict(self.branches)
+        rows = self.compute(deployments, branches)
+        with self.lock:
+            old_rows = dict((key, row) for key, row in self.rows.iteritems()
+                            if key[0] == label)
+            if rows != old_rows:
+                self.revision += 1
+            for key in old_rows:
+                del self.rows[key]
+            self.rows.update(rows)
+            self.branches.update(branches)
+        self.get_logger('update').debug('%s: %d deployments',
+                                        label, len(rows))
+
+    def set_status(self, instance_id, status):
+        """Changes the status of the instance in place.
+
+        :returns: ``False`` if there's no such instance
+        :rtype: :class:`bool`
+
+        """
+        with self.lock:
+            for row in self.rows.itervalues():
+                for instance in row['instances']:
+                    if instance['id'] == instance_id:
+                        instance['status'] = status
+                        return True
+        return False
+
+    def follow(self):
+        """Applies new events.  Status changes of known instances are
+        applied in place.
+
+        :returns: the set of labels of branches to :meth:`update()`
+        :rtype: :class:`collections.Set`
+
+        """
+        labels = set()
+        while True:
+            events, self.cursor = self.events.read(self.cursor)
+            for cursor, event in events:
+                data = event['data']
+                if event['event'] == 'status':
+                    if (not self.set_status(data['instance'], data['status'])
+                        and data['label']):
+                        labels.add(data['label'])
+                elif (event['event'] == 'job' and
+                      data['kind'] != 'hook' and data['state'] != 'running'):
+                    labels.add(data['label'])
+            if not events:
+                return labels
+
+    def run(self):
+        """Keeps the dashboard up to date forever.  A failed full
+        refresh is retried after :attr:`ttl` seconds as well, so that
+        EC2 and GitHub aren't hammered while they fail, and branches
+        are updated in the meantime.
+
+        """
+        logger = self.get_logger('run')
+        while True:
+            try:
+                labels = self.follow()
+                attempted_at = self.attempted_at
+                if (attempted_at is None or
+                    time.time() - attempted_at >= self.ttl):
+                    refreshed = self.refresh()
+                else:
+                    refreshed = False
+                if not refreshed:
+                    for label in labels:
+                        try:
+                            self.update(label)
+                        except Exception as e:
+                            logger.exception(e)
+            except Exception as e:
+                logger.exception(e)
+            time.sleep(self.interval)
+
+    def run_in_background(self):
+        """Runs :meth:`run()` in a daemon thread.
+
+        :returns: the thread
+        :rtype: :class:`threading.Thread`
+
+        """
+        thread = threading.Thread(target=self.run,
+                                  name='dashboard-' + self.app.name)
+        thread.daemon = True
+        thread.start()
+        return thread
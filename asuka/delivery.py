@@ -0,0 +1,166 @@
+""":mod:`asuka.delivery` --- Received web hook deliveries
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+GitHub gives up a web hook delivery if the endpoint doesn't respond in
+seconds, and redelivers it with the same ``X-GitHub-Delivery`` id.
+The web hook endpoint therefore only verifies the signature and stores
+the raw payload in :class:`DeliveryStore`, and the ``hook`` job does
+the rest in the background.  Storing a delivery which already has been
+stored fails, so that redeliveries are processed only once.
+
+"""
+import errno
+import hashlib
+import json
+import os
+import os.path
+import re
+import time
+
+from .logger import LoggerProviderMixin
+
+__all__ = 'DeliveryStore',
+
+
+class DeliveryStore(LoggerProviderMixin):
+    """Web hook deliveries of the ``app``.  They are stored in
+    :attr:`App.data_dir <asuka.app.App.data_dir>`, so that they are
+    shared among workers. ::
+
+        store = DeliveryStore(app)
+        if store.save(delivery_id, event, data):
+            enqueue_hook_job(delivery_id)
+        # in the worker process:
+        event, payload = store.load(delivery_id)
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+
+    """
+
+    #: (:class:`basestring`) The name of the directory to store deliveries
+    #: in :attr:`App.data_dir <asuka.app.App.data_dir>`.
+    DIRNAME = '.deliveries'
+
+    #: (:class:`re.RegexObject`) The pattern of delivery ids which can be
+    #: used as filenames as they are.
+    ID_PATTERN = re.compile(r'^[0-9A-Za-z-]{1,64}$')
+
+    #: (:class:`numbers.Real`) Seconds to keep deliveries to detect
+    #: redeliveries.  The default is a week.
+    keep = 7 * 24 * 60 * 60
+
+    def __init__(self, app):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        self.app = app
+
+    @property
+    def path(self):
+        """(:class:`basestring`) The path of the directory."""
+        path = os.path.join(self.app.data_dir, self.DIRNAME)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return path
+
+    def get_path(self, delivery_id):
+        """Gets the path of the delivery file.
+
+        :param delivery_id: the ``X-GitHub-Delivery`` id
+        :type delivery_id: :class:`basestring`
+        :returns: the path of the file
+        :rtype: :class:`basestring`
+
+        """
+        if not self.ID_PATTERN.match(delivery_id):
+            delivery_id = hashlib.sha1(delivery_id).hexdigest()
+        return os.path.join(self.path, delivery_id + '.json')
+
+    def save(self, delivery_id, event, data):
+        """Stores the delivery unless it already has been stored.
+
+        :param delivery_id: the ``X-GitHub-Delivery`` id
+        :type delivery_id: :class:`basestring`
+        :param event: the ``X-GitHub-Event`` name e.g. ``'push'``
+        :type event: :class:`basestring`
+        :param data: the raw JSON payload
+        :type data: :class:`str`
+        :returns: ``False`` if it's a redelivery
+        :rtype: :class:`bool`
+
+        """
+        path = self.get_path(delivery_id)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                self.get_logger('save').info('%s is a redelivery',
+                                             delivery_id)
+                return False
+            raise
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'id': delivery_id,
+                'event': event,
+                'received_at': time.time(),
+                'data': data
+            }, f)
+        return True
+
+    def load(self, delivery_id):
+        """Loads the delivery.
+
+        :param delivery_id: the ``X-GitHub-Delivery`` id
+        :type delivery_id: :class:`basestring`
+        :returns: the pair of the event name and the parsed payload
+        :rtype: :class:`tuple`
+        :raises KeyError: if there's no such delivery
+
+        """
+        try:
+            with open(self.get_path(delivery_id)) as f:
+                delivery = json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(delivery_id)
+            raise
+        return delivery['event'], json.loads(delivery['data'])
+
+    def discard(self, delivery_id):
+        """Removes the delivery, so that its redelivery is accepted
+        again, e.g. when it failed to be enqueued.
+
+        :param delivery_id: the ``X-GitHub-Delivery`` id
+        :type delivery_id: :class:`basestring`
+
+        """
+        try:
+            os.unlink(self.get_path(delivery_id))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def collect_garbage(self):
+        """Removes deliveries older than :attr:`keep` seconds.
+
+        :returns: the number of removed deliveries
+        :rtype: :class:`numbers.Integral`
+
+        """
+        expired = time.time() - self.keep
+        count = 0
+        for filename in os.listdir(self.path):
+            path = os.path.join(self.path, filename)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.unlink(path)
+                    count += 1
+            except OSError:
+                continue
+        return count
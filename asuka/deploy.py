@@ -1,8 +1,15 @@
 """:mod:`asuka.deploy` --- Deployed branches
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+:meth:`Deployment.from_app()` makes deployments only from tags of
+instances.  Their :attr:`~Deployment.branch` and :attr:`~Deployment.commit`
+are resolved lazily when they are accessed first, and pull requests of
+all deployments are fetched at once by :class:`~asuka.branch.OpenPullRequests`.
+
 """
-from .branch import Branch, find_by_label
+from werkzeug.utils import cached_property
+
+from .branch import Branch, OpenPullRequests, find_by_label
 from .commit import Commit
 
 __all__ = 'Deployment',
@@ -14,12 +21,17 @@ class Deployment(object):
     #: (:class:`~asuka.app.App`) The application object.
     app = None
 
-    #: (:class:`~asuka.branch.Branch`) The branch of the commit.
-    #: It could be a pull request as well.
-    branch = None
+    #: (:class:`basestring`) The :attr:`~asuka.branch.Branch.label` of
+    #: the :attr:`branch`.
+    label = None
 
-    #: (:class:`~asuka.commit.Commit`) The commit of the build.
-    commit = None
+    #: (:class:`basestring`) The :attr:`~asuka.commit.Commit.ref` of
+    #: the :attr:`commit`.
+    ref = None
+
+    #: (:class:`collections.Mapping`) The pull requests to resolve
+    #: the :attr:`branch` from.  See also :func:`~asuka.branch.find_by_label`.
+    pull_requests = None
 
     @classmethod
     def from_app(cls, app):
@@ -41,13 +53,36 @@ class Deployment(object):
                 continue
             live = tags.get('Live') == 'live'
             deployments.add((branch, commit, live))
+        pull_requests = OpenPullRequests(app)
         return frozenset(
-            cls(branch=find_by_label(app, branch),
-                commit=Commit(app, commit),
-                live=live)
+            cls.from_tags(app, branch, commit, live, pull_requests)
             for branch, commit, live in deployments
         )
 
+    @classmethod
+    def from_tags(cls, app, label, ref, live=False, pull_requests=None):
+        """Makes a deployment from tag values without any GitHub
+        requests.
+
+        :param app: the app object
+        :type app: :class:`asuka.app.App`
+        :param label: the ``Branch`` tag
+        :type label: :class:`basestring`
+        :param ref: the ``Commit`` tag
+        :type ref: :class:`basestring`
+        :param live: whether it's promoted or not
+        :type live: :class:`bool`
+        :param pull_requests: the pull requests to resolve the branch from
+        :type pull_requests: :class:`collections.Mapping`
+        :returns: the deployment
+        :rtype: :class:`Deployment`
+
+        """
+        deployment = cls.__new__(cls)
+        deployment._init(app, label, ref, live)
+        deployment.pull_requests = pull_requests
+        return deployment
+
     def __init__(self, branch, commit, live=False):
         if not isinstance(branch, Branch):
             raise TypeError('branch must be an instance of asuka.branch.'
@@ -59,15 +94,34 @@ class Deployment(object):
             raise TypeError('{0!r} and {1!r} are not compatible for each '
                             'other; their applications differ: {0.app!r}, '
                             'and {1.app!r}'.format(branch, commit))
-        self.app = branch.app
+        self._init(branch.app, branch.label, commit.ref, live)
         self.branch = branch
         self.commit = commit
+
+    def _init(self, app, label, ref, live):
+        self.app = app
+        self.label = label
+        self.ref = ref
         self.live = bool(live)
         instances = self.app.instances
-        self.instances = instances.tagged('Branch', branch.label) \
-                                  .tagged('Commit', commit.ref) \
+        self.instances = instances.tagged('Branch', label) \
+                                  .tagged('Commit', ref) \
                                   .tagged('Live', 'live' if self.live else '')
 
+    @cached_property
+    def branch(self):
+        """(:class:`~asuka.branch.Branch`) The branch of the commit.
+        It could be a pull request as well.
+
+        """
+        return find_by_label(self.app, self.label,
+                             pull_requests=self.pull_requests)
+
+    @cached_property
+    def commit(self):
+        """(:class:`~asuka.commit.Commit`) The commit of the build."""
+        return Commit(self.app, self.ref)
+
     @property
     def domains(self):
         """(:class:`collections.Mapping`) The mapping of routed domain names.
@@ -85,6 +139,6 @@ class Deployment(object):
         c = type(self)
         return '<{0}.{1} {2} {3} {4}{5}>'.format(
             c.__module__, c.__name__,
-            self.app.name, self.branch.name, self.commit.ref,
+            self.app.name, self.label, self.ref,
             ' (live)' if self.live else ''
         )
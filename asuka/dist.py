@@ -67,7 +67,17 @@ def capture_stdout():
 
 
 class Dist(LoggerProviderMixin):
-    """The Python package distribution."""
+    """The Python package distribution.
+
+    :param branch: the branch of the commit
+    :type branch: :class:`~asuka.branch.Branch`
+    :param commit: the commit to distribute
+    :type commit: :class:`~asuka.commit.Commit`
+    :param timing: an optional timing record to record durations of
+                   packaging
+    :type timing: :class:`~asuka.timing.TimingRecord`
+
+    """
 
     #: (:class:`~asuka.app.App`) The application object.
     app = None
@@ -79,7 +89,10 @@ class Dist(LoggerProviderMixin):
     #: (:class:`~asuka.commit.Commit`) The commit object.
     commit = None
 
-    def __init__(self, branch, commit):
+    #: (:class:`~asuka.timing.TimingRecord`) The optional timing record.
+    timing = None
+
+    def __init__(self, branch, commit, timing=None):
         if not isinstance(branch, Branch):
             raise TypeError('branch must be an instance of asuka.branch.'
                             'Branch, not ' + repr(branch))
@@ -93,6 +106,20 @@ class Dist(LoggerProviderMixin):
         self.branch = branch
         self.commit = commit
         self.app = commit.app
+        self.timing = timing
+
+    def record_timing(self, name, started_at):
+        """Records the duration of the packaging step to :attr:`timing`
+        if it's present.
+
+        :param name: the name of the step
+        :type name: :class:`basestring`
+        :param started_at: the timestamp when the step started
+        :type started_at: :class:`numbers.Real`
+
+        """
+        if self.timing is not None:
+            self.timing.add('dist:' + name, started_at)
 
     @contextlib.contextmanager
     def archive_package(self, cache=True):
@@ -109,6 +136,7 @@ class Dist(LoggerProviderMixin):
 
         """
         logger_ = self.get_logger('archive_package')
+        started_at = time.time()
         with self.branch.fetch(self.commit.ref) as path:
             setup_script = os.path.join(path, 'setup.py')
             if not os.path.isfile(setup_script):
@@ -135,6 +163,7 @@ class Dist(LoggerProviderMixin):
                 if os.path.isfile(cache_path):
                     logger_.info('cache exists: %s, skipping sdist...',
                                  cache_path)
+                    self.record_timing('sdist', started_at)
                     yield package_name, filename, cache_path
                     return
             run_setup(setup_script, [
@@ -146,6 +175,7 @@ class Dist(LoggerProviderMixin):
             if cache:
                 logger_.info('save sdist cache %s...', cache_path)
                 shutil.copyfile(filepath, cache_path)
+            self.record_timing('sdist', started_at)
             yield package_name, filename, filepath
 
     @contextlib.contextmanager
@@ -180,6 +210,7 @@ class Dist(LoggerProviderMixin):
         main_parser = create_main_parser()
         bundle = commands['bundle'](main_parser)
         with self.archive_package() as (package_name, filename, filepath):
+            started_at = time.time()
             bundle_filename = package_name + '.pybundle'
             if cache:
                 cache_dir_path = os.path.join(
@@ -192,6 +223,7 @@ class Dist(LoggerProviderMixin):
                 if os.path.isfile(cache_path):
                     asuka_logger.info('cache exists: %s, skipping pybundle...',
                                       cache_path)
+                    self.record_timing('bundle', started_at)
                     yield package_name, bundle_filename, cache_path
                     return
             tempdir = tempfile.gettempdir()
@@ -259,6 +291,7 @@ class Dist(LoggerProviderMixin):
             if cache:
                 asuka_logger.info('save pybundle cache %s...', cache_path)
                 shutil.copyfile(bundle_path, cache_path)
+            self.record_timing('bundle', started_at)
             yield package_name, os.path.basename(bundle_path), bundle_path
 
 
@@ -0,0 +1,149 @@
+""":mod:`asuka.events` --- Live events
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Build jobs run in worker processes, possibly on other nodes, so they
+can't notify browsers directly.  They append events instead to
+:class:`EventLog`, a small append-only file in :attr:`App.data_dir
+<asuka.app.App.data_dir>`, and the web frontend tails it to push them
+to connected browsers as server-sent events.  Tailing a local file
+costs neither EC2 nor GitHub requests.
+
+There are two kinds of events:
+
+``'status'``
+   The :attr:`~asuka.instance.Instance.status` of an instance changed.
+   Its data contains ``instance``, ``label``, ``commit``, ``live`` and
+   ``status``.
+
+``'job'``
+   A job started or finished.  Its data contains ``id``, ``kind``,
+   ``label``, ``commit`` and ``state``.
+
+Each event has a cursor, which is a string like ``'1234-5678'``.
+Reading from the cursor gives events after it.
+
+"""
+import errno
+import fcntl
+import json
+import os
+import os.path
+import re
+import time
+
+from .logger import LoggerProviderMixin
+
+__all__ = 'EventLog',
+
+
+class EventLog(LoggerProviderMixin):
+    """The event log of the ``app``. ::
+
+        log = EventLog(app)
+        events, cursor = log.read()  # the cursor of the end
+        log.publish('status', instance='i-1234abcd', status='done')
+        events, cursor = log.read(cursor)
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+
+    """
+
+    #: (:class:`basestring`) The filename of the log
+    #: in :attr:`App.data_dir <asuka.app.App.data_dir>`.
+    FILENAME = '.events.jsonl'
+
+    #: (:class:`re.RegexObject`) The pattern of cursors.
+    CURSOR_PATTERN = re.compile(r'^(\d+)-(\d+)$')
+
+    #: (:class:`numbers.Integral`) The size in bytes to rotate the log.
+    #: Only one rotated log is kept.
+    max_size = 1024 * 1024
+
+    def __init__(self, app):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        self.app = app
+
+    @property
+    def path(self):
+        """(:class:`basestring`) The path of the log file."""
+        return os.path.join(self.app.data_dir, self.FILENAME)
+
+    def publish(self, event, **data):
+        """Appends an event.  It never raises errors, so that
+        builds don't fail because of events.
+
+        :param event: the kind of the event e.g. ``'status'``
+        :type event: :class:`basestring`
+        :param \*\*data: the data of the event
+        :returns: whether it's published or not
+        :rtype: :class:`bool`
+
+        """
+        line = json.dumps({'event': event, 'time': time.time(), 'data': data})
+        path = self.path
+        try:
+            with open(path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError:
+                        size = 0
+                    if size > self.max_size:
+                        os.rename(path, path + '.1')
+                    with open(path, 'a') as f:
+                        f.write(line + '\n')
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except (IOError, OSError) as e:
+            self.get_logger('publish').exception(e)
+            return False
+        return True
+
+    def read(self, cursor=None, limit=100):
+        """Reads events after the ``cursor``.
+
+        :param cursor: the cursor to read from.  if it's omitted,
+                       no events are read and the cursor of the end
+                       is returned
+        :type cursor: :class:`basestring`
+        :param limit: the maximum number of events.  default is 100
+        :type limit: :class:`numbers.Integral`
+        :returns: the pair of the list of (cursor, event) pairs and
+                  the cursor to read the next events from
+        :rtype: :class:`tuple`
+
+        """
+        try:
+            f = open(self.path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return [], '0-0'
+            raise
+        with f:
+            stat = os.fstat(f.fileno())
+            match = cursor and self.CURSOR_PATTERN.match(cursor)
+            if not match:
+                return [], '{0}-{1}'.format(stat.st_ino, stat.st_size)
+            inode, offset = int(match.group(1)), int(match.group(2))
+            if inode != stat.st_ino or offset > stat.st_size:
+                # The log has been rotated since the cursor.
+                offset = 0
+            f.seek(offset)
+            events = []
+            while len(events) < limit:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    # EOF, or the line is being written.
+                    break
+                offset += len(line)
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                events.append(('{0}-{1}'.format(stat.st_ino, offset), event))
+        return events, '{0}-{1}'.format(stat.st_ino, offset)
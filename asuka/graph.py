@@ -0,0 +1,128 @@
+""":mod:`asuka.graph` --- Dependency graphs
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+"""
+import collections
+
+__all__ = 'CyclicDependencyError', 'DependencyGraph'
+
+
+class DependencyGraph(collections.Mapping):
+    """The directed acyclic graph of nodes and their dependencies.
+    It behaves like an immutable mapping of nodes to the set of their
+    dependencies.  Nodes are grouped into :attr:`levels`; every node
+    depends only on nodes of prior levels, so nodes of the same level
+    can be processed concurrently::
+
+        graph = DependencyGraph({
+            'web': ['db', 'static'],
+            'worker': ['db'],
+            'db': [],
+            'static': []
+        })
+        assert graph.levels == [['db', 'static'], ['web', 'worker']]
+
+    :param dependencies: the mapping of nodes to the iterable of
+                         their dependencies
+    :type dependencies: :class:`collections.Mapping`
+    :raises CyclicDependencyError: if there's a cycle
+    :raises ValueError: if there's a dependency not in the graph
+
+    """
+
+    def __init__(self, dependencies):
+        self.dependencies = dict((node, frozenset(deps))
+                                 for node, deps in dependencies.iteritems())
+        for node, deps in self.dependencies.iteritems():
+            for dep in deps:
+                if dep not in self.dependencies:
+                    raise ValueError('{0!r} depends on unknown {1!r}'.format(
+                        node, dep
+                    ))
+        self.levels = self._make_levels()
+
+    def _make_levels(self):
+        dependents = dict((node, set()) for node in self.dependencies)
+        for node, deps in self.dependencies.iteritems():
+            for dep in deps:
+                dependents[dep].add(node)
+        remains = dict((node, len(deps))
+                       for node, deps in self.dependencies.iteritems())
+        levels = []
+        level = [node for node, count in remains.iteritems() if not count]
+        while level:
+            level.sort()
+            levels.append(level)
+            next_level = []
+            for node in level:
+                del remains[node]
+                for dependent in dependents[node]:
+                    remains[dependent] -= 1
+                    if not remains[dependent]:
+                        next_level.append(dependent)
+            level = next_level
+        if remains:
+            raise CyclicDependencyError(self.find_cycle(remains))
+        return levels
+
+    def find_cycle(self, nodes):
+        """Finds a cycle among ``nodes``.
+
+        :param nodes: nodes that make one or more cycles
+        :type nodes: :class:`collections.Iterable`
+        :returns: the list of nodes in the cycle.  the first node is
+                  also the last
+        :rtype: :class:`collections.Sequence`
+
+        """
+        nodes = set(nodes)
+        path = [min(nodes)]
+        while 1:
+            node = min(dep for dep in self.dependencies[path[-1]]
+                       if dep in nodes)
+            if node in path:
+                return path[path.index(node):] + [node]
+            path.append(node)
+
+    @property
+    def order(self):
+        """(:class:`collections.Sequence`) All nodes in topological
+        order.  Dependencies always precede their dependents.
+
+        """
+        return [node for level in self.levels for node in level]
+
+    def dependents(self, node):
+        """Gets nodes that directly depend on the ``node``.
+
+        :param node: the node to find dependents
+        :returns: the set of dependents
+        :rtype: :class:`collections.Set`
+
+        """
+        return frozenset(n for n, deps in self.dependencies.iteritems()
+                         if node in deps)
+
+    def __len__(self):
+        return len(self.dependencies)
+
+    def __iter__(self):
+        return iter(self.dependencies)
+
+    def __getitem__(self, node):
+        return self.dependencies[node]
+
+
+class CyclicDependencyError(ValueError):
+    """An error raised when dependencies make a cycle.
+
+    :param cycle: the list of nodes in the cycle
+    :type cycle: :class:`collections.Sequence`
+
+    """
+
+    def __init__(self, cycle, message=None):
+        if not message:
+            message = 'cyclic dependency: ' + ' -> '.join(map(str, cycle))
+        super(CyclicDependencyError, self).__init__(message)
+        self.cycle = cycle
@@ -0,0 +1,178 @@
+""":mod:`asuka.image` --- Baked machine images
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Provisioning a vanilla Ubuntu image (creating the user, adding APT
+repositories, installing APT and Python packages services require)
+takes most of the time of a build, although its result depends only
+on the set of requirements.  :class:`ImageStore` bakes a provisioned
+instance into an AMI keyed by the :func:`provisioning_fingerprint`,
+so that :meth:`App.create_instance() <asuka.app.App.create_instance>`
+can launch a new instance from it and skip provisioning.
+
+"""
+import datetime
+import hashlib
+
+from boto.exception import EC2ResponseError
+
+from .logger import LoggerProviderMixin
+
+__all__ = 'ImageStore', 'provisioning_fingerprint'
+
+
+def provisioning_fingerprint(app, base_image, apt_repositories, apt_packages,
+                             python_packages):
+    """Computes the fingerprint of provisioning.  Instances provisioned
+    with the same fingerprint are interchangeable.
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+    :param base_image: the vanilla AMI id to provision
+    :type base_image: :class:`basestring`
+    :param apt_repositories: APT repositories to add
+    :type apt_repositories: :class:`collections.Iterable`
+    :param apt_packages: APT packages to install
+    :type apt_packages: :class:`collections.Iterable`
+    :param python_packages: Python packages to install
+    :type python_packages: :class:`collections.Iterable`
+    :returns: the hexadecimal fingerprint
+    :rtype: :class:`basestring`
+
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update('app:' + app.name)
+    fingerprint.update('\0image:' + base_image)
+    for kind, values in [('repo', apt_repositories),
+                         ('apt', apt_packages),
+                         ('python', python_packages)]:
+        for value in sorted(set(values)):
+            fingerprint.update('\0{0}:{1}'.format(kind, value))
+    return fingerprint.hexdigest()
+
+
+class ImageStore(LoggerProviderMixin):
+    """Baked images of the ``app``.  Images are tagged with
+    the ``App``, ``Provisioning`` (fingerprint), ``Base-Image`` and
+    ``Created-At`` tags.
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+
+    """
+
+    #: (:class:`basestring`) The format of image names.
+    NAME_FORMAT = ('asuka-{app.name}-{fingerprint:.12}-'
+                   '{created_at:%Y%m%d%H%M%S}')
+
+    #: (:class:`basestring`) The format of ``Created-At`` tags.
+    TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    #: (:class:`numbers.Integral`) The number of recent images to keep
+    #: for each app even if no instances use them.
+    keep = 5
+
+    def __init__(self, app):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        self.app = app
+
+    @property
+    def images(self):
+        """(:class:`collections.Sequence`) The list of
+        :class:`boto.ec2.image.Image`\ s baked for the app, the newest
+        first.
+
+        """
+        images = self.app.ec2_connection.get_all_images(
+            owners=['self'],
+            filters={'tag:App': self.app.name}
+        )
+        images.sort(key=lambda image: image.tags.get('Created-At', ''),
+                    reverse=True)
+        return images
+
+    def find(self, fingerprint):
+        """Finds the available image of the ``fingerprint``.
+
+        :param fingerprint: the :func:`provisioning_fingerprint`
+        :type fingerprint: :class:`basestring`
+        :returns: the newest image of the ``fingerprint``, or ``None``
+                  if there isn't any
+        :rtype: :class:`boto.ec2.image.Image`
+
+        """
+        for image in self.images:
+            if (image.state == 'available' and
+                image.tags.get('Provisioning') == fingerprint):
+                return image
+
+    def bake(self, instance, fingerprint):
+        """Bakes the provisioned ``instance`` into a new image.  It doesn't
+        wait for the image to be available, and doesn't reboot
+        the ``instance``.
+
+        :param instance: the provisioned instance
+        :type instance: :class:`~asuka.instance.Instance`
+        :param fingerprint: the :func:`provisioning_fingerprint` of
+                            the ``instance``
+        :type fingerprint: :class:`basestring`
+        :returns: the id of the new image
+        :rtype: :class:`basestring`
+
+        """
+        logger = self.get_logger('bake')
+        ec2 = self.app.ec2_connection
+        created_at = datetime.datetime.utcnow()
+        name = self.NAME_FORMAT.format(app=self.app, fingerprint=fingerprint,
+                                       created_at=created_at)
+        with instance:
+            instance.sudo(['sync'])
+            image_id = ec2.create_image(
+                instance.id,
+                name,
+                description='Provisioned by Asuka for ' + self.app.name,
+                no_reboot=True
+            )
+        ec2.create_tags([image_id], {
+            'App': self.app.name,
+            'Provisioning': fingerprint,
+            'Base-Image': instance.base_image,
+            'Created-At': created_at.strftime(self.TIME_FORMAT)
+        })
+        logger.info('baked %s from %r: %s', image_id, instance, fingerprint)
+        return image_id
+
+    def collect_garbage(self):
+        """Deregisters stale images and deletes their snapshots.  Images
+        are stale unless they are one of the :attr:`keep` most recent
+        fingerprints or any instance of the app is still running from
+        them.
+
+        :returns: the list of deregistered image ids
+        :rtype: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('collect_garbage')
+        ec2 = self.app.ec2_connection
+        used = set(instance.instance.image_id
+                   for instance in self.app.instances)
+        fingerprints = []
+        deregistered = []
+        for image in self.images:
+            fingerprint = image.tags.get('Provisioning')
+            if fingerprint not in fingerprints:
+                fingerprints.append(fingerprint)
+                if len(fingerprints) <= self.keep:
+                    continue
+            if image.id in used:
+                continue
+            try:
+                ec2.deregister_image(image.id, delete_snapshot=True)
+            except EC2ResponseError as e:
+                logger.exception(e)
+                continue
+            logger.info('deregistered %s (%s)', image.id, fingerprint)
+            deregistered.append(image.id)
+        return deregistered
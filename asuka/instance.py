@@ -16,6 +16,7 @@ from boto.ec2.instance import Instance as EC2Instance
 from paramiko.client import AutoAddPolicy, SSHClient
 from werkzeug.datastructures import ImmutableDict
 
+from .events import EventLog
 from .logger import LoggerProviderMixin
 
 __all__ = 'REGION_AMI_MAP', 'Instance', 'Metadata'
@@ -125,7 +126,10 @@ class Instance(LoggerProviderMixin):
         self.app = app
         self.id = instance.id
         self.instance = instance
-        self.login = login or AMI_LOGIN_MAP.get(instance.image_id, 'root')
+        self.login = login or AMI_LOGIN_MAP.get(
+            instance.tags.get('Base-Image') or instance.image_id,
+            'root'
+        )
         self.local = threading.local()
         self.tags = Metadata(self)
 
@@ -462,6 +466,28 @@ class Instance(LoggerProviderMixin):
             with self.sftp() as sftp:
                 sftp.remove(path)
 
+    @property
+    def base_image(self):
+        """(:class:`basestring`) The id of the vanilla AMI the instance
+        is from.  If the instance was launched from an image baked by
+        :class:`~asuka.image.ImageStore` it's the image the baked image
+        was provisioned from.
+
+        """
+        return (self.instance.tags.get('Base-Image') or
+                self.instance.image_id)
+
+    @property
+    def platform(self):
+        """(:class:`basestring`) The platform identifier of the instance
+        e.g. ``'ami-c641f2c7-x86_64'``.  Artifacts built on an instance
+        (e.g. wheels, APT packages) can be reused by other instances
+        of the same platform.
+
+        """
+        return '{0}-{1}'.format(self.base_image,
+                                self.instance.architecture or 'unknown')
+
     @property
     def status(self):
         """(:class:`basestring`) The current status of the instance
@@ -475,6 +501,15 @@ class Instance(LoggerProviderMixin):
     def status(self, status):
         status = str(status)
         self.tags['Status'] = status
+        tags = self.tags
+        EventLog(self.app).publish(
+            'status',
+            instance=self.id,
+            label=tags.get('Branch'),
+            commit=tags.get('Commit'),
+            live=tags.get('Live') == 'live',
+            status=status
+        )
 
 
 class Metadata(collections.MutableMapping):
@@ -507,12 +542,16 @@ class Metadata(collections.MutableMapping):
     def __setitem__(self, tag, value):
         if not isinstance(tag, basestring):
             raise TypeError('tag name must be a string, not ' + repr(tag))
-        self.instance().instance.add_tag(tag, value)
+        instance = self.instance()
+        instance.instance.add_tag(tag, value)
+        instance.app.inventory.update(instance.instance)
 
     def __delitem__(self, tag):
         if not isinstance(tag, basestring):
             raise TypeError('tag name must be a string, not ' + repr(tag))
-        self.instance().instance.remove_tag(tag)
+        instance = self.instance()
+        instance.instance.remove_tag(tag)
+        instance.app.inventory.update(instance.instance)
 
     def update(self, mapping=[], **kwargs):
         mapping = dict(mapping, **kwargs)
@@ -525,6 +564,7 @@ class Metadata(collections.MutableMapping):
             mapping
         )
         instance.instance.tags.update(mapping)
+        instance.app.inventory.update(instance.instance)
 
 
 class WaitTimeoutError(RuntimeError):
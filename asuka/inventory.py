@@ -0,0 +1,310 @@
+""":mod:`asuka.inventory` --- In-process instance inventory
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Every iteration of :class:`~asuka.app.InstanceSet` used to call
+:meth:`EC2Connection.get_all_instances()
+<boto.ec2.connection.EC2Connection.get_all_instances>`, so the home page
+and a build hit EC2 dozens of times for the same data.  :class:`Inventory`
+snapshots all instances of the app in a single call instead, and indexes
+them by :attr:`~Inventory.INDEXED_TAGS`, so that queries are answered
+from memory.
+
+The snapshot is refreshed when it gets older than :attr:`Inventory.ttl`
+seconds, or periodically by :meth:`Inventory.run_in_background()` so that
+web requests don't wait for EC2.  Our own mutations are reflected
+explicitly: tag changes through :class:`~asuka.instance.Metadata` reindex
+the instance, and terminated instances are :meth:`~Inventory.forget()`\ ed.
+Changes made by other processes or by hand are picked up by the next
+refresh.
+
+"""
+import operator
+import os
+import threading
+import time
+
+from boto.exception import EC2ResponseError
+
+from .logger import LoggerProviderMixin
+
+__all__ = 'Inventory', 'InventoryError'
+
+
+class Inventory(LoggerProviderMixin):
+    """The inventory of instances of the ``app``.  Use :meth:`from_app()`
+    or :attr:`App.inventory <asuka.app.App.inventory>` instead of
+    instantiating it directly, so that the snapshot is shared in
+    the process. ::
+
+        inventory = app.inventory
+        for instance in inventory.find({'Branch': 'master'}):
+            print instance.id
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+
+    """
+
+    #: (:class:`collections.Sequence`) The tags to index.  Queries on
+    #: other tags are filtered linearly.
+    INDEXED_TAGS = 'App', 'Branch', 'Commit', 'Live', 'Status'
+
+    #: (:class:`collections.Sequence`) The instance states to snapshot.
+    #: Terminated instances are left out.
+    STATES = 'pending', 'running', 'stopping', 'stopped'
+
+    #: (:class:`numbers.Real`) Seconds until the snapshot gets stale.
+    ttl = 30
+
+    #: (:class:`numbers.Real`) Seconds between refreshes by
+    #: :meth:`run_in_background()`.  It has to be shorter than :attr:`ttl`.
+    interval = 20
+
+    #: (:class:`collections.MutableMapping`) Inventories of each
+    #: (app name, process id) pair.
+    inventories = {}
+
+    #: (:class:`threading.Lock`) The lock for :attr:`inventories`.
+    inventories_lock = threading.Lock()
+
+    #: (:class:`numbers.Real`) The time the current snapshot was taken.
+    refreshed_at = None
+
+    #: (:class:`numbers.Real`) The last time :meth:`invalidate()` was
+    #: called.
+    invalidated_at = None
+
+    #: (:class:`threading.Thread`) The thread refreshing the snapshot
+    #: in the background.
+    thread = None
+
+    @classmethod
+    def from_app(cls, app):
+        """Gets the inventory of the ``app`` shared in the process.
+        Forked processes get their own inventories.
+
+        :param app: the application
+        :type app: :class:`~asuka.app.App`
+        :returns: the inventory
+        :rtype: :class:`Inventory`
+
+        """
+        key = app.name, os.getpid()
+        with cls.inventories_lock:
+            try:
+                return cls.inventories[key]
+            except KeyError:
+                inventory = cls(app)
+                cls.inventories[key] = inventory
+                return inventory
+
+    def __init__(self, app):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        self.app = app
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+        self.instances = {}
+        self.index = dict((tag, {}) for tag in self.INDEXED_TAGS)
+
+    @property
+    def fresh(self):
+        """(:class:`bool`) Whether the snapshot isn't stale."""
+        refreshed_at = self.refreshed_at
+        if refreshed_at is None:
+            return False
+        elif (self.invalidated_at is not None and
+              self.invalidated_at >= refreshed_at):
+            return False
+        return time.time() - refreshed_at < self.ttl
+
+    def refresh(self, tags=None):
+        """Takes a new snapshot.  If EC2 fails to respond, the current
+        snapshot is kept.
+
+        :param tags: refreshes only instances which have these tags
+                     if it's present.  otherwise the whole snapshot
+                     is refreshed
+        :type tags: :class:`collections.Mapping`
+        :returns: whether the snapshot is refreshed or not
+        :rtype: :class:`bool`
+
+        """
+        logger = self.get_logger('refresh')
+        started_at = time.time()
+        filters = dict(('tag:' + tag, value)
+                       for tag, value in (tags or {}).iteritems())
+        filters.update({
+            'tag:App': self.app.name,
+            'instance-state-name': list(self.STATES)
+        })
+        # boto's get_all_instances() doesn't paginate; a single
+        # DescribeInstances call returns all instances.
+        try:
+            reservations = self.app.ec2_connection.get_all_instances(
+                filters=filters
+            )
+        except EC2ResponseError as e:
+            logger.exception(e)
+            return False
+        instances = dict(
+            (instance.id, instance)
+            for reservation in reservations
+            for instance in reservation.instances
+        )
+        if tags:
+            with self.lock:
+                stale_ids = [
+                    instance.id
+                    for instance in self.instances.itervalues()
+                    if instance.id not in instances and
+                       all(instance.tags.get(tag) == value
+                           for tag, value in tags.iteritems())
+                ]
+                self.forget(stale_ids)
+                for instance in instances.itervalues():
+                    self.instances[instance.id] = instance
+                    self.update(instance)
+            logger.debug('%d instances of %r in %.2f seconds',
+                         len(instances), tags, time.time() - started_at)
+            return True
+        index = dict((tag, {}) for tag in self.INDEXED_TAGS)
+        for instance in instances.itervalues():
+            self._index(index, instance)
+        with self.lock:
+            self.instances = instances
+            self.index = index
+            self.refreshed_at = started_at
+        logger.debug('%d instances in %.2f seconds',
+                     len(instances), time.time() - started_at)
+        return True
+
+    def ensure_fresh(self):
+        """Refreshes the snapshot if it's stale.  Only one thread
+        refreshes at a time, and the others wait for it.
+
+        """
+        if self.fresh:
+            return
+        with self.refresh_lock:
+            if not self.fresh:
+                self.refresh()
+
+    def invalidate(self):
+        """Makes the snapshot stale, so that the next query refreshes it."""
+        self.invalidated_at = time.time()
+
+    @staticmethod
+    def _index(index, instance):
+        for tag, values in index.iteritems():
+            value = instance.tags.get(tag)
+            if value is not None:
+                values.setdefault(value, set()).add(instance.id)
+
+    def update(self, instance):
+        """Reindexes the ``instance`` after its tags were changed by us.
+        If it isn't in the snapshot (e.g. it's just launched),
+        the snapshot is invalidated instead.
+
+        :param instance: the changed instance
+        :type instance: :class:`boto.ec2.instance.Instance`
+
+        """
+        with self.lock:
+            if instance.id not in self.instances:
+                self.invalidate()
+                return
+            self.instances[instance.id] = instance
+            for values in self.index.itervalues():
+                for ids in values.itervalues():
+                    ids.discard(instance.id)
+            self._index(self.index, instance)
+
+    def forget(self, instance_ids):
+        """Removes terminated instances from the snapshot.
+
+        :param instance_ids: the ids of terminated instances
+        :type instance_ids: :class:`collections.Iterable`
+
+        """
+        with self.lock:
+            for instance_id in instance_ids:
+                self.instances.pop(instance_id, None)
+                for values in self.index.itervalues():
+                    for ids in values.itervalues():
+                        ids.discard(instance_id)
+
+    def find(self, tags={}, states=('running',)):
+        """Finds instances which have all ``tags``.
+
+        :param tags: tags to match
+        :type tags: :class:`collections.Mapping`
+        :param states: instance states to match.  default is only
+                       ``'running'``
+        :type states: :class:`collections.Container`
+        :returns: the list of :class:`boto.ec2.instance.Instance`\ s,
+                  the earliest launched first
+        :rtype: :class:`collections.Sequence`
+
+        """
+        self.ensure_fresh()
+        unindexed = []
+        with self.lock:
+            ids = None
+            for tag, value in tags.iteritems():
+                if tag not in self.index:
+                    unindexed.append((tag, value))
+                    continue
+                matched = self.index[tag].get(value, ())
+                ids = set(matched) if ids is None else ids.intersection(matched)
+            if ids is None:
+                candidates = self.instances.values()
+            else:
+                candidates = [self.instances[id_] for id_ in ids]
+        instances = [
+            instance
+            for instance in candidates
+            if instance.state in states and
+               all(instance.tags.get(tag) == value
+                   for tag, value in unindexed)
+        ]
+        instances.sort(key=operator.attrgetter('launch_time', 'id'))
+        return instances
+
+    def run(self):
+        """Refreshes the snapshot every :attr:`interval` seconds forever."""
+        logger = self.get_logger('run')
+        while True:
+            try:
+                with self.refresh_lock:
+                    self.refresh()
+            except Exception as e:
+                logger.exception(e)
+            time.sleep(self.interval)
+
+    def run_in_background(self):
+        """Runs :meth:`run()` in a daemon thread unless it's already
+        running.
+
+        :returns: the thread
+        :rtype: :class:`threading.Thread`
+
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run,
+                    name='inventory-' + self.app.name
+                )
+                self.thread.daemon = True
+                self.thread.start()
+            return self.thread
+
+
+class InventoryError(RuntimeError):
+    """Raised when the snapshot can't be refreshed while up-to-date
+    instances are required, e.g. to terminate them.
+
+    """
@@ -0,0 +1,693 @@
+""":mod:`asuka.jobqueue` --- Persistent prioritized job queue
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Jobs (deployments, promotions, cleanups) are stored in an SQLite
+database in :attr:`App.data_dir <asuka.app.App.data_dir>`, so that
+queued jobs survive restarts.  Jobs are admitted in order of their
+priority (promotions first, then the master branch, then other
+branches and pull requests), and only while :class:`CapacityPolicy`
+allows.
+
+Running jobs report their progress through each stage, and stop at
+the next stage boundary when they are cancelled or time out
+(see :meth:`JobQueue.listener()`).
+
+Jobs are leased to workers (see :mod:`asuka.worker`), which renew
+their leases by heartbeats.  Jobs of workers that stopped heartbeating
+are requeued by :meth:`JobQueue.expire()`, so that other workers retry
+them. ::
+
+    queue = app.job_queue
+    queue.enqueue('deploy', 'pull-123', commit_ref, [generation],
+                  timeout=3600)
+    policy = CapacityPolicy(app)
+    policy.prepare()
+    job = queue.admit(policy, worker='node-1', lease=120)
+    # in the worker process:
+    queue.start(job.id, os.getpid())
+    build.stage_listeners.append(queue.listener(job.id))
+    build.install()
+    queue.finish(job.id, worker='node-1')
+
+:class:`JobQueue` stores jobs in SQLite, whose locking isn't reliable
+on network filesystems, so it can be shared only by workers of a single
+host.  Workers of several nodes need another backend which implements
+the same interface, plugged by :attr:`App.job_queue_backend
+<asuka.app.App.job_queue_backend>`.
+
+"""
+import collections
+import contextlib
+import json
+import os.path
+import sqlite3
+import time
+
+from .coordinator import BuildCancelledError
+from .logger import LoggerProviderMixin
+
+__all__ = 'CapacityPolicy', 'Job', 'JobCancelledError', 'JobQueue'
+
+
+class Job(collections.namedtuple('Job', [
+    'id', 'kind', 'label', 'commit', 'arguments', 'priority', 'state',
+    'created_at', 'started_at', 'finished_at', 'timeout', 'pid',
+    'progress', 'cancelled_at', 'worker', 'lease_expires', 'attempts'
+])):
+    """A job in the :class:`JobQueue`.  Its :attr:`state` is one of
+    ``'queued'``, ``'running'``, ``'done'``, ``'failed'``, ``'lost'``,
+    ``'cancelled'``, ``'timed-out'`` and ``'superseded'``.
+
+    Its :attr:`progress` is a mapping of ``'running'`` and ``'done'``
+    lists of stage names.
+
+    """
+
+    @classmethod
+    def from_row(cls, row):
+        values = dict(zip(row.keys(), row))
+        values['arguments'] = json.loads(values['arguments'])
+        values['progress'] = json.loads(values['progress'] or
+                                        '{"running": [], "done": []}')
+        return cls(**values)
+
+    @property
+    def deadline(self):
+        """(:class:`numbers.Real`) The timestamp when the running job
+        times out, or ``None`` if it has no deadline.
+
+        """
+        if self.started_at is not None and self.timeout is not None:
+            return self.started_at + self.timeout
+
+    @property
+    def builds(self):
+        """(:class:`bool`) Whether the job builds an instance or not."""
+        return self.kind not in ('cleanup', 'hook')
+
+
+class JobQueue(LoggerProviderMixin):
+    """The persistent job queue.  It's safe to be used by several
+    threads and processes at a time.
+
+    :param path: the path of the SQLite database file
+    :type path: :class:`basestring`
+
+    """
+
+    @classmethod
+    def from_app(cls, app):
+        """Makes the job queue of the ``app``.  Every backend has to
+        implement this.
+
+        :param app: the application
+        :type app: :class:`~asuka.app.App`
+        :returns: the job queue
+        :rtype: :class:`JobQueue`
+
+        """
+        return cls(os.path.join(app.data_dir, cls.FILENAME))
+
+    #: (:class:`basestring`) The default filename of the database.
+    FILENAME = 'jobs.sqlite'
+
+    #: (:class:`numbers.Integral`) The priority of live promotions.
+    PRIORITY_PROMOTE = 0
+
+    #: (:class:`numbers.Integral`) The priority of the master branch.
+    PRIORITY_MASTER = 1
+
+    #: (:class:`numbers.Integral`) The priority of other branches
+    #: and pull requests.
+    PRIORITY_BRANCH = 2
+
+    #: (:class:`collections.Mapping`) The kinds of jobs that supersede
+    #: queued jobs of the same label.
+    SUPERSEDES = {
+        'deploy': ('deploy', 'redeploy'),
+        'redeploy': ('deploy', 'redeploy'),
+        'cleanup': ('deploy', 'redeploy'),
+        'promote': ('promote',)
+    }
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            label TEXT NOT NULL,
+            "commit" TEXT,
+            arguments TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            timeout REAL,
+            pid INTEGER,
+            progress TEXT,
+            cancelled_at REAL,
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state
+            ON jobs (state, priority, id);
+    '''
+
+    #: (:class:`collections.Sequence`) The pairs of column names and
+    #: definitions added after the first :attr:`SCHEMA`.  They are added
+    #: to existing databases.
+    MIGRATIONS = [
+        ('timeout', 'REAL'),
+        ('pid', 'INTEGER'),
+        ('progress', 'TEXT'),
+        ('cancelled_at', 'REAL'),
+        ('worker', 'TEXT'),
+        ('lease_expires', 'REAL'),
+        ('attempts', 'INTEGER NOT NULL DEFAULT 0')
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.executescript(self.SCHEMA)
+            columns = set(row[1] for row in
+                          db.execute('PRAGMA table_info(jobs)'))
+            for column, definition in self.MIGRATIONS:
+                if column not in columns:
+                    db.execute('ALTER TABLE jobs ADD COLUMN {0} {1}'.format(
+                        column, definition
+                    ))
+            db.commit()
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Connects to the database, and commits the transaction at
+        the end.  It yields :class:`sqlite3.Connection`.
+
+        """
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    @classmethod
+    def get_priority(cls, kind, label):
+        """Gets the priority of the job.  Lower is prior.
+
+        :param kind: the kind of the job e.g. ``'deploy'``
+        :type kind: :class:`basestring`
+        :param label: the branch label e.g. ``'pull-123'``
+        :type label: :class:`basestring`
+        :returns: the priority
+        :rtype: :class:`numbers.Integral`
+
+        """
+        if kind == 'promote':
+            return cls.PRIORITY_PROMOTE
+        elif label == 'branch-master':
+            return cls.PRIORITY_MASTER
+        return cls.PRIORITY_BRANCH
+
+    def enqueue(self, kind, label, commit, arguments=(), priority=None,
+                timeout=None):
+        """Enqueues a new job.  Queued jobs of the same ``label`` that
+        the ``kind`` :attr:`SUPERSEDES` are dropped.
+
+        :param kind: the kind of the job e.g. ``'deploy'``
+        :type kind: :class:`basestring`
+        :param label: the branch label e.g. ``'pull-123'``
+        :type label: :class:`basestring`
+        :param commit: the commit ref
+        :type commit: :class:`basestring`
+        :param arguments: the extra arguments of the job.  it has to be
+                          able to be serialized into JSON
+        :type arguments: :class:`collections.Sequence`
+        :param priority: the priority.  :meth:`get_priority()` by default
+        :type priority: :class:`numbers.Integral`
+        :param timeout: seconds the job can run.  no limit by default
+        :type timeout: :class:`numbers.Real`
+        :returns: the id of the new job
+        :rtype: :class:`numbers.Integral`
+
+        """
+        if priority is None:
+            priority = self.get_priority(kind, label)
+        superseded = self.SUPERSEDES.get(kind, ())
+        with self.connect() as db:
+            if superseded:
+                db.execute(
+                    'UPDATE jobs SET state = ?, finished_at = ? '
+                    'WHERE state = ? AND label = ? AND kind IN ({0})'.format(
+                        ', '.join('?' * len(superseded))
+                    ),
+                    ('superseded', time.time(), 'queued', label) +
+                    tuple(superseded)
+                )
+            cursor = db.execute(
+                'INSERT INTO jobs (kind, label, "commit", arguments, '
+                'priority, state, created_at, timeout) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, label, commit, json.dumps(list(arguments)), priority,
+                 'queued', time.time(), timeout)
+            )
+            job_id = cursor.lastrowid
+        self.get_logger('enqueue').info('#%d %s %s [%s] (priority: %d)',
+                                        job_id, kind, label, commit, priority)
+        return job_id
+
+    def admit(self, policy=None, worker=None, lease=None):
+        """Admits the most prior queued job which the ``policy`` allows,
+        and marks it as running.
+
+        :param policy: the function that takes a queued :class:`Job` and
+                       the list of running :class:`Job`\ s, and returns
+                       whether to admit it.  all jobs are admitted if
+                       it's omitted
+        :type policy: :class:`collections.Callable`
+        :param worker: the name of the worker to lease the job to
+        :type worker: :class:`basestring`
+        :param lease: seconds of the lease.  the job doesn't expire
+                      if it's omitted
+        :type lease: :class:`numbers.Real`
+        :returns: the admitted job, or ``None`` if nothing is admitted
+        :rtype: :class:`Job`
+
+        """
+        with self.connect() as db:
+            running = [Job.from_row(row) for row in db.execute(
+                'SELECT * FROM jobs WHERE state = ? ORDER BY id', ('running',)
+            )]
+            queued = db.execute(
+                'SELECT * FROM jobs WHERE state = ? ORDER BY priority, id',
+                ('queued',)
+            )
+            for row in queued.fetchall():
+                job = Job.from_row(row)
+                if policy is None or policy(job, running):
+                    started_at = time.time()
+                    lease_expires = lease and started_at + lease
+                    db.execute(
+                        'UPDATE jobs SET state = ?, started_at = ?, '
+                        'worker = ?, lease_expires = ?, '
+                        'attempts = attempts + 1 WHERE id = ?',
+                        ('running', started_at, worker, lease_expires, job.id)
+                    )
+                    return job._replace(state='running',
+                                        started_at=started_at,
+                                        worker=worker,
+                                        lease_expires=lease_expires,
+                                        attempts=job.attempts + 1)
+
+    def start(self, job_id, pid):
+        """Records the process which runs the job.
+
+        :param job_id: the id of the job
+        :type job_id: :class:`numbers.Integral`
+        :param pid: the process id of the worker
+        :type pid: :class:`numbers.Integral`
+
+        """
+        with self.connect() as db:
+            db.execute('UPDATE jobs SET pid = ? WHERE id = ?', (pid, job_id))
+
+    def finish(self, job_id, state='done', worker=None):
+        """Marks the running job as finished.  It does nothing if
+        the job has already finished.
+
+        :param job_id: the id of the job
+        :type job_id: :class:`numbers.Integral`
+        :param state: the final state.  default is ``'done'``
+        :type state: :class:`basestring`
+        :param worker: the name of the worker which ran the job.
+                       if it's given, the job isn't finished unless
+                       it's still leased to the ``worker``
+        :type worker: :class:`basestring`
+        :returns: whether the job was running or not
+        :rtype: :class:`bool`
+
+        """
+        query = ('UPDATE jobs SET state = ?, finished_at = ?, '
+                 'lease_expires = NULL WHERE id = ? AND state = ?')
+        params = (state, time.time(), job_id, 'running')
+        if worker is not None:
+            query += ' AND worker = ?'
+            params += (worker,)
+        with self.connect() as db:
+            cursor = db.execute(query, params)
+            finished = cursor.rowcount > 0
+        if finished:
+            self.get_logger('finish').info('#%d %s', job_id, state)
+        return finished
+
+    def cancel(self, job_id):
+        """Cancels the job.  A queued job is dropped immediately, and
+        a running job stops at the next stage boundary.
+
+        :param job_id: the id of the job
+        :type job_id: :class:`numbers.Integral`
+        :returns: whether the job was queued or running or not
+        :rtype: :class:`bool`
+
+        """
+        now = time.time()
+        with self.connect() as db:
+            cursor = db.execute(
+                'UPDATE jobs SET state = ?, cancelled_at = ?, '
+                'finished_at = ? WHERE id = ? AND state = ?',
+                ('cancelled', now, now, job_id, 'queued')
+            )
+            if not cursor.rowcount:
+                cursor = db.execute(
+                    'UPDATE jobs SET cancelled_at = ? '
+                    'WHERE id = ? AND state = ? AND cancelled_at IS NULL',
+                    (now, job_id, 'running')
+                )
+            cancelled = cursor.rowcount > 0
+        if cancelled:
+            self.get_logger('cancel').info('#%d cancelled', job_id)
+        return cancelled
+
+    def report(self, job_id, event, stage):
+        """Records the progress of the running job.
+
+        :param job_id: the id of the job
+        :type job_id: :class:`numbers.Integral`
+        :param event: the stage event (``'start'``, ``'done'`` or
+                      ``'error'``)
+        :type event: :class:`basestring`
+        :param stage: the name of the stage
+        :type stage: :class:`basestring`
+
+        """
+        with self.connect() as db:
+            row = db.execute('SELECT progress FROM jobs WHERE id = ?',
+                             (job_id,)).fetchone()
+            if row is None:
+                return
+            progress = json.loads(row[0] or '{"running": [], "done": []}')
+            if event == 'start':
+                progress['running'].append(stage)
+            else:
+                if stage in progress['running']:
+                    progress['running'].remove(stage)
+                if event == 'done':
+                    progress['done'].append(stage)
+            db.execute('UPDATE jobs SET progress = ? WHERE id = ?',
+                       (json.dumps(progress), job_id))
+
+    def check(self, job_id):
+        """Raises :exc:`JobCancelledError` if the job was cancelled or
+        has timed out.
+
+        :param job_id: the id of the job
+        :type job_id: :class:`numbers.Integral`
+        :raises JobCancelledError: if the job has to stop
+
+        """
+        job = self.get(job_id)
+        if job is None:
+            return
+        elif job.cancelled_at is not None:
+            raise JobCancelledError(job, 'cancelled')
+        elif job.deadline is not None and time.time() > job.deadline:
+            raise JobCancelledError(job, 'timed-out')
+
+    def listener(self, job_id):
+        """Makes the listener for :attr:`StageGraph.listeners
+        <asuka.stage.StageGraph.listeners>` which reports the progress
+        of the job, and stops it before the next stage starts if it
+        was cancelled or has timed out.
+
+        :param job_id: the id of the job
+        :type job_id: :class:`numbers.Integral`
+        :returns: the listener function
+        :rtype: :class:`collections.Callable`
+
+        """
+        def listen(event, stage):
+            if event == 'start':
+                self.check(job_id)
+            self.report(job_id, event, stage.name)
+        return listen
+
+    def heartbeat(self, worker, lease):
+        """Renews leases of jobs running on the ``worker``.
+
+        :param worker: the name of the worker
+        :type worker: :class:`basestring`
+        :param lease: seconds of the renewed lease
+        :type lease: :class:`numbers.Real`
+        :returns: the number of renewed jobs
+        :rtype: :class:`numbers.Integral`
+
+        """
+        with self.connect() as db:
+            cursor = db.execute(
+                'UPDATE jobs SET lease_expires = ? '
+                'WHERE state = ? AND worker = ?',
+                (time.time() + lease, 'running', worker)
+            )
+            return cursor.rowcount
+
+    def _requeue(self, db, where, params, max_attempts):
+        now = time.time()
+        db.execute(
+            'UPDATE jobs SET state = ?, finished_at = ? '
+            'WHERE state = ? AND cancelled_at IS NOT NULL AND ' + where,
+            ('cancelled', now, 'running') + params
+        )
+        if max_attempts is not None:
+            db.execute(
+                'UPDATE jobs SET state = ?, finished_at = ? '
+                'WHERE state = ? AND attempts >= ? AND ' + where,
+                ('lost', now, 'running', max_attempts) + params
+            )
+        cursor = db.execute(
+            'UPDATE jobs SET state = ?, started_at = NULL, pid = NULL, '
+            'progress = NULL, worker = NULL, lease_expires = NULL '
+            'WHERE state = ? AND ' + where,
+            ('queued', 'running') + params
+        )
+        return cursor.rowcount
+
+    def expire(self, max_attempts=None):
+        """Requeues running jobs whose leases have expired, so that
+        other workers retry them.  Jobs that were cancelled or have
+        been tried ``max_attempts`` times are finished instead.
+
+        :param max_attempts: the maximum number of attempts of a job.
+                             no limit by default
+        :type max_attempts: :class:`numbers.Integral`
+        :returns: the number of requeued jobs
+        :rtype: :class:`numbers.Integral`
+
+        """
+        with self.connect() as db:
+            count = self._requeue(db, 'lease_expires < ?', (time.time(),),
+                                  max_attempts)
+        if count:
+            self.get_logger('expire').info('requeued %d jobs', count)
+        return count
+
+    def recover(self, worker=None):
+        """Requeues jobs that were running when the worker died,
+        except for cancelled ones.  It has to be called before
+        the ``worker`` admits any job.
+
+        :param worker: the name of the worker.  jobs of all workers
+                       are requeued if it's omitted
+        :type worker: :class:`basestring`
+        :returns: the number of requeued jobs
+        :rtype: :class:`numbers.Integral`
+
+        """
+        if worker is None:
+            where, params = '1', ()
+        else:
+            where, params = 'worker = ?', (worker,)
+        with self.connect() as db:
+            count = self._requeue(db, where, params, None)
+        if count:
+            self.get_logger('recover').info('requeued %d jobs', count)
+        return count
+
+    def get(self, job_id):
+        """Gets the job.
+
+        :param job_id: the id of the job
+        :type job_id: :class:`numbers.Integral`
+        :returns: the job, or ``None`` if there's no such job
+        :rtype: :class:`Job`
+
+        """
+        with self.connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?',
+                             (job_id,)).fetchone()
+        return row and Job.from_row(row)
+
+    def list(self, states=('queued', 'running'), limit=100):
+        """Lists jobs of ``states``.  Queued jobs are ordered by their
+        position in the queue.
+
+        :param states: the states of jobs to list
+        :type states: :class:`collections.Sequence`
+        :param limit: the maximum number of jobs.  default is 100
+        :type limit: :class:`numbers.Integral`
+        :returns: the list of jobs
+        :rtype: :class:`collections.Sequence`
+
+        """
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT * FROM jobs WHERE state IN ({0}) '
+                'ORDER BY state = ?, priority, id LIMIT ?'.format(
+                    ', '.join('?' * len(states))
+                ),
+                tuple(states) + ('queued', limit)
+            ).fetchall()
+        return [Job.from_row(row) for row in rows]
+
+    def recent(self, limit=20):
+        """Lists finished jobs, the most recently finished first.
+
+        :param limit: the maximum number of jobs.  default is 20
+        :type limit: :class:`numbers.Integral`
+        :returns: the list of jobs
+        :rtype: :class:`collections.Sequence`
+
+        """
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT * FROM jobs WHERE state NOT IN (?, ?) '
+                'ORDER BY finished_at DESC LIMIT ?',
+                ('queued', 'running', limit)
+            ).fetchall()
+        return [Job.from_row(row) for row in rows]
+
+
+class JobCancelledError(BuildCancelledError):
+    """An error raised when the job was cancelled or has timed out.
+
+    :param job: the stopped job
+    :type job: :class:`Job`
+    :param reason: ``'cancelled'`` or ``'timed-out'``
+    :type reason: :class:`basestring`
+
+    """
+
+    def __init__(self, job, reason):
+        message = 'the job #{0} of {1} was {2}'.format(
+            job.id, job.label, reason.replace('-', ' ')
+        )
+        super(JobCancelledError, self).__init__(job.label, None, message)
+        self.job = job
+        self.reason = reason
+
+
+class CapacityPolicy(LoggerProviderMixin):
+    """The admission policy which respects
+    :attr:`App.max_concurrent_builds <asuka.app.App.max_concurrent_builds>`
+    and :attr:`App.max_instances <asuka.app.App.max_instances>`.
+    Jobs that don't build (cleanups and web hooks) are always admitted
+    since they don't take capacity.
+
+    Idle instances of the :class:`~asuka.warmpool.WarmPool` aren't
+    counted, since builds consume them.  A running build is counted
+    only until its instance is tagged, and a deployment which is likely
+    to redeploy into the existing instance of its branch in place
+    doesn't need an extra instance.
+
+    Listing instances can take an EC2 API call, so call :meth:`prepare()`
+    before :meth:`JobQueue.admit()` to keep it out of the transaction
+    of admission.
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+
+    """
+
+    #: (:class:`numbers.Real`) Seconds to reuse the instances taken by
+    #: :meth:`prepare()`.
+    instances_ttl = 10
+
+    def __init__(self, app):
+        self.app = app
+        self._instances = None, 0
+
+    def prepare(self):
+        """Takes the list of :attr:`instances` to count."""
+        inventory = self.app.inventory
+        instances = [
+            instance
+            for instance in inventory.find({}, states=('pending', 'running'))
+            if 'Warm-Pool' not in instance.tags
+        ]
+        self._instances = instances, time.time()
+
+    @property
+    def instances(self):
+        """(:class:`collections.Sequence`) The :class:`Instance
+        <boto.ec2.instance.Instance>`\ s of the app except for idle
+        instances of the warm pool.
+
+        """
+        instances, taken_at = self._instances
+        if instances is None or time.time() - taken_at > self.instances_ttl:
+            self.prepare()
+            instances, _ = self._instances
+        return instances
+
+    @staticmethod
+    def has_instance(instances, job):
+        """Whether the ``job`` already has its instance tagged."""
+        return any(instance.tags.get('Branch') == job.label and
+                   instance.tags.get('Commit') == job.commit
+                   for instance in instances)
+
+    @staticmethod
+    def redeploys_in_place(instances, job):
+        """Whether the ``job`` is likely to redeploy into the healthy
+        instance of its branch in place.
+
+        """
+        return job.kind == 'deploy' and any(
+            instance.tags.get('Branch') == job.label and
+            instance.tags.get('Status') == 'done' and
+            not instance.tags.get('Live')
+            for instance in instances
+        )
+
+    def __call__(self, job, running):
+        if not job.builds:
+            return True
+        builds = [j for j in running if j.builds]
+        max_builds = self.app.max_concurrent_builds
+        if max_builds is not None and len(builds) >= max_builds:
+            return False
+        max_instances = self.app.max_instances
+        if max_instances is not None:
+            # A build needs an extra instance until it terminates
+            # the instance it replaces.
+            instances = self.instances
+            launching = sum(1 for j in builds
+                            if not self.has_instance(instances, j))
+            needed = 0 if self.redeploys_in_place(instances, job) else 1
+            if len(instances) + launching + needed > max_instances:
+                self.get_logger('__call__').info(
+                    '#%d waits for capacity: %d instances, %d launching',
+                    job.id, len(instances), launching
+                )
+                return False
+        return True
@@ -0,0 +1,236 @@
+""":mod:`asuka.manifest` --- Service manifests
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Service manifests are :file:`*.yml` files in the Asuka configuration
+directory (:attr:`App.config_dir <asuka.app.App.config_dir>`) of
+the repository.  :class:`ManifestLoader` reads only these files of
+the commit without checking out the whole tree, and caches the parsed
+result per commit.
+
+"""
+import copy
+import logging
+import os.path
+import pipes
+import re
+import threading
+
+from yaml import load
+
+from .branch import Branch
+from .commit import Commit
+from .graph import DependencyGraph
+from .logger import LoggerProviderMixin
+
+__all__ = 'ManifestLoader', 'manifest_graph', 'sort_manifests'
+
+
+def manifest_graph(manifests):
+    """Makes the dependency graph of service manifests from their
+    ``depends`` lists.  Dependencies on services that aren't enabled
+    are ignored.
+
+    :param manifests: the mapping of service names to manifest dicts,
+                      or the sequence of (name, manifest dict) pairs
+    :type manifests: :class:`collections.Mapping`,
+                     :class:`collections.Sequence`
+    :returns: the dependency graph of service names
+    :rtype: :class:`~asuka.graph.DependencyGraph`
+    :raises asuka.graph.CyclicDependencyError: if dependencies make
+                                               a cycle
+
+    """
+    logger = logging.getLogger(__name__ + '.manifest_graph')
+    manifests = dict(manifests)
+    dependencies = {}
+    for name, service_dict in manifests.iteritems():
+        depends = service_dict.get('depends') or ()
+        if isinstance(depends, basestring):
+            depends = [depends]
+        dependencies[name] = set()
+        for dep in depends:
+            if dep in manifests:
+                dependencies[name].add(dep)
+            else:
+                logger.warn('%s depends on %s which is not enabled; ignored',
+                            name, dep)
+    return DependencyGraph(dependencies)
+
+
+def sort_manifests(manifests):
+    """Sorts service manifests in topological order of their
+    ``depends`` lists.
+
+    :param manifests: the mapping of service names to manifest dicts
+    :type manifests: :class:`collections.Mapping`
+    :returns: the list of (name, manifest dict) pairs
+    :rtype: :class:`collections.Sequence`
+    :raises asuka.graph.CyclicDependencyError: if dependencies make
+                                               a cycle
+
+    """
+    return [(name, manifests[name])
+            for name in manifest_graph(manifests).order]
+
+
+class ManifestLoader(LoggerProviderMixin):
+    """Loads enabled service manifests of the commit.  If the commit
+    object is available in the local clone the branch has fetched, it
+    reads manifest blobs using :program:`git` there, or it reads them
+    through GitHub contents API otherwise. ::
+
+        loader = ManifestLoader(branch, commit)
+        for name, manifest in loader.load():
+            print name, manifest['type']
+
+    :param branch: the branch of the commit
+    :type branch: :class:`~asuka.branch.Branch`
+    :param commit: the commit to read manifests
+    :type commit: :class:`~asuka.commit.Commit`
+
+    """
+
+    #: (:class:`re.RegexObject`) The pattern of service manifest
+    #: filenames.
+    FILENAME_PATTERN = re.compile(r'^(?P<name>[a-z0-9_]{2,50})\.yml$')
+
+    #: (:class:`collections.MutableMapping`) The cache of loaded
+    #: manifests.  Keys are pairs of (app name, commit ref).
+    cache = {}
+
+    #: (:class:`threading.Lock`) The lock for :attr:`cache`.
+    cache_lock = threading.Lock()
+
+    def __init__(self, branch, commit):
+        if not isinstance(branch, Branch):
+            raise TypeError('branch must be an instance of asuka.branch.'
+                            'Branch, not ' + repr(branch))
+        elif not isinstance(commit, Commit):
+            raise TypeError('commit must be an instance of asuka.commit.'
+                            'Commit, not ' + repr(commit))
+        self.app = branch.app
+        self.branch = branch
+        self.commit = commit
+
+    @property
+    def config_dir(self):
+        """(:class:`basestring`) The path of the configuration directory
+        relative to the root of the repository, without trailing slash.
+
+        """
+        return self.app.config_dir.strip('/')
+
+    def load(self):
+        """Loads enabled service manifests in topological order.
+
+        :returns: the list of (service name, manifest dict) pairs.
+                  manifest dicts are copies, so they can be modified
+        :rtype: :class:`collections.Sequence`
+
+        """
+        key = self.app.name, self.commit.ref
+        with self.cache_lock:
+            manifests = self.cache.get(key)
+        if manifests is None:
+            manifests = sort_manifests(self.parse(self.read()))
+            with self.cache_lock:
+                self.cache[key] = manifests
+            self.get_logger('load').info('%s: %r', self.commit.ref,
+                                         [name for name, _ in manifests])
+        return copy.deepcopy(manifests)
+
+    def parse(self, files):
+        """Parses the manifest ``files``, and filters enabled ones.
+
+        :param files: the mapping of filenames to their contents
+        :type files: :class:`collections.Mapping`
+        :returns: the mapping of service names to manifest dicts
+        :rtype: :class:`collections.Mapping`
+
+        """
+        manifests = {}
+        for fname, content in files.iteritems():
+            match = self.FILENAME_PATTERN.search(fname)
+            if not match:
+                continue
+            try:
+                service_dict = load(content)
+                if not service_dict.pop('enabled', False):
+                    continue
+                manifests[match.group('name')] = service_dict
+            except Exception as e:
+                raise type(e)(fname + ': ' + str(e))
+        return manifests
+
+    def read(self):
+        """Reads manifest files of the commit.
+
+        :returns: the mapping of filenames to their contents
+        :rtype: :class:`collections.Mapping`
+
+        """
+        for path in self.branch.fetched_paths.values():
+            files = self.read_git(path)
+            if files is not None:
+                return files
+        return self.read_github()
+
+    def read_git(self, path):
+        """Reads manifest files from the local clone of the ``path``.
+
+        :param path: the path of the local clone
+        :type path: :class:`basestring`
+        :returns: the mapping of filenames to their contents,
+                  or ``None`` if the commit isn't available there
+        :rtype: :class:`collections.Mapping`
+
+        """
+        logger = self.get_logger('read_git')
+        def git(command, *args):
+            cmd = 'git --git-dir={0} {1} 2>/dev/null'.format(
+                pipes.quote(os.path.join(path, '.git')),
+                command.format(*map(pipes.quote, args))
+            )
+            logger.debug('%s', cmd)
+            f = os.popen(cmd)
+            output = f.read()
+            if f.close():
+                return
+            return output
+        treeish = '{0}:{1}'.format(self.commit.ref, self.config_dir)
+        if git('cat-file -e {0}', self.commit.ref) is None:
+            return
+        names = git('ls-tree --name-only {0}', treeish)
+        if names is None:
+            return {}
+        files = {}
+        for name in names.splitlines():
+            if self.FILENAME_PATTERN.search(name):
+                files[name] = git('show {0}', treeish + '/' + name)
+        return files
+
+    def read_github(self):
+        """Reads manifest files through GitHub contents API.
+
+        :returns: the mapping of filenames to their contents
+        :rtype: :class:`collections.Mapping`
+
+        """
+        logger = self.get_logger('read_github')
+        repo = self.branch.repository
+        url = repo._build_url('contents', self.config_dir,
+                              base_url=repo._api)
+        response = repo._get(url, params={'ref': self.commit.ref})
+        logger.debug('%s: %r', response.url, response.status_code)
+        if response.status_code == 404:
+            return {}
+        response.raise_for_status()
+        files = {}
+        for entry in response.json():
+            if entry['type'] != 'file':
+                continue
+            elif not self.FILENAME_PATTERN.search(entry['name']):
+                continue
+            contents = repo.contents(entry['path'], ref=self.commit.ref)
+            files[entry['name']] = contents.decoded
+        return files
@@ -0,0 +1,251 @@
+""":mod:`asuka.notify` --- Hook notifications
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Payloads of builds are posted to :attr:`App.start_hook_urls
+<asuka.app.App.start_hook_urls>` and :attr:`App.finish_hook_urls
+<asuka.app.App.finish_hook_urls>`.  :class:`Notifier` writes each
+notification to an outbox in :attr:`App.data_dir
+<asuka.app.App.data_dir>` first, and then delivers them concurrently
+from a bounded pool of threads, so that slow or hung endpoints never
+block builds.  Failed deliveries are retried with exponential backoff
+by :meth:`Notifier.flush()`, which :class:`~asuka.worker.Worker`\ s
+call periodically, so notifications survive restarts as well.
+
+"""
+import errno
+import fcntl
+import json
+import os
+import os.path
+import Queue
+import threading
+import time
+import uuid
+
+from requests import session
+
+from .logger import LoggerProviderMixin
+
+__all__ = 'Notifier',
+
+
+class Notifier(LoggerProviderMixin):
+    """The notifier of the ``app``. ::
+
+        notifier = Notifier(app)
+        notifier.notify(app.start_hook_urls, payload)
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+
+    """
+
+    #: (:class:`basestring`) The name of the outbox directory
+    #: in :attr:`App.data_dir <asuka.app.App.data_dir>`.
+    DIRNAME = '.outbox'
+
+    #: (:class:`numbers.Integral`) The number of threads delivering
+    #: notifications in a process.
+    concurrency = 4
+
+    #: (:class:`numbers.Real`) Seconds to wait for the response.
+    timeout = 10
+
+    #: (:class:`numbers.Integral`) The maximum number of attempts.
+    #: Notifications which failed this many times are left in the outbox
+    #: with the ``.failed`` suffix.
+    max_attempts = 6
+
+    #: (:class:`numbers.Real`) Seconds to wait before the first retry.
+    #: It doubles on each retry.
+    backoff = 30
+
+    #: (:class:`Queue.Queue`) Paths of notifications to deliver in
+    #: the process.
+    tasks = None
+
+    #: (:class:`numbers.Integral`) The id of the process which started
+    #: threads for :attr:`tasks`.
+    tasks_pid = None
+
+    #: (:class:`threading.Lock`) The lock for :attr:`tasks`.
+    tasks_lock = threading.Lock()
+
+    def __init__(self, app):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        self.app = app
+
+    @property
+    def path(self):
+        """(:class:`basestring`) The path of the outbox directory."""
+        path = os.path.join(self.app.data_dir, self.DIRNAME)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return path
+
+    def notify(self, urls, payload):
+        """Posts the ``payload`` to the ``urls`` in the background.
+
+        :param urls: the urls to post
+        :type urls: :class:`collections.Iterable`
+        :param payload: the payload to be serialized into JSON
+        :type payload: :class:`collections.Mapping`
+        :returns: the list of paths of notifications in the outbox
+        :rtype: :class:`collections.Sequence`
+
+        """
+        data = json.dumps(payload)
+        paths = [self.put(url, data) for url in urls]
+        for path in paths:
+            self.submit(path)
+        return paths
+
+    def put(self, url, data):
+        """Writes a notification to the outbox.
+
+        :param url: the url to post
+        :type url: :class:`basestring`
+        :param data: the JSON payload
+        :type data: :class:`str`
+        :returns: the path of the notification
+        :rtype: :class:`basestring`
+
+        """
+        now = time.time()
+        filename = '{0:.6f}-{1}.json'.format(now, uuid.uuid4().hex)
+        path = os.path.join(self.path, filename)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'url': url,
+                'data': data,
+                'attempts': 0,
+                'created_at': now,
+                'next_attempt_at': now
+            }, f)
+        os.rename(tmp_path, path)
+        return path
+
+    def submit(self, path):
+        """Delivers the notification in one of threads of the process.
+
+        :param path: the path of the notification
+        :type path: :class:`basestring`
+
+        """
+        cls = type(self)
+        with cls.tasks_lock:
+            if cls.tasks_pid != os.getpid():
+                # Threads aren't inherited by forked processes.
+                cls.tasks = Queue.Queue()
+                cls.tasks_pid = os.getpid()
+                for i in xrange(self.concurrency):
+                    thread = threading.Thread(target=cls.work,
+                                              args=(cls.tasks,),
+                                              name='notifier-{0}'.format(i))
+                    thread.daemon = True
+                    thread.start()
+            cls.tasks.put((self, path))
+
+    @staticmethod
+    def work(tasks):
+        while True:
+            notifier, path = tasks.get()
+            try:
+                notifier.deliver(path)
+            except Exception as e:
+                notifier.get_logger('work').exception(e)
+
+    def deliver(self, path):
+        """Delivers the notification unless another thread or process
+        is delivering it, or it isn't due yet.
+
+        :param path: the path of the notification
+        :type path: :class:`basestring`
+        :returns: whether it's delivered or not
+        :rtype: :class:`bool`
+
+        """
+        logger = self.get_logger('deliver')
+        try:
+            f = open(path, 'r+')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            if not os.path.isfile(path):
+                return False
+            notification = json.load(f)
+            if notification['next_attempt_at'] > time.time():
+                return False
+            url = notification['url']
+            try:
+                with session() as client:
+                    response = client.post(
+                        url,
+                        headers={'Content-Type': 'application/json'},
+                        data=notification['data'],
+                        timeout=self.timeout
+                    )
+                status = response.status_code
+            except Exception as e:
+                logger.warn('failed to post to %s: %s', url, e)
+                status = None
+            if status is not None and status < 400:
+                os.unlink(path)
+                logger.info('posted to %s (%d)', url, status)
+                return True
+            elif status is not None and status < 500 and \
+                 status not in (408, 429):
+                os.rename(path, path + '.failed')
+                logger.error('%s rejected the notification (%d)', url, status)
+                return False
+            attempts = notification['attempts'] + 1
+            if attempts >= self.max_attempts:
+                os.rename(path, path + '.failed')
+                logger.error('gave up posting to %s after %d attempts',
+                             url, attempts)
+                return False
+            delay = self.backoff * 2 ** (attempts - 1)
+            notification.update(attempts=attempts,
+                                next_attempt_at=time.time() + delay)
+            f.seek(0)
+            f.truncate()
+            json.dump(notification, f)
+            logger.info('retry posting to %s in %d seconds', url, delay)
+            return False
+
+    def flush(self):
+        """Submits notifications in the outbox which are due.
+
+        :returns: the number of submitted notifications
+        :rtype: :class:`numbers.Integral`
+
+        """
+        now = time.time()
+        count = 0
+        for filename in sorted(os.listdir(self.path)):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.path, filename)
+            try:
+                with open(path) as f:
+                    notification = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if notification['next_attempt_at'] <= now:
+                self.submit(path)
+                count += 1
+        return count
@@ -2,6 +2,7 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 """
+import pipes
 import re
 
 from .build import BaseBuild
@@ -61,6 +62,12 @@ class Service(LoggerProviderMixin):
     #: (:class:`collections.Mapping`) The configuration dictionary.
     config = None
 
+    #: (:class:`bool`) Whether the service depends on each commit
+    #: even if its configuration doesn't change.  Such services are
+    #: always reinstalled when the build redeploys into the existing
+    #: instance in place.
+    commit_specific = False
+
     def __init__(self, build, name, config={},
                  required_apt_repositories=frozenset(),
                  required_apt_packages=frozenset(),
@@ -151,6 +158,41 @@ class Service(LoggerProviderMixin):
                 '/var/run/{0}'.format(*F)
             ])
 
+    def reload(self, instance):
+        """Gracefully reloads the installed service so that it runs
+        the newly installed package.  It's called instead of
+        :meth:`install()` when the build redeploys into the existing
+        ``instance`` and the service configuration doesn't change.
+        The default implementation does nothing.
+
+        :param instance: the instance the service is installed
+        :type instance: :class:`asuka.instance.Instance`
+
+        """
+
+    @property
+    def job_name(self):
+        """(:class:`basestring`) The name of the upstart job of
+        the service e.g. ``'myapp-web'``.
+
+        """
+        return self.app.name + '-' + self.name
+
+    def start_job(self, instance):
+        """Starts the upstart job of the service.  If it's already
+        running, it's stopped first so that the changed job
+        configuration takes effect.
+
+        :param instance: the instance the service is installed
+        :type instance: :class:`asuka.instance.Instance`
+
+        """
+        job_name = pipes.quote(self.job_name)
+        instance.sudo([
+            'sh', '-c',
+            'stop {0} >/dev/null 2>&1; start {0}'.format(job_name)
+        ])
+
     def uninstall(self):
         """Uninstalls the service."""
 
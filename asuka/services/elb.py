@@ -7,6 +7,8 @@
 .. _Elastic Load Balancing: http://aws.amazon.com/elasticloadbalancing/
 
 """
+import time
+
 from boto.ec2.elb import ELBConnection, HealthCheck, regions
 from boto.exception import BotoServerError
 from werkzeug.utils import cached_property
@@ -19,6 +21,10 @@ __all__ = 'ELBService',
 class ELBService(DomainService):
     """Elastic Load Balancing."""
 
+    #: (:class:`numbers.Real`) Seconds to wait for a new instance to be
+    #: registered before old instances are deregistered.
+    registration_timeout = 300
+
     def __init__(self, *args, **kwargs):
         super(ELBService, self).__init__(*args, **kwargs)
 
@@ -128,12 +134,40 @@ end script
 '''.format(**format_args),
             sudo=True
         )
-        instances = [i.id for i in self.load_balancer.instances]
-        instance.sudo([
-            'service', instance.app.name + '-' + self.name, 'start'
-        ])
-        if instances:
+        # The instance is already registered if it's redeployed in place.
+        instances = [i.id for i in self.load_balancer.instances
+                     if i.id != instance.id]
+        self.start_job(instance)
+        if not instances:
+            return
+        elif self.wait_registration(instance):
             self.load_balancer.deregister_instances(instances)
+        else:
+            self.get_logger('install').warn(
+                '%r is not registered to %s in %d seconds; old instances '
+                'are left registered', instance, self.load_balancer_name,
+                self.registration_timeout
+            )
+
+    def wait_registration(self, instance):
+        """Waits until the ``instance`` is registered to the load balancer.
+
+        :param instance: the instance to wait
+        :type instance: :class:`~asuka.instance.Instance`
+        :returns: ``False`` if it's not registered in
+                  :attr:`registration_timeout` seconds
+        :rtype: :class:`bool`
+
+        """
+        deadline = time.time() + self.registration_timeout
+        conn = self.elb_connection
+        while True:
+            balancer, = conn.get_all_load_balancers([self.load_balancer_name])
+            if any(i.id == instance.id for i in balancer.instances):
+                return True
+            elif time.time() > deadline:
+                return False
+            time.sleep(5)
 
     @property
     def dns_name(self):
@@ -22,6 +22,9 @@ __all__ = 'StaticS3Service',
 
 class StaticS3Service(Service):
 
+    #: Static files are uploaded under the prefix of each commit.
+    commit_specific = True
+
     @cached_property
     def s3_connection(self):
         """(:class:`boto.s3.conection.S3Connection`) The S3 connection."""
@@ -60,6 +60,12 @@ end script
 '''.format(**format_args),
             sudo=True
         )
-        instance.sudo([
-            'service', instance.app.name + '-' + self.name, 'start'
-        ])
+        self.start_job(instance)
+
+    def reload(self, instance):
+        """Restarts the Celery worker.  Running tasks are finished first
+        since :program:`celery worker` shuts down warmly on
+        :const:`SIGTERM`.
+
+        """
+        instance.sudo(['restart', self.job_name])
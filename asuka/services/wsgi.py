@@ -231,9 +231,18 @@ end script
 '''.format(gunicorn_options=gunicorn_options, **format_args),
             sudo=True
         )
-        instance.sudo([
-            'service', instance.app.name + '-' + self.name, 'start'
-        ])
+        self.start_job(instance)
+
+    def reload(self, instance):
+        """Gracefully reloads workers by sending :const:`SIGHUP` to
+        the Gunicorn master process.  If the app is preloaded in
+        the master process, it's restarted instead.
+
+        """
+        if self.config.get('server_options', {}).get('preload'):
+            instance.sudo(['restart', self.job_name])
+        else:
+            instance.sudo(['reload', self.job_name])
 
 
 class Worker(object):
@@ -0,0 +1,245 @@
+""":mod:`asuka.stage` --- Stage graph scheduler
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+A build consists of stages.  Each stage declares values it requires
+and values it provides, and :class:`StageGraph` runs every stage as soon
+as all of its inputs are ready, so that independent stages overlap::
+
+    stages = StageGraph()
+    stages.add('fetch', fetch, provides=['path'])
+    stages.add('bundle', bundle, requires=['path'], provides=['bundle'])
+    stages.add('provision', provision)
+    stages.add('install', install, requires=['bundle'], after=['provision'])
+    values = stages.run()
+
+In the above example, ``provision`` runs concurrently with ``fetch``
+and ``bundle``.
+
+"""
+import collections
+import sys
+import threading
+
+from .graph import DependencyGraph
+from .logger import LoggerProviderMixin
+
+__all__ = 'Stage', 'StageGraph'
+
+
+class Stage(object):
+    """A stage of the :class:`StageGraph`.
+
+    :param name: the unique name of the stage
+    :type name: :class:`basestring`
+    :param function: the function to run.  it takes required values
+                     as keyword arguments
+    :type function: :class:`collections.Callable`
+    :param requires: the names of values the stage requires
+    :type requires: :class:`collections.Iterable`
+    :param provides: the names of values the stage provides.  if it's
+                     only one the return value of the ``function``
+                     becomes the value, or the ``function`` has to
+                     return a sequence of the same length
+    :type provides: :class:`collections.Iterable`
+    :param after: the names of stages that have to be done before
+                  the stage even if it doesn't require their values
+    :type after: :class:`collections.Iterable`
+
+    """
+
+    def __init__(self, name, function, requires=(), provides=(), after=()):
+        if not isinstance(name, basestring):
+            raise TypeError('name must be a string, not ' + repr(name))
+        elif not callable(function):
+            raise TypeError('function must be callable, not ' +
+                            repr(function))
+        self.name = name
+        self.function = function
+        self.requires = frozenset(requires)
+        self.provides = tuple(provides)
+        self.after = frozenset(after)
+
+    def __call__(self, values):
+        """Runs the stage.
+
+        :param values: the mapping of values which contains all values
+                       the stage requires
+        :type values: :class:`collections.Mapping`
+        :returns: the mapping of provided values
+        :rtype: :class:`collections.Mapping`
+
+        """
+        result = self.function(**dict((name, values[name])
+                                      for name in self.requires))
+        if not self.provides:
+            return {}
+        elif len(self.provides) == 1:
+            return {self.provides[0]: result}
+        result = tuple(result)
+        if len(result) != len(self.provides):
+            raise ValueError('{0!r} has to provide {1} values, but it '
+                             'returned {2}'.format(self, len(self.provides),
+                                                   len(result)))
+        return dict(zip(self.provides, result))
+
+    def __repr__(self):
+        c = type(self)
+        return '<{0}.{1} {2!r}>'.format(c.__module__, c.__name__, self.name)
+
+
+class StageGraph(LoggerProviderMixin):
+    """The graph of :class:`Stage`\ s.
+
+    :param stages: the initial stages
+    :type stages: :class:`collections.Iterable`
+
+    """
+
+    #: (:class:`collections.MutableSequence`) The list of listener
+    #: functions.  They are called with two arguments, the event
+    #: (``'start'``, ``'done'`` or ``'error'``) and the :class:`Stage`,
+    #: in the thread of the stage.  If a listener raises an exception
+    #: on ``'start'`` the stage fails without running.
+    listeners = None
+
+    def __init__(self, stages=()):
+        self.stages = collections.OrderedDict()
+        self.listeners = []
+        for stage in stages:
+            self.add_stage(stage)
+
+    def add(self, name, function, requires=(), provides=(), after=()):
+        """Adds a new stage.  Parameters are the same to :class:`Stage`.
+
+        :returns: the added stage
+        :rtype: :class:`Stage`
+
+        """
+        return self.add_stage(Stage(name, function, requires=requires,
+                                    provides=provides, after=after))
+
+    def add_stage(self, stage):
+        """Adds the ``stage``.
+
+        :param stage: the stage to add
+        :type stage: :class:`Stage`
+        :returns: the added ``stage``
+        :rtype: :class:`Stage`
+
+        """
+        if not isinstance(stage, Stage):
+            raise TypeError('expected an instance of asuka.stage.Stage, '
+                            'not ' + repr(stage))
+        elif stage.name in self.stages:
+            raise ValueError('stage {0!r} already exists'.format(stage.name))
+        self.stages[stage.name] = stage
+        return stage
+
+    def make_graph(self, values=()):
+        """Makes the dependency graph of stage names.
+
+        :param values: the names of values given initially
+        :type values: :class:`collections.Iterable`
+        :returns: the dependency graph of stage names
+        :rtype: :class:`~asuka.graph.DependencyGraph`
+        :raises ValueError: if a required value is provided by nothing
+                            or two or more providers
+        :raises asuka.graph.CyclicDependencyError: if stages make a cycle
+
+        """
+        providers = dict((name, None) for name in values)
+        for stage in self.stages.itervalues():
+            for name in stage.provides:
+                if name in providers:
+                    raise ValueError('{0!r} is provided by two or more '
+                                     'providers'.format(name))
+                providers[name] = stage.name
+        dependencies = {}
+        for stage in self.stages.itervalues():
+            deps = set(stage.after)
+            for name in stage.requires:
+                try:
+                    provider = providers[name]
+                except KeyError:
+                    raise ValueError('{0!r} requires {1!r} but nothing '
+                                     'provides it'.format(stage, name))
+                if provider is not None:
+                    deps.add(provider)
+            dependencies[stage.name] = deps
+        return DependencyGraph(dependencies)
+
+    def run(self, values={}):
+        """Runs all stages.  Each stage runs in its own thread as soon
+        as all stages it depends on are done.  If a stage fails, no more
+        stages are started, and the error is reraised after running
+        stages finish.
+
+        :param values: the initial values
+        :type values: :class:`collections.Mapping`
+        :returns: the mapping of all values
+        :rtype: :class:`collections.Mapping`
+
+        """
+        logger = self.get_logger('run')
+        values = dict(values)
+        graph = self.make_graph(values)
+        done = set()
+        running = set()
+        errors = []
+        condition = threading.Condition()
+        def notify(event, stage):
+            for listener in self.listeners:
+                try:
+                    listener(event, stage)
+                except Exception as e:
+                    logger.exception(e)
+        def execute(stage):
+            try:
+                for listener in self.listeners:
+                    listener('start', stage)
+                outputs = stage(values)
+            except Exception:
+                exc_info = sys.exc_info()
+                logger.exception('%r failed', stage)
+                notify('error', stage)
+                with condition:
+                    errors.append(exc_info)
+                    running.discard(stage.name)
+                    condition.notify()
+            else:
+                logger.info('%r done', stage)
+                notify('done', stage)
+                with condition:
+                    values.update(outputs)
+                    done.add(stage.name)
+                    running.discard(stage.name)
+                    condition.notify()
+        with condition:
+            while 1:
+                if not errors:
+                    for name in graph.order:
+                        if name in done or name in running:
+                            continue
+                        elif graph[name] <= done:
+                            stage = self.stages[name]
+                            logger.info('start %r', stage)
+                            running.add(name)
+                            thread = threading.Thread(
+                                target=execute,
+                                args=(stage,),
+                                name='stage-' + name
+                            )
+                            thread.start()
+                if not running:
+                    break
+                condition.wait()
+        if errors:
+            exc_type, exc_value, tb = errors[0]
+            raise exc_type, exc_value, tb
+        return values
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __iter__(self):
+        return self.stages.itervalues()
@@ -0,0 +1,224 @@
+""":mod:`asuka.timing` --- Build timing records
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Every build records how long each of its stages took into
+:file:`timing.json` of its :attr:`~asuka.build.BaseBuild.data_dir`.
+This module also provides functions to summarize records of recent
+builds and to find regressions.
+
+"""
+import contextlib
+import json
+import math
+import os
+import os.path
+import threading
+import time
+
+__all__ = ('TimingRecord', 'find_regressions', 'load_history', 'percentile',
+           'summarize')
+
+
+class TimingRecord(object):
+    """The timing record of a build.  It's thread-safe, and saves
+    the file every time a new entry is added. ::
+
+        timing = TimingRecord('/path/to/build/timing.json')
+        with timing.measure('make_package'):
+            make_package()
+
+    :param path: the path of the record file
+    :type path: :class:`basestring`
+
+    """
+
+    #: (:class:`basestring`) The filename of timing records.
+    FILENAME = 'timing.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self.started = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.entries = json.load(f)['entries']
+
+    def add(self, name, started_at, finished_at=None, failed=False):
+        """Adds an entry.
+
+        :param name: the name of the measured stage
+        :type name: :class:`basestring`
+        :param started_at: the timestamp when the stage started
+        :type started_at: :class:`numbers.Real`
+        :param finished_at: the timestamp when the stage finished.
+                            the current time by default
+        :type finished_at: :class:`numbers.Real`
+        :param failed: whether the stage failed or not
+        :type failed: :class:`bool`
+
+        """
+        if finished_at is None:
+            finished_at = time.time()
+        entry = {
+            'name': name,
+            'started_at': started_at,
+            'duration': finished_at - started_at,
+            'failed': bool(failed)
+        }
+        with self.lock:
+            self.entries.append(entry)
+            with open(self.path, 'w') as f:
+                json.dump({'entries': self.entries}, f)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """Measures the time the :keyword:`with` block takes.
+
+        :param name: the name of the stage
+        :type name: :class:`basestring`
+
+        """
+        started_at = time.time()
+        try:
+            yield
+        except:
+            self.add(name, started_at, failed=True)
+            raise
+        self.add(name, started_at)
+
+    def listen(self, event, stage):
+        """The listener for :attr:`StageGraph.listeners
+        <asuka.stage.StageGraph.listeners>`.
+
+        """
+        if event == 'start':
+            self.started[stage.name] = time.time()
+        elif stage.name in self.started:
+            self.add(stage.name, self.started.pop(stage.name),
+                     failed=event == 'error')
+
+    @property
+    def durations(self):
+        """(:class:`collections.Mapping`) The mapping of stage names
+        to their durations in seconds.  Durations of the same name
+        are summed up.
+
+        """
+        durations = {}
+        for entry in self.entries:
+            name = entry['name']
+            durations[name] = durations.get(name, 0) + entry['duration']
+        return durations
+
+
+def load_history(data_dir, limit=50):
+    """Loads timing records of recent builds.
+
+    :param data_dir: the :attr:`~asuka.app.App.data_dir`
+    :type data_dir: :class:`basestring`
+    :param limit: the maximum number of builds to load.  default is 50
+    :type limit: :class:`numbers.Integral`
+    :returns: the list of (build identifier, :class:`TimingRecord`) pairs,
+              the newest first
+    :rtype: :class:`collections.Sequence`
+
+    """
+    builds = []
+    for dirname in os.listdir(data_dir):
+        path = os.path.join(data_dir, dirname, TimingRecord.FILENAME)
+        if os.path.isfile(path):
+            builds.append(dirname)
+    builds.sort(key=lambda n: n.rsplit('.', 1)[-1], reverse=True)
+    history = []
+    for build in builds[:limit]:
+        path = os.path.join(data_dir, build, TimingRecord.FILENAME)
+        try:
+            history.append((build, TimingRecord(path)))
+        except ValueError:
+            continue
+    return history
+
+
+def percentile(values, percent):
+    """Gets the nearest-rank ``percent`` percentile of ``values``.
+
+    :param values: the sequence of numbers
+    :type values: :class:`collections.Sequence`
+    :param percent: the percent e.g. ``90``
+    :type percent: :class:`numbers.Real`
+    :returns: the percentile, or ``None`` if ``values`` are empty
+    :rtype: :class:`numbers.Real`
+
+    """
+    if not values:
+        return
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+def summarize(history):
+    """Summarizes durations of each stage over the ``history``.
+
+    :param history: the history got by :func:`load_history()`
+    :type history: :class:`collections.Sequence`
+    :returns: the mapping of stage names to dicts which contain
+              ``'count'``, ``'p50'``, ``'p90'`` and ``'max'``
+    :rtype: :class:`collections.Mapping`
+
+    """
+    samples = {}
+    for build, record in history:
+        for name, duration in record.durations.iteritems():
+            samples.setdefault(name, []).append(duration)
+    return dict(
+        (name, {
+            'count': len(durations),
+            'p50': percentile(durations, 50),
+            'p90': percentile(durations, 90),
+            'max': max(durations)
+        })
+        for name, durations in samples.iteritems()
+    )
+
+
+def find_regressions(history, threshold=1.5, min_seconds=5, min_samples=3):
+    """Finds stages of builds that took ``threshold`` times longer than
+    the median of older builds.
+
+    :param history: the history got by :func:`load_history()`,
+                    the newest first
+    :type history: :class:`collections.Sequence`
+    :param threshold: the ratio to the median to be regarded as
+                      a regression.  default is 1.5
+    :type threshold: :class:`numbers.Real`
+    :param min_seconds: the minimum slowdown in seconds to be regarded
+                        as a regression.  it prevents noises of short
+                        stages.  default is 5 seconds
+    :type min_seconds: :class:`numbers.Real`
+    :param min_samples: the minimum number of older builds to compare.
+                        default is 3
+    :type min_samples: :class:`numbers.Integral`
+    :returns: the list of dicts which contain ``'build'``, ``'stage'``,
+              ``'duration'`` and ``'median'``, the newest first
+    :rtype: :class:`collections.Sequence`
+
+    """
+    regressions = []
+    for i, (build, record) in enumerate(history):
+        older = [r.durations for _, r in history[i + 1:]]
+        for name, duration in sorted(record.durations.iteritems()):
+            samples = [d[name] for d in older if name in d]
+            if len(samples) < min_samples:
+                continue
+            median = percentile(samples, 50)
+            if (duration > median * threshold and
+                duration - median >= min_seconds):
+                regressions.append({
+                    'build': build,
+                    'stage': name,
+                    'duration': duration,
+                    'median': median
+                })
+    return regressions
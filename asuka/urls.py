@@ -17,11 +17,14 @@ def commit(commit):
 
 
 def service_config_file(deployment, service):
-    """The :file:`{service}.yml` config file of the commit."""
-    branch = deployment.branch
-    commit = deployment.commit
-    path = branch.app.config_dir
-    if not path.endswith('/'):
+    """The :file:`{service}.yml` config file of the commit.  Commits of
+    pull requests can be browsed in the base repository as well, so it
+    doesn't need any GitHub requests.
+
+    """
+    app = deployment.app
+    path = app.config_dir.strip('/')
+    if path:
         path += '/'
     path += service + '.yml'
-    return branch.repository.contents(path, ref=commit.ref).html_url
+    return '{0}/blob/{1}/{2}'.format(repository(app), deployment.ref, path)
@@ -0,0 +1,295 @@
+""":mod:`asuka.warmpool` --- Warm pool of pre-provisioned instances
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Launching an instance and waiting for it to boot and accept SSH
+connections takes minutes.  :class:`WarmPool` keeps
+:attr:`App.warm_pool_size <asuka.app.App.warm_pool_size>` instances
+launched from the baked image (see :mod:`asuka.image`) of each
+provisioning fingerprint, booted and SSH-verified in advance, so that
+:meth:`App.create_instance() <asuka.app.App.create_instance>` can claim
+one of them instantly.
+
+Pooled instances are tagged with ``Warm-Pool`` (fingerprint) and
+``Warm-Pool-Since``, and their ``Status`` is ``'warming'`` until they
+become ready (``'warm'``).  An instance is claimed by writing a unique
+``Warm-Pool-Lease`` tag and reading it back; the claim is serialized
+by a lock file in :attr:`App.data_dir <asuka.app.App.data_dir>` among
+processes of the same host as well.
+
+"""
+import contextlib
+import datetime
+import fcntl
+import os.path
+import threading
+import time
+import uuid
+
+from boto.exception import EC2ResponseError
+
+from .instance import Instance
+from .logger import LoggerProviderMixin
+
+__all__ = 'WarmPool',
+
+
+class WarmPool(LoggerProviderMixin):
+    """The warm pool of instances of the ``app`` for the provisioning
+    ``fingerprint``. ::
+
+        pool = WarmPool(app, fingerprint)
+        instance = pool.claim()
+        if instance is None:
+            instance = launch_new_instance()
+        pool.replenish_in_background()
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+    :param fingerprint: the :func:`provisioning fingerprint
+                        <asuka.image.provisioning_fingerprint>`
+    :type fingerprint: :class:`basestring`
+
+    """
+
+    #: (:class:`basestring`) The format of ``Warm-Pool-Since`` tags.
+    TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    #: (:class:`numbers.Real`) Seconds to wait before reading back
+    #: the lease tag.
+    lease_delay = 2
+
+    #: (:class:`collections.MutableMapping`) Replenishing threads
+    #: of each (app name, fingerprint) pair.
+    replenishers = {}
+
+    #: (:class:`threading.Lock`) The lock for :attr:`replenishers`.
+    replenishers_lock = threading.Lock()
+
+    def __init__(self, app, fingerprint):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        elif not isinstance(fingerprint, basestring):
+            raise TypeError('fingerprint must be a string, not ' +
+                            repr(fingerprint))
+        self.app = app
+        self.fingerprint = fingerprint
+
+    @property
+    def size(self):
+        """(:class:`numbers.Integral`) The number of instances to keep."""
+        return self.app.warm_pool_size
+
+    @property
+    def instances(self):
+        """(:class:`collections.Sequence`) The list of pooled
+        :class:`~asuka.instance.Instance`\ s, both warming and warm,
+        the oldest first.
+
+        """
+        instances = list(self.app.instances.tagged('Warm-Pool',
+                                                   self.fingerprint))
+        instances.sort(key=lambda i: i.tags.get('Warm-Pool-Since', ''))
+        return instances
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Serializes claims among processes of the host."""
+        path = os.path.join(self.app.data_dir, '.warm-pool.lock')
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def claim(self):
+        """Claims a warm instance from the pool.
+
+        :returns: the claimed instance, or ``None`` if there's no warm
+                  instance
+        :rtype: :class:`~asuka.instance.Instance`
+
+        """
+        logger = self.get_logger('claim')
+        if self.size < 1:
+            return
+        with self.lock():
+            # Other processes may have claimed instances since the
+            # inventory was refreshed.
+            if not self.app.inventory.refresh({'Warm-Pool': self.fingerprint}):
+                logger.warning('failed to list instances of the pool')
+                return
+            for instance in self.instances:
+                if not self.is_warm(instance):
+                    continue
+                lease = uuid.uuid4().hex
+                try:
+                    # The listed tags can be old; another process may
+                    # have claimed it since.
+                    instance.instance.update()
+                    if not self.is_warm(instance):
+                        continue
+                    instance.tags['Warm-Pool-Lease'] = lease
+                    time.sleep(self.lease_delay)
+                    instance.instance.update()
+                except EC2ResponseError as e:
+                    logger.exception(e)
+                    continue
+                if not self.is_warm(instance, lease):
+                    continue
+                for tag in 'Warm-Pool', 'Warm-Pool-Since', 'Warm-Pool-Lease':
+                    del instance.tags[tag]
+                instance.status = 'not-ready'
+                logger.info('claimed %r', instance)
+                return instance
+        logger.info('no warm instances for %s', self.fingerprint)
+
+    def is_warm(self, instance, lease=None):
+        """Checks whether the ``instance`` is a warm instance of the pool
+        which isn't claimed.
+
+        :param instance: the instance to check
+        :type instance: :class:`~asuka.instance.Instance`
+        :param lease: the lease the instance has to have.  if it's omitted
+                      the instance has to have no lease
+        :type lease: :class:`basestring`
+        :rtype: :class:`bool`
+
+        """
+        tags = instance.tags
+        return (instance.instance.state == 'running' and
+                tags.get('Status') == 'warm' and
+                tags.get('Warm-Pool') == self.fingerprint and
+                tags.get('Warm-Pool-Lease') == lease)
+
+    def launch(self):
+        """Launches a new instance into the pool, and waits until it
+        becomes ready.
+
+        :returns: the launched instance, or ``None`` if there's no image
+                  baked for the :attr:`fingerprint`
+        :rtype: :class:`~asuka.instance.Instance`
+
+        """
+        from .image import ImageStore
+        logger = self.get_logger('launch')
+        image = ImageStore(self.app).find(self.fingerprint)
+        if image is None:
+            logger.info('no image for %s; skipped', self.fingerprint)
+            return
+        reserve = self.app.ec2_connection.run_instances(
+            image_id=image.id,
+            instance_type='t1.micro',
+            key_name=self.app.key_name,
+            security_groups=list(self.app.ec2_security_groups)
+        )
+        instance = Instance(self.app, reserve.instances[0])
+        instance.tags.update({
+            'App': self.app.name,
+            'Name': '{0}-warm-pool'.format(self.app.name),
+            'Status': 'warming',
+            'Warm-Pool': self.fingerprint,
+            'Warm-Pool-Since': datetime.datetime.utcnow().strftime(
+                self.TIME_FORMAT
+            ),
+            'Provisioning': self.fingerprint,
+            'Base-Image': image.tags.get('Base-Image', image.id)
+        })
+        try:
+            with instance:
+                instance.do(['true'])
+        except Exception as e:
+            logger.exception(e)
+            instance.instance.terminate()
+            self.app.inventory.forget([instance.id])
+            return
+        instance.status = 'warm'
+        logger.info('launched %r', instance)
+        return instance
+
+    def reap(self):
+        """Terminates instances that have been idle longer than
+        :attr:`App.warm_pool_idle_timeout
+        <asuka.app.App.warm_pool_idle_timeout>` seconds, and
+        instances more than :attr:`size`.
+
+        :returns: the list of terminated instances
+        :rtype: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('reap')
+        timeout = datetime.timedelta(seconds=self.app.warm_pool_idle_timeout)
+        now = datetime.datetime.utcnow()
+        instances = self.instances
+        reaped = []
+        for i, instance in enumerate(instances):
+            since = instance.tags.get('Warm-Pool-Since')
+            try:
+                since = datetime.datetime.strptime(since, self.TIME_FORMAT)
+            except (TypeError, ValueError):
+                since = None
+            if (since is None or now - since > timeout or
+                len(instances) - i > self.size):
+                reaped.append(instance)
+        if reaped:
+            with self.lock():
+                reaped = [i for i in reaped
+                          if not i.tags.get('Warm-Pool-Lease')]
+                if reaped:
+                    self.app.ec2_connection.terminate_instances(
+                        [instance.id for instance in reaped]
+                    )
+                    self.app.inventory.forget(i.id for i in reaped)
+            logger.info('reaped %r', reaped)
+        return reaped
+
+    def replenish(self):
+        """Reaps idle instances, and then launches instances until
+        the pool is filled.
+
+        :returns: the list of launched instances
+        :rtype: :class:`collections.Sequence`
+
+        """
+        reaped = set(instance.id for instance in self.reap())
+        count = sum(1 for instance in self.instances
+                    if instance.id not in reaped)
+        launched = []
+        for _ in xrange(self.size - count):
+            instance = self.launch()
+            if instance is None:
+                break
+            launched.append(instance)
+        return launched
+
+    def replenish_in_background(self):
+        """Runs :meth:`replenish()` in a daemon thread unless one is
+        already running for the same pool.
+
+        :returns: the thread, or ``None`` if it's already running
+        :rtype: :class:`threading.Thread`
+
+        """
+        if self.size < 1:
+            return
+        key = self.app.name, self.fingerprint
+        logger = self.get_logger('replenish_in_background')
+        def replenish():
+            try:
+                self.replenish()
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self.replenishers_lock:
+                    self.replenishers.pop(key, None)
+        with self.replenishers_lock:
+            if key in self.replenishers:
+                return
+            thread = threading.Thread(target=replenish,
+                                      name='warm-pool-' + self.fingerprint[:8])
+            thread.daemon = True
+            self.replenishers[key] = thread
+        thread.start()
+        return thread
@@ -7,12 +7,13 @@ import functools
 import hashlib
 import hmac
 import logging
-import multiprocessing
 import os
 import os.path
 import random
 import re
+import socket
 import sys
+import threading
 import time
 import traceback
 
@@ -25,15 +26,23 @@ try:
     import simplejson as json
 except ImportError:
     import json
-from werkzeug.exceptions import BadRequest, Forbidden
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
 from werkzeug.urls import url_decode, url_encode
 from werkzeug.utils import redirect
+from werkzeug.wrappers import Response
 
 from . import urls
 from .app import App
 from .branch import Branch, PullRequest, find_by_label
 from .build import Build, Clean, Promote
 from .commit import Commit
+from .coordinator import BuildCancelledError, BuildCoordinator
+from .dashboard import Dashboard
+from .delivery import DeliveryStore
+from .events import EventLog
+from .notify import Notifier
+from .timing import find_regressions, load_history, summarize
+from .worker import Worker
 
 __all__ = 'WebApp', 'auth_required', 'authorize', 'delegate', 'home', 'hook'
 
@@ -51,8 +60,26 @@ class WebApp(BaseApp):
 
     """
 
-    #: (:class:`multiprocessing.Pool`) The multiprocessing pool.
-    pool = None
+    #: (:class:`asuka.jobqueue.JobQueue`) The persistent job queue.
+    queue = None
+
+    #: (:class:`asuka.worker.Worker`) The worker which runs jobs in
+    #: the background, or ``None`` if :attr:`App.external_workers
+    #: <asuka.app.App.external_workers>` is set.
+    worker = None
+
+    #: (:class:`asuka.dashboard.Dashboard`) The dashboard precomputed
+    #: in the background.
+    dashboard = None
+
+    #: (:class:`numbers.Integral`) The maximum number of event streams
+    #: at a time.  Each stream occupies a thread of the server.
+    max_event_streams = 2
+
+    #: (:class:`numbers.Real`) Seconds to keep an event stream open.
+    #: Browsers reconnect to it with the ``Last-Event-ID`` header, so
+    #: that threads of the server are returned periodically.
+    event_stream_duration = 60
 
     def __init__(self, app, config={}):
         if not isinstance(app, App):
@@ -61,19 +88,28 @@ class WebApp(BaseApp):
         config.update(app.web_config)
         config['app'] = app
         super(WebApp, self).__init__(config)
-        try:
-            pool_size = multiprocessing.cpu_count()
-        except NotImplementedError:
-            pool_size = 3
-        else:
-            pool_size = pool_size * 2 + 1
-        self.pool = multiprocessing.Pool(pool_size)
+        self.queue = app.job_queue
+        if not app.external_workers:
+            self.worker = Worker(app, name=socket.gethostname() + '/web')
+            self.worker.run_in_background()
+        app.inventory.run_in_background()
+        self.dashboard = Dashboard(app)
+        self.dashboard.run_in_background()
+        self.event_streams = threading.Semaphore(self.max_event_streams)
 
     @property
     def app(self):
         """(:class:`asuka.app.App`) The application object."""
         return self.config['app']
 
+    def wake(self):
+        """Wakes up the :attr:`worker` to run newly enqueued jobs
+        immediately.
+
+        """
+        if self.worker is not None:
+            self.worker.wake()
+
     def wsgi_app(self, environ, start_response):
         app = self.app
         if not app.url_base:
@@ -178,9 +214,67 @@ def authorize(request):
 @WebApp.route('/home/')
 @auth_required
 def home(request):
-    """The list of deployed branches."""
-    deployments = request.app.app.deployments
-    return render(request, deployments, 'home', deployments=deployments)
+    """The list of deployed branches.  It's rendered from
+    the :attr:`~WebApp.dashboard` precomputed in the background.
+
+    """
+    dashboard = request.app.dashboard
+    if dashboard.refreshed_at is None:
+        dashboard.refresh()
+    deployments = dashboard.deployments
+    return render(request, deployments, 'home',
+                  deployments=deployments, dashboard=dashboard)
+
+
+@WebApp.route('/events/')
+@auth_required
+def event_stream(request):
+    """The stream of server-sent events.  It relays events of
+    the :class:`~asuka.events.EventLog` (``status`` and ``job``),
+    and sends ``dashboard`` events when the :attr:`~WebApp.dashboard`
+    has new deployments.
+
+    """
+    webapp = request.app
+    dashboard = webapp.dashboard
+    log = EventLog(webapp.app)
+    cursor = (request.headers.get('Last-Event-ID') or
+              request.args.get('cursor'))
+    revision = request.args.get('revision', type=int)
+    def message(event, data, id_=None):
+        lines = 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data))
+        if id_:
+            lines = 'id: {0}\n'.format(id_) + lines
+        return lines
+    def stream(cursor, revision):
+        if not webapp.event_streams.acquire(False):
+            # Too many streams; let the browser retry later.
+            yield 'retry: 30000\n\n'
+            return
+        try:
+            yield 'retry: 3000\n\n'
+            if cursor is None:
+                _, cursor = log.read()
+                yield 'id: {0}\n\n'.format(cursor)
+            deadline = time.time() + webapp.event_stream_duration
+            keepalive = time.time()
+            while time.time() < deadline:
+                events, cursor = log.read(cursor)
+                for event_cursor, event in events:
+                    yield message(event['event'], event['data'], event_cursor)
+                if revision is not None and dashboard.revision != revision:
+                    revision = dashboard.revision
+                    yield message('dashboard', {'revision': revision})
+                if events:
+                    continue
+                elif time.time() - keepalive > 15:
+                    keepalive = time.time()
+                    yield ': keepalive\n\n'
+                time.sleep(1)
+        finally:
+            webapp.event_streams.release()
+    return Response(stream(cursor, revision), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 @WebApp.route('/deploy', methods=['POST'])
@@ -189,7 +283,8 @@ def deploy_manually(request):
     app = webapp.app
     branch = find_by_label(app, request.form['branch'])
     commit = Commit(app, request.form['commit'])
-    deploy(webapp, commit, branch)
+    deploy(app, commit, branch)
+    webapp.wake()
     return 'Start to deploy {0!r} [{1.ref}]'.format(branch, commit)
 
 
@@ -200,7 +295,8 @@ def terminate(request, label):
     app = webapp.app
     branch = find_by_label(app, label)
     commit = app.deployed_branches[branch]
-    cleanup(webapp, commit, branch)
+    cleanup(app, commit, branch)
+    webapp.wake()
     return 'Start to terminate {0!r} [{1.ref}]'.format(branch, commit)
 
 
@@ -211,7 +307,8 @@ def deploy_again(request, label):
     app = webapp.app
     branch = find_by_label(app, label)
     commit = app.deployed_branches[branch]
-    redeploy(webapp, commit, branch)
+    redeploy(app, commit, branch)
+    webapp.wake()
     return 'Start to redeploy {0!r} [{1.ref}]'.format(branch, commit)
 
 
@@ -222,97 +319,165 @@ def start_promote(request, label):
     app = webapp.app
     branch = find_by_label(app, label)
     commit = app.deployed_branches[branch]
-    promote(webapp, commit, branch)
+    promote(app, commit, branch)
+    webapp.wake()
     return 'Start to promote {0!r} [{1.ref}]'.format(branch, commit)
 
 
 @WebApp.route('/hook/')
 def hook(request):
+    """The endpoint of GitHub web hooks.  It only verifies and stores
+    the delivery, and leaves the rest to :func:`hook_worker()`, so that
+    it responds in time.
+
+    """
     logger = logging.getLogger(__name__ + '.hook')
-    app = request.app.app
-    assert request.mimetype == 'application/json'
+    webapp = request.app
+    app = webapp.app
+    if request.mimetype != 'application/json':
+        raise BadRequest()
     data = request.data
     sig = hmac.new(app.github_client_secret, data, hashlib.sha1)
-    assert request.headers['X-Hub-Signature'].split('=')[1] == sig.hexdigest()
+    signature = request.headers.get('X-Hub-Signature', '').partition('=')[2]
+    if signature != sig.hexdigest():
+        raise Forbidden()
+    event = request.headers.get('X-GitHub-Event')
+    delivery = request.headers.get('X-GitHub-Delivery') or sig.hexdigest()
+    logger.info('event = %r, delivery = %r', event, delivery)
+    if event not in ('push', 'pull_request'):
+        return 'ignored'
     payload = json.loads(data)
-    event = request.headers['X-GitHub-Event']
-    logger.info('event = %r', event)
-    logger.debug('payload = %r', payload)
-    if event == 'push':
-        message = payload.get('head_commit', {}).get('message', '')
-    elif event == 'pull_request':
-        try:
-            number = payload['pull_request']['number']
-        except KeyError:
-            message = None
+    try:
+        if event == 'push':
+            label = Branch(app, payload['ref'].split('/', 2)[2]).label
+            commit = payload['after']
         else:
-            pull_request = app.repository.pull_request(number)
-            commits = pull_request.iter_commits()
-            head = list(commits)[-1]
-            message = head._json_data.get('commit', {}).get('message', '')
-    else:
-        message = None
-    if message is None or IGNORE_PATTERN.search(message):
-        return 'ignored'
-    config_url = app.repository._build_url('contents', app.config_dir,
-                                           base_url=app.repository._api)
-    config_dir = app.repository._get(config_url.rstrip('/'), params={
-        'ref': payload['head_commit']['id']
-               if event == 'push'
-               else payload['pull_request']['head']['sha']
-    })
-    logger.info('config_dir.url = %r', config_dir.url)
-    logger.info('config_dir.status_code = %r', config_dir.status_code)
-    logger.debug('config_dir.json = %r', config_dir.json)
-    if config_dir.status_code >= 400:
+            pull_request = payload['pull_request']
+            label = 'pull-{0}'.format(pull_request['number'])
+            commit = pull_request['head']['sha']
+    except (KeyError, IndexError, TypeError):
         return 'ignored'
-    if event == 'pull_request':
-        hook_pull_request(request.app, payload)
-    elif event == 'push':
-        hook_push(request.app, payload)
-    return 'okay'
+    store = DeliveryStore(app)
+    if not store.save(delivery, event, data):
+        return 'duplicate'
+    try:
+        enqueue(app, 'hook', label, commit, delivery)
+    except Exception:
+        # Otherwise GitHub's redelivery would be taken as a duplicate,
+        # and the delivery would be lost.
+        store.discard(delivery)
+        raise
+    webapp.wake()
+    return 'accepted'
+
+
+def hook_worker(app, branch, commit, delivery, listeners=()):
+    """Processes the web hook ``delivery`` stored by :func:`hook()`."""
+    logger = logging.getLogger(__name__ + '.hook_worker')
+    store = DeliveryStore(app)
+    try:
+        event, payload = store.load(delivery)
+        logger.debug('payload = %r', payload)
+        if event == 'push':
+            message = (payload.get('head_commit') or {}).get('message', '')
+        elif event == 'pull_request':
+            message = Commit(app, commit).git_commit.message
+        else:
+            message = None
+        if message is None or IGNORE_PATTERN.search(message):
+            logger.info('ignored: %s [%s]', branch, commit)
+            return
+        config_url = app.repository._build_url('contents', app.config_dir,
+                                               base_url=app.repository._api)
+        config_dir = app.repository._get(config_url.rstrip('/'), params={
+            'ref': commit
+        })
+        logger.info('config_dir.url = %r', config_dir.url)
+        logger.info('config_dir.status_code = %r', config_dir.status_code)
+        logger.debug('config_dir.json = %r', config_dir.json)
+        if config_dir.status_code >= 400:
+            logger.info('ignored: %s [%s]', branch, commit)
+            return
+        if event == 'pull_request':
+            hook_pull_request(app, payload)
+        elif event == 'push':
+            hook_push(app, payload)
+    except Exception as e:
+        logger.exception(e)
+        return False
+    finally:
+        store.collect_garbage()
 
 
-def hook_pull_request(webapp, payload):
+def hook_pull_request(app, payload):
     pull_request = payload['pull_request']
-    commit = Commit(webapp.app, pull_request['head']['sha'])
-    branch = PullRequest(webapp.app, pull_request['number'])
+    commit = Commit(app, pull_request['head']['sha'])
+    branch = PullRequest(app, pull_request['number'], merge_test=False)
     if payload['action'] == 'closed':
-        cleanup(webapp, commit, branch)
+        cleanup(app, commit, branch)
     else:
-        deploy(webapp, commit, branch)
+        deploy(app, commit, branch)
+
 
+def hook_push(app, payload):
+    commit = Commit(app, payload['after'])
+    branch = Branch(app, payload['ref'].split('/', 2)[2])
+    deploy(app, commit, branch)
 
-def hook_push(webapp, payload):
-    commit = Commit(webapp.app, payload['after'])
-    branch = Branch(webapp.app, payload['ref'].split('/', 2)[2])
-    deploy(webapp, commit, branch)
 
+def enqueue(app, kind, label, commit, *arguments):
+    """Enqueues the job of the ``kind`` to the :attr:`App.job_queue
+    <asuka.app.App.job_queue>`.  Workers pick it up at the next
+    heartbeat unless they are woken up e.g. by :meth:`WebApp.wake()`.
 
-def redeploy(webapp, commit, branch):
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+    :param kind: the kind of the job e.g. ``'deploy'``.
+                 :func:`~asuka.worker.run_job()` calls
+                 the ``kind + '_worker'`` function
+    :type kind: :class:`basestring`
+    :param label: the branch label
+    :type label: :class:`basestring`
+    :param commit: the commit ref
+    :type commit: :class:`basestring`
+    :returns: the id of the job
+    :rtype: :class:`numbers.Integral`
+
+    """
+    return app.job_queue.enqueue(kind, label, commit, arguments,
+                                 timeout=app.job_timeout)
+
+
+def redeploy(app, commit, branch):
     logger = logging.getLogger(__name__ + '.redeploy')
     logger.info('start redeployment: %s [%s]', branch.label, commit.ref)
-    webapp.pool.apply_async(
-        redeploy_worker,
-        (webapp.app, branch.label, commit.ref)
-    )
+    coordinator = BuildCoordinator(app, branch.label)
+    generation = coordinator.supersede(commit.ref)
+    enqueue(app, 'redeploy', branch.label, commit.ref, generation)
 
 
-def redeploy_worker(app, branch, commit):
-    cleanup_worker(app, branch, commit)
-    deploy_worker(app, branch, commit)
+def redeploy_worker(app, branch, commit, generation=None, listeners=()):
+    logger = logging.getLogger(__name__ + '.redeploy_worker')
+    coordinator = BuildCoordinator(app, branch)
+    if generation is not None and not coordinator.is_current(generation):
+        # e.g. it was requeued after a newer deployment had finished;
+        # it must not tear the newer deployment down.
+        logger.info('superseded; skip redeploy_worker: %s [%s]',
+                    branch, commit)
+        return
+    cleanup_worker(app, branch, commit, generation, listeners)
+    return deploy_worker(app, branch, commit, generation, listeners)
 
 
-def cleanup(webapp, commit, branch):
+def cleanup(app, commit, branch):
     logger = logging.getLogger(__name__ + '.cleanup')
     logger.info('start cleaning up: %s [%s]', branch.label, commit.ref)
-    webapp.pool.apply_async(
-        cleanup_worker,
-        (webapp.app, branch.label, commit.ref)
-    )
+    BuildCoordinator(app, branch.label).cancel()
+    enqueue(app, 'cleanup', branch.label, commit.ref)
 
 
-def cleanup_worker(app, branch, commit):
+def cleanup_worker(app, branch, commit, generation=None, listeners=()):
+    coordinator = BuildCoordinator(app, branch)
     branch = find_by_label(app, branch)
     commit = Commit(app, commit)
     logger = logging.getLogger(__name__ + '.cleanup_worker')
@@ -322,26 +487,37 @@ def cleanup_worker(app, branch, commit):
         system_logger.addHandler(logging.StreamHandler(sys.stderr))
         logger.info('start cleanup_worker: %s [%s]', branch.label, commit.ref)
         clean = Clean(branch, commit)
+        if generation is not None:
+            clean.stage_listeners.append(coordinator.listener(generation))
+        clean.stage_listeners.extend(listeners)
         clean.uninstall()
         logger.info('finished cleanup_worker: %s [%s]',
                     branch.label, commit.ref)
+    except BuildCancelledError as e:
+        logger.info('%s', e)
+        return False
     except Exception as e:
         logger.exception(e)
+        return False
 
 
-def promote(webapp, commit, branch):
+def promote(app, commit, branch):
     logger = logging.getLogger(__name__ + '.promote')
     logger.info('start promoting: %s [%s]', branch.label, commit.ref)
-    webapp.pool.apply_async(
-        promote_worker,
-        (webapp.app, branch.label, commit.ref)
-    )
+    coordinator = BuildCoordinator(app, 'live')
+    generation = coordinator.supersede(commit.ref)
+    enqueue(app, 'promote', branch.label, commit.ref, generation)
 
 
-def promote_worker(app, branch, commit):
-    branch = find_by_label(app, branch)
-    commit = Commit(app, commit)
+def promote_worker(app, branch, commit, generation=None, listeners=()):
     logger = logging.getLogger(__name__ + '.promote_worker')
+    coordinator = BuildCoordinator(app, 'live')
+    if generation is not None and not coordinator.is_current(generation):
+        logger.info('superseded; skip promote_worker: %s [%s]',
+                    branch, commit)
+        return
+    branch = find_by_label(app, branch, merge_test=True)
+    commit = Commit(app, commit)
     try:
         system_logger = logging.getLogger('asuka')
         system_logger.setLevel(logging.DEBUG)
@@ -349,42 +525,36 @@ def promote_worker(app, branch, commit):
         logger.info('start cleanup_worker: %s [%s]', branch.label, commit.ref)
         # start web hook
         payload = make_payload(branch, commit)
-        with session() as client:
-            for hook_url in branch.app.start_hook_urls:
-                client.post(
-                    hook_url,
-                    headers={'Content-Type': 'application/json'},
-                    data=json.dumps(payload)
-                )
+        notifier = Notifier(app)
+        notifier.notify(app.start_hook_urls, payload)
         # build
-        instance = branch.app.create_instance()
-        promote_ = Promote(branch, commit, instance)
+        promote_ = Promote(branch, commit)
+        if generation is not None:
+            promote_.stage_listeners.append(coordinator.listener(generation))
+        promote_.stage_listeners.extend(listeners)
         deployed_domains = promote_.install()
         # finish web hook
         payload['deployed_domains'] = dict(
             (service, domain[:-1] if domain.endswith('.') else domain)
             for service, domain in deployed_domains.items()
         )
-        with session() as client:
-            for hook_url in branch.app.finish_hook_urls:
-                client.post(
-                    hook_url,
-                    headers={'Content-Type': 'application/json'},
-                    data=json.dumps(payload)
-                )
+        notifier.notify(app.finish_hook_urls, payload)
         logger.info('finished promote_worker: %s [%s]',
                     branch.label, commit.ref)
+    except BuildCancelledError as e:
+        logger.info('%s', e)
+        return False
     except Exception as e:
         logger.exception(e)
+        return False
 
 
-def deploy(webapp, commit, branch):
+def deploy(app, commit, branch):
     logger = logging.getLogger(__name__ + '.deploy')
     logger.info('start deployment: %s [%s]', branch.label, commit.ref)
-    webapp.pool.apply_async(
-        deploy_worker,
-        (webapp.app, branch.label, commit.ref)
-    )
+    coordinator = BuildCoordinator(app, branch.label)
+    generation = coordinator.supersede(commit.ref)
+    enqueue(app, 'deploy', branch.label, commit.ref, generation)
 
 
 def make_payload(branch, commit):
@@ -426,10 +596,14 @@ def make_payload(branch, commit):
     }
 
 
-def deploy_worker(app, branch, commit):
-    branch = find_by_label(app, branch)
-    commit = Commit(app, commit)
+def deploy_worker(app, branch, commit, generation=None, listeners=()):
     logger = logging.getLogger(__name__ + '.deploy_worker')
+    coordinator = BuildCoordinator(app, branch)
+    if generation is not None and not coordinator.is_current(generation):
+        logger.info('superseded; skip deploy_worker: %s [%s]', branch, commit)
+        return
+    branch = find_by_label(app, branch, merge_test=True)
+    commit = Commit(app, commit)
     try:
         system_logger = logging.getLogger('asuka')
         system_logger.setLevel(logging.DEBUG)
@@ -437,44 +611,33 @@ def deploy_worker(app, branch, commit):
         logger.info('start deploy_worker: %s [%s]', branch.label, commit.ref)
         # start web hook
         payload = make_payload(branch, commit)
-        with session() as client:
-            for hook_url in branch.app.start_hook_urls:
-                client.post(
-                    hook_url,
-                    headers={'Content-Type': 'application/json'},
-                    data=json.dumps(payload)
-                )
+        notifier = Notifier(app)
+        notifier.notify(app.start_hook_urls, payload)
         # build
-        instance = branch.app.create_instance()
-        build = Build(branch, commit, instance)
+        build = Build(branch, commit)
+        if generation is not None:
+            build.stage_listeners.append(coordinator.listener(generation))
+        build.stage_listeners.extend(listeners)
         deployed_domains = build.install()
         # finish web hook
         payload['deployed_domains'] = dict(
             (service, domain[:-1] if domain.endswith('.') else domain)
             for service, domain in deployed_domains.items()
         )
-        with session() as client:
-            for hook_url in branch.app.finish_hook_urls:
-                client.post(
-                    hook_url,
-                    headers={'Content-Type': 'application/json'},
-                    data=json.dumps(payload)
-                )
+        notifier.notify(app.finish_hook_urls, payload)
         logger.info('finished deploy_worker: %s [%s]', branch.label, commit.ref)
+    except BuildCancelledError as e:
+        logger.info('%s', e)
+        return False
     except Exception as e:
         logger.exception(e)
+        return False
 
 
 @WebApp.route('/logs/')
 @auth_required
 def log_list(request):
-    data_dir = request.app.app.data_dir
-    entries = [
-        dirname
-        for dirname in os.listdir(data_dir)
-        if os.path.isdir(os.path.join(data_dir, dirname))
-    ]
-    entries.sort(key=lambda n: n.rsplit('.', 1)[-1], reverse=True)
+    entries = list_builds(request.app.app.data_dir)
     return render(request, entries, 'log_list', builds=entries)
 
 
@@ -516,6 +679,244 @@ def log_file(request, build):
                   build=build, records=records(), levelno=levelno)
 
 
+@WebApp.route('/timings/')
+@auth_required
+def timing_list(request):
+    data_dir = request.app.app.data_dir
+    limit = request.values.get('builds', default=50, type=int)
+    threshold = request.values.get('threshold', default=1.5, type=float)
+    history = load_history(data_dir, limit=limit)
+    summary = summarize(history)
+    regressions = find_regressions(history, threshold=threshold)
+    result = {
+        'builds': [build for build, _ in history],
+        'summary': summary,
+        'regressions': regressions
+    }
+    return render(request, result, 'timing_list',
+                  summary=sorted(summary.iteritems(),
+                                 key=lambda pair: pair[1]['p50'], reverse=True),
+                  regressions=regressions,
+                  builds=len(history), threshold=threshold)
+
+
+def wants_json(request):
+    """Whether the client prefers JSON to HTML or not.  It can be
+    forced by ``?format=json`` query as well.
+
+    """
+    if request.args.get('format') == 'json':
+        return True
+    accept = request.accept_mimetypes
+    return accept.quality('application/json') > accept.quality('text/html')
+
+
+def json_response(value, status=200):
+    """Makes a JSON response of the ``value``."""
+    return Response(json.dumps(value), status=status,
+                    mimetype='application/json')
+
+
+def conditional_json_response(request, etag, make_value):
+    """Makes a JSON response with the strong ``etag``.  If the client
+    already has the same version, it responds ``304 Not Modified``
+    without calling ``make_value``.
+
+    :param request: the request
+    :param etag: the strong entity tag of the current version
+    :type etag: :class:`basestring`
+    :param make_value: the function which returns the value to serialize
+    :type make_value: :class:`collections.Callable`
+
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = json_response(make_value())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@WebApp.route('/api/v1/deployments/')
+@auth_required
+def api_deployments(request):
+    """The JSON version of :func:`home`.  Its entity tag is derived from
+    the :attr:`~WebApp.dashboard` in memory.
+
+    """
+    dashboard = request.app.dashboard
+    if dashboard.refreshed_at is None:
+        dashboard.refresh()
+    value = {
+        'deployments': dashboard.deployments,
+        'stale': dashboard.stale
+    }
+    body = json.dumps(value, sort_keys=True)
+    etag = hashlib.sha1(body).hexdigest()
+    return conditional_json_response(request, etag, lambda: value)
+
+
+def list_builds(data_dir):
+    """Lists builds which have logs, the most recent first.
+
+    :param data_dir: the :attr:`App.data_dir <asuka.app.App.data_dir>`
+    :type data_dir: :class:`basestring`
+    :returns: the list of build identifiers
+    :rtype: :class:`collections.Sequence`
+
+    """
+    entries = [
+        dirname
+        for dirname in os.listdir(data_dir)
+        if not dirname.startswith('.') and
+           os.path.isdir(os.path.join(data_dir, dirname))
+    ]
+    entries.sort(key=lambda n: n.rsplit('.', 1)[-1], reverse=True)
+    return entries
+
+
+@WebApp.route('/api/v1/builds/')
+@auth_required
+def api_builds(request):
+    """The JSON version of :func:`log_list`.  Each build has the size
+    of its log, and the entity tag is derived from them, so it changes
+    whenever a build starts or logs.
+
+    """
+    data_dir = request.app.app.data_dir
+    builds = []
+    for build in list_builds(data_dir):
+        try:
+            size = os.path.getsize(os.path.join(data_dir, build, 'log.txt'))
+        except OSError:
+            size = None
+        builds.append({
+            'id': build,
+            'log_size': size,
+            'log_url': request.build_url('api_log', build=build,
+                                         _external=True)
+        })
+    etag = hashlib.sha1(
+        ','.join('{0[id]}:{0[log_size]}'.format(b) for b in builds)
+    ).hexdigest()
+    return conditional_json_response(request, etag,
+                                     lambda: {'builds': builds})
+
+
+@WebApp.route('/api/v1/builds/<build>/log')
+@auth_required
+def api_log(request, build):
+    """The JSON version of :func:`log_file`.  Records are paginated by
+    the ``cursor``, the byte offset in the log to read from, and
+    ``limit``.  The response contains the ``next_cursor``, and ``more``
+    which is ``False`` if there's nothing to read after it yet.  Since
+    logs are only appended, the entity tag is derived from the query
+    and the size of the log, and only the bytes up to that size
+    are read.
+
+    """
+    data_dir = request.app.app.data_dir
+    if build not in list_builds(data_dir):
+        raise NotFound()
+    filename = os.path.join(data_dir, build, 'log.txt')
+    cursor = request.args.get('cursor', default=0, type=int)
+    limit = min(request.args.get('limit', default=500, type=int), 5000)
+    levelno = request.args.get('levelno', default=logging.INFO, type=int)
+    thread = request.args.get('thread')
+    logger = request.args.get('name')
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        raise NotFound()
+    cursor = max(0, min(cursor, size))
+    etag = hashlib.sha1('{0}:{1}:{2}:{3}:{4}:{5}:{6}'.format(
+        build, size, cursor, limit, levelno, thread, logger
+    )).hexdigest()
+    def read():
+        records = []
+        offset = cursor
+        with open(filename) as f:
+            f.seek(cursor)
+            # The last line can be being written, so it's left out.
+            lines = f.read(size - cursor).split('\n')[:-1]
+        for line in lines:
+            if len(records) >= limit:
+                break
+            offset += len(line) + 1
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if logger and not record['name'].startswith(logger):
+                continue
+            elif record['levelno'] < levelno:
+                continue
+            elif thread and thread != (record['process_name'] +
+                                       '/' + record['thread_name']):
+                continue
+            records.append(record)
+        return {
+            'build': build,
+            'records': records,
+            'next_cursor': offset,
+            'more': offset < size
+        }
+    return conditional_json_response(request, etag, read)
+
+
+@WebApp.route('/jobs/')
+@auth_required
+def job_list(request):
+    """The list of running, queued and recently finished jobs."""
+    queue = request.app.queue
+    jobs = queue.list()
+    running = [job for job in jobs if job.state == 'running']
+    queued = [job for job in jobs if job.state == 'queued']
+    finished = queue.recent(
+        limit=request.values.get('finished', default=20, type=int)
+    )
+    if wants_json(request):
+        return json_response({
+            'running': [dict(job._asdict(), deadline=job.deadline)
+                        for job in running],
+            'queued': [dict(job._asdict(), position=position)
+                       for position, job in enumerate(queued, 1)],
+            'finished': [job._asdict() for job in finished]
+        })
+    return render(request, jobs, 'job_list',
+                  running=running, queued=queued, finished=finished,
+                  now=time.time())
+
+
+@WebApp.route('/jobs/<int:job_id>/')
+@auth_required
+def job_detail(request, job_id):
+    """The job in JSON."""
+    job = request.app.queue.get(job_id)
+    if job is None:
+        raise NotFound()
+    return json_response(dict(job._asdict(), deadline=job.deadline))
+
+
+@WebApp.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@auth_required
+def cancel_job(request, job_id):
+    """Cancels the job.  Queued jobs are dropped, and running jobs stop
+    at the next stage boundary.
+
+    """
+    cancelled = request.app.queue.cancel(job_id)
+    if wants_json(request):
+        return json_response({'id': job_id, 'cancelled': cancelled},
+                             status=200 if cancelled else 409)
+    elif not cancelled:
+        return 'Job #{0} is neither queued nor running'.format(job_id)
+    return redirect(request.build_url('job_list'))
+
+
 @WebApp.route('/delegate/')
 @auth_required
 def delegate(request):
@@ -0,0 +1,321 @@
+""":mod:`asuka.wheelhouse` --- Prebuilt wheels of service packages
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Python packages services require (e.g. :mod:`celery`, :mod:`meinheld`)
+are built into wheels only once per platform, and kept in the wheelhouse
+of the controller.  Later builds upload only the wheels they need and
+install them without any index.
+
+Since the wheels have to be compatible with the target instances,
+missing wheels are built on the instance being deployed, and then
+downloaded to the wheelhouse.  Builds run in several worker processes,
+so building and adding wheels are serialized by a lock file in the
+wheelhouse.
+
+"""
+import contextlib
+import fcntl
+import json
+import os
+import os.path
+import re
+import tempfile
+import threading
+
+from .dist import PYPI_INDEX_URLS
+from .instance import Instance
+from .logger import LoggerProviderMixin
+
+__all__ = 'Wheelhouse',
+
+
+class Wheelhouse(LoggerProviderMixin):
+    """The cache of wheels for a platform.  Wheels are grouped by
+    package specs (e.g. ``'celery'``, ``'Werkzeug >= 0.8'``) which
+    were built with, so that every wheel a spec depends on can be
+    uploaded together. ::
+
+        wheelhouse = Wheelhouse.for_instance(instance)
+        wheelhouse.install(instance, ['celery', 'meinheld'])
+
+    :param platform: the platform identifier
+    :type platform: :class:`basestring`
+    :param path: the path of the directory to store wheels.
+                 default is :file:`asuka-wheelhouse/{platform}` in
+                 the temporary directory
+    :type path: :class:`basestring`
+
+    """
+
+    #: (:class:`basestring`) The filename of the index of specs.
+    INDEX_FILENAME = 'index.json'
+
+    #: (:class:`collections.Sequence`) The requirements to build and
+    #: install wheels on instances.  pip supports wheels since 1.4,
+    #: and 1.5 dropped pybundles that :class:`~asuka.dist.Dist` makes.
+    BOOTSTRAP_REQUIREMENTS = ['pip >= 1.4, < 1.5', 'wheel']
+
+    #: (:class:`basestring`) The filename of the lock file.
+    LOCK_FILENAME = '.lock'
+
+    #: (:class:`collections.MutableMapping`) The thread locks of each
+    #: (path, process id) pair.
+    locks = {}
+
+    #: (:class:`collections.MutableMapping`) The depths of
+    #: :meth:`locked()` of each (path, process id) pair.
+    lock_depths = {}
+
+    #: (:class:`collections.MutableMapping`) The open lock files of
+    #: each (path, process id) pair.
+    lock_files = {}
+
+    #: (:class:`threading.Lock`) The lock for :attr:`locks`.
+    locks_lock = threading.Lock()
+
+    @classmethod
+    def for_instance(cls, instance):
+        """Gets the wheelhouse for the platform of the ``instance``.
+
+        :param instance: the target instance
+        :type instance: :class:`~asuka.instance.Instance`
+        :returns: the wheelhouse
+        :rtype: :class:`Wheelhouse`
+
+        """
+        return cls(instance.platform)
+
+    def __init__(self, platform, path=None):
+        if not isinstance(platform, basestring):
+            raise TypeError('platform must be a string, not ' +
+                            repr(platform))
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(), 'asuka-wheelhouse',
+                                re.sub(r'[^A-Za-z0-9_.-]', '_', platform))
+        self.platform = platform
+        self.path = path
+        self.lock_key = path, os.getpid()
+        with self.locks_lock:
+            self.lock = self.locks.setdefault(self.lock_key,
+                                              threading.RLock())
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Serializes changes of the wheelhouse among threads and
+        processes of the host.  It's reentrant.
+
+        """
+        key = self.lock_key
+        with self.lock:
+            depth = self.lock_depths.get(key, 0)
+            if not depth:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                f = open(os.path.join(self.path, self.LOCK_FILENAME), 'a')
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self.lock_files[key] = f
+            self.lock_depths[key] = depth + 1
+            try:
+                yield
+            finally:
+                self.lock_depths[key] -= 1
+                if not self.lock_depths[key]:
+                    f = self.lock_files.pop(key)
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    f.close()
+
+    @property
+    def index_path(self):
+        """(:class:`basestring`) The path of the index file."""
+        return os.path.join(self.path, self.INDEX_FILENAME)
+
+    @property
+    def index(self):
+        """(:class:`collections.Mapping`) The mapping of package specs
+        to the list of their wheel filenames.
+
+        """
+        # It's replaced atomically, so it can be read without the lock.
+        if not os.path.isfile(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def find(self, spec):
+        """Finds wheel files of the ``spec``.
+
+        :param spec: the package spec e.g. ``'celery'``
+        :type spec: :class:`basestring`
+        :returns: the list of paths of wheel files.  ``None`` if they
+                  aren't built yet
+        :rtype: :class:`collections.Sequence`
+
+        """
+        filenames = self.index.get(spec)
+        if filenames is None:
+            return
+        paths = [os.path.join(self.path, filename) for filename in filenames]
+        if all(os.path.isfile(path) for path in paths):
+            return paths
+
+    def add(self, spec, paths):
+        """Adds wheel files of the ``spec`` into the wheelhouse.  The files
+        are moved.
+
+        :param spec: the package spec e.g. ``'celery'``
+        :type spec: :class:`basestring`
+        :param paths: the paths of wheel files the ``spec`` needs
+        :type paths: :class:`collections.Iterable`
+
+        """
+        with self.locked():
+            filenames = []
+            for path in paths:
+                filename = os.path.basename(path)
+                os.rename(path, os.path.join(self.path, filename))
+                filenames.append(filename)
+            index = self.index
+            index[spec] = sorted(filenames)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path,
+                                            prefix=self.INDEX_FILENAME + '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, self.index_path)
+
+    @property
+    def index_options(self):
+        """(:class:`collections.Sequence`) The :program:`pip` options
+        of package indices.
+
+        """
+        options = ['-i', PYPI_INDEX_URLS[0]]
+        for url in PYPI_INDEX_URLS[1:]:
+            options.append('--extra-index-url=' + url)
+        return options
+
+    def bootstrap(self, instance):
+        """Installs :attr:`BOOTSTRAP_REQUIREMENTS` into the ``instance``
+        if they aren't installed yet.
+
+        :param instance: the instance to bootstrap
+        :type instance: :class:`~asuka.instance.Instance`
+
+        """
+        instance.sudo(['pip', 'install'] + self.index_options +
+                      self.BOOTSTRAP_REQUIREMENTS,
+                      environ={'CI': '1'})
+
+    def build(self, instance, specs, remote_path):
+        """Builds wheels of ``specs`` on the ``instance``, and adds them
+        into the wheelhouse.
+
+        :param instance: the instance to build wheels on
+        :type instance: :class:`~asuka.instance.Instance`
+        :param specs: the package specs to build
+        :type specs: :class:`collections.Iterable`
+        :param remote_path: the remote path of the working directory
+        :type remote_path: :class:`basestring`
+        :returns: the list of specs that failed to be built
+        :rtype: :class:`collections.Sequence`
+
+        """
+        logger = self.get_logger('build')
+        failed = []
+        with instance:
+            for i, spec in enumerate(specs):
+                wheel_dir = '{0}/build-{1}'.format(remote_path, i)
+                instance.do(['mkdir', '-p', wheel_dir])
+                status = instance.do(
+                    ['pip', 'wheel', '--wheel-dir=' + wheel_dir] +
+                    self.index_options + [spec],
+                    environ={'CI': '1'}
+                )
+                if status:
+                    logger.warn('failed to build wheels of %r (%d)',
+                                spec, status)
+                    failed.append(spec)
+                    continue
+                local_dir = tempfile.mkdtemp(prefix='asuka-wheel-')
+                try:
+                    paths = []
+                    with instance.sftp() as sftp:
+                        for filename in sftp.listdir(wheel_dir):
+                            if not filename.endswith('.whl'):
+                                continue
+                            path = os.path.join(local_dir, filename)
+                            instance.get_file(wheel_dir + '/' + filename,
+                                              path)
+                            paths.append(path)
+                    self.add(spec, paths)
+                    logger.info('built %r: %r', spec,
+                                map(os.path.basename, paths))
+                finally:
+                    for filename in os.listdir(local_dir):
+                        os.unlink(os.path.join(local_dir, filename))
+                    os.rmdir(local_dir)
+        return failed
+
+    def install(self, instance, specs):
+        """Installs ``specs`` into the ``instance`` from prebuilt wheels.
+        Missing wheels are built first.
+
+        :param instance: the instance to install packages
+        :type instance: :class:`~asuka.instance.Instance`
+        :param specs: the package specs to install
+        :type specs: :class:`collections.Iterable`
+        :returns: the list of specs that couldn't be installed from
+                  wheels.  they have to be installed in the other way
+        :rtype: :class:`collections.Sequence`
+
+        """
+        if not isinstance(instance, Instance):
+            raise TypeError('instance must be an instance of asuka.instance.'
+                            'Instance, not ' + repr(instance))
+        logger = self.get_logger('install')
+        specs = sorted(set(specs))
+        remote_path = '/tmp/asuka-wheelhouse'
+        with instance:
+            instance.do(['rm', '-rf', remote_path])
+            instance.do(['mkdir', '-p', remote_path + '/wheels'])
+            self.bootstrap(instance)
+            with self.locked():
+                missing = [spec for spec in specs if self.find(spec) is None]
+                if missing:
+                    logger.info('build missing wheels: %r', missing)
+                    failed = self.build(instance, missing, remote_path)
+                else:
+                    failed = []
+                wheels = {}
+                for spec in specs:
+                    if spec not in failed:
+                        paths = self.find(spec)
+                        if paths is None:
+                            failed.append(spec)
+                        else:
+                            wheels[spec] = paths
+            available = [spec for spec in specs if spec in wheels]
+            if not available:
+                return failed
+            filenames = set()
+            with instance.sftp():
+                for spec in available:
+                    for path in wheels[spec]:
+                        filename = os.path.basename(path)
+                        if filename in filenames:
+                            continue
+                        instance.put_file(
+                            path,
+                            '{0}/wheels/{1}'.format(remote_path, filename)
+                        )
+                        filenames.add(filename)
+            logger.info('uploaded %d wheels for %r', len(filenames), available)
+            status = instance.sudo(
+                ['pip', 'install', '-I', '--use-wheel', '--no-index',
+                 '--find-links=' + remote_path + '/wheels'] + available,
+                environ={'CI': '1'}
+            )
+            instance.do(['rm', '-rf', remote_path])
+        if status:
+            logger.warn('failed to install from wheels (%d)', status)
+            return specs
+        return failed
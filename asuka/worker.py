@@ -0,0 +1,279 @@
+""":mod:`asuka.worker` --- Job workers
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:class:`Worker` admits jobs from the :attr:`App.job_queue
+<asuka.app.App.job_queue>` and runs them in its own pool of processes.
+By default the web frontend runs a worker in a background thread,
+but if :attr:`App.external_workers <asuka.app.App.external_workers>`
+is set, jobs are run only by :program:`asuka-worker` processes.
+With the default SQLite backend they have to run on the same host as
+the web frontend, since the :attr:`~asuka.app.App.data_dir` can't be
+shared over a network filesystem.  Workers on several nodes need
+another :attr:`~asuka.app.App.job_queue_backend`.
+
+Jobs are leased to the worker which admitted them, and the worker
+renews their leases by heartbeats.  If a worker dies, its leases
+expire and other workers retry its jobs.
+
+"""
+import functools
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from .coordinator import BuildCancelledError
+from .events import EventLog
+from .jobqueue import CapacityPolicy
+from .logger import LoggerProviderMixin
+from .notify import Notifier
+
+__all__ = 'Worker', 'publish_job', 'run_job'
+
+
+class Worker(LoggerProviderMixin):
+    """The worker which runs jobs of the ``app``. ::
+
+        worker = Worker(app)
+        worker.run()
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+    :param name: the unique name of the worker.  default is the hostname
+    :type name: :class:`basestring`
+    :param processes: the number of jobs to run at a time.  default is
+                      twice the number of CPUs plus one
+    :type processes: :class:`numbers.Integral`
+
+    """
+
+    #: (:class:`numbers.Real`) Seconds between heartbeats.  Queued jobs
+    #: are also admitted at least this often even if nothing wakes up
+    #: the worker, since capacity can also be freed outside of the queue
+    #: e.g. by terminated instances.
+    interval = 30
+
+    #: (:class:`numbers.Real`) Seconds of leases.  It has to be longer
+    #: than :attr:`interval`.
+    lease = 120
+
+    #: (:class:`numbers.Integral`) The maximum number of attempts of
+    #: a job whose worker died.
+    max_attempts = 3
+
+    #: (:class:`numbers.Real`) Seconds to wait for a cancelled or timed out
+    #: job to stop at the next stage boundary before its process is
+    #: killed.
+    kill_grace = 300
+
+    #: (:class:`numbers.Real`) Seconds to wait for an admitted job to
+    #: record its process before it's regarded as lost.
+    start_timeout = 300
+
+    def __init__(self, app, name=None, processes=None):
+        from .app import App
+        if not isinstance(app, App):
+            raise TypeError('app must be an instance of asuka.app.App, not ' +
+                            repr(app))
+        if processes is None:
+            try:
+                processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                processes = 3
+            else:
+                processes = processes * 2 + 1
+        self.app = app
+        self.name = name or socket.gethostname()
+        self.processes = processes
+        self.queue = app.job_queue
+        self.policy = CapacityPolicy(app)
+        self.notifier = Notifier(app)
+        self.pool = multiprocessing.Pool(processes)
+        self.event = threading.Event()
+
+    def wake(self):
+        """Wakes up the worker to admit jobs immediately e.g. after
+        a job is enqueued.
+
+        """
+        self.event.set()
+
+    def admits(self, job, running):
+        """The admission policy of the worker.  It allows at most
+        :attr:`processes` jobs of the worker at a time, and respects
+        the :class:`~asuka.jobqueue.CapacityPolicy` of the app.
+
+        """
+        mine = sum(1 for j in running if j.worker == self.name)
+        return mine < self.processes and self.policy(job, running)
+
+    def step(self):
+        """Renews leases, :meth:`watch()`\ es running jobs, requeues
+        expired jobs of dead workers, retries due notifications, and
+        then runs admitted jobs.
+
+        """
+        logger = self.get_logger('step')
+        self.queue.heartbeat(self.name, self.lease)
+        self.watch()
+        self.queue.expire(self.max_attempts)
+        self.notifier.flush()
+        self.policy.prepare()
+        while True:
+            job = self.queue.admit(self.admits, self.name, self.lease)
+            if job is None:
+                break
+            logger.info('#%d %s %s [%s] (attempt %d)', job.id, job.kind,
+                        job.label, job.commit, job.attempts)
+            self.pool.apply_async(
+                run_job,
+                (self.app, job.id, job.kind, job.label, job.commit,
+                 job.arguments),
+                callback=functools.partial(self.finish, job.id)
+            )
+
+    def watch(self):
+        """Finishes running jobs of the worker whose process died or
+        never started, and kills processes of jobs that don't stop in
+        :attr:`kill_grace` seconds after they were cancelled or timed out.
+
+        """
+        logger = self.get_logger('watch')
+        now = time.time()
+        for job in self.queue.list(states=('running',)):
+            if job.worker != self.name:
+                continue
+            elif job.pid is None:
+                if now > job.started_at + self.start_timeout:
+                    logger.warn('#%d: the process never started', job.id)
+                    self.finish(job.id, 'lost')
+                continue
+            try:
+                os.kill(job.pid, 0)
+            except OSError:
+                logger.warn('#%d: the process %d died', job.id, job.pid)
+                self.finish(job.id, 'lost')
+                continue
+            if (job.cancelled_at is not None and
+                now > job.cancelled_at + self.kill_grace):
+                state = 'cancelled'
+            elif (job.deadline is not None and
+                  now > job.deadline + self.kill_grace):
+                state = 'timed-out'
+            else:
+                continue
+            logger.warn('#%d %s; kill the process %d', job.id, state, job.pid)
+            try:
+                os.kill(job.pid, signal.SIGKILL)
+            except OSError as e:
+                logger.exception(e)
+            self.finish(job.id, state)
+
+    def finish(self, job_id, state):
+        """Called back when the job has finished in the :attr:`pool`."""
+        self.queue.finish(job_id, state, worker=self.name)
+        publish_job(self.app, self.queue.get(job_id), state)
+        self.wake()
+
+    def run(self):
+        """Runs the worker until it's interrupted.  Jobs which are still
+        running are requeued when it stops.
+
+        """
+        logger = self.get_logger('run')
+        self.queue.recover(self.name)
+        logger.info('%s started with %d processes',
+                    self.name, self.processes)
+        try:
+            while True:
+                try:
+                    self.step()
+                except Exception as e:
+                    logger.exception(e)
+                self.event.wait(self.interval)
+                self.event.clear()
+        finally:
+            self.pool.terminate()
+            self.queue.recover(self.name)
+            logger.info('%s stopped', self.name)
+
+    def run_in_background(self):
+        """Runs the worker in a daemon thread.
+
+        :returns: the thread
+        :rtype: :class:`threading.Thread`
+
+        """
+        thread = threading.Thread(target=self.run, name='worker-' + self.name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def run_job(app, job_id, kind, branch, commit, arguments):
+    """Runs the :class:`~asuka.jobqueue.Job` of the ``kind`` in the pool
+    process.  It calls the ``kind + '_worker'`` function of
+    :mod:`asuka.web`, which returns ``False`` if it failed or was stopped.
+    Build logs of the job are flushed and closed after it.
+
+    :returns: the final state of the job
+    :rtype: :class:`basestring`
+
+    """
+    from . import web
+    from .build import BuildLogHandler
+    queue = app.job_queue
+    try:
+        queue.start(job_id, os.getpid())
+        publish_job(app, queue.get(job_id), 'running')
+        function = getattr(web, kind + '_worker')
+        result = function(app, branch, commit, *arguments,
+                          listeners=[queue.listener(job_id)])
+    except BuildCancelledError as e:
+        logging.getLogger(__name__ + '.run_job').info('%s', e)
+        result = False
+    except Exception as e:
+        logging.getLogger(__name__ + '.run_job').exception(e)
+        result = False
+    finally:
+        # Build logs are written in the background; make sure they are
+        # all written, and don't leak into logs of the next job.
+        logger = logging.getLogger('asuka')
+        for handler in list(logger.handlers):
+            if isinstance(handler, BuildLogHandler):
+                logger.removeHandler(handler)
+                handler.close()
+    if result is not False:
+        return 'done'
+    # The pool calls back only if it returns, so it must not raise
+    # e.g. when the database is locked.
+    try:
+        job = queue.get(job_id)
+    except Exception as e:
+        logging.getLogger(__name__ + '.run_job').exception(e)
+        return 'failed'
+    if job.cancelled_at is not None:
+        return 'cancelled'
+    elif job.deadline is not None and time.time() > job.deadline:
+        return 'timed-out'
+    return 'failed'
+
+
+def publish_job(app, job, state):
+    """Publishes the ``'job'`` event to the :class:`~asuka.events.EventLog`.
+
+    :param app: the application
+    :type app: :class:`~asuka.app.App`
+    :param job: the started or finished job
+    :type job: :class:`~asuka.jobqueue.Job`
+    :param state: the new state of the job
+    :type state: :class:`basestring`
+
+    """
+    if job is None:
+        return
+    EventLog(app).publish('job', id=job.id, kind=job.kind, label=job.label,
+                          commit=job.commit, state=state)
@@ -96,7 +96,8 @@ setup(
     license='MIT License',
     entry_points={
         'console_scripts': [
-            'asuka-server = asuka.cli:run_server'
+            'asuka-server = asuka.cli:run_server',
+            'asuka-worker = asuka.cli:run_worker'
         ]
     },
     cmdclass={'upload_doc': upload_doc}